@@ -1,3 +1,5 @@
+import asyncio
+import hmac
 import json
 import logging
 import re
@@ -5,6 +7,8 @@ from dotenv import load_dotenv
 from fastapi.security import APIKeyHeader, OAuth2PasswordBearer
 from fastapi import Depends, status, HTTPException
 import os
+import threading
+import time
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 import psycopg2
@@ -47,65 +51,131 @@ def connect_db():
         print(f"Error connecting to PostgreSQL database: {error}")
         return None, None
 
-def retrieve_keys(microservice_id: str):
-    """
-    Retrieve the API key for the specified microservice from the database.
-
-    This function connects to the database, executes a query to fetch the API key
-    associated with the given microservice ID, and returns the key if found. If the 
-    database connection fails or the query encounters an error, appropriate error 
-    messages are logged.
+API_KEYS_TTL = float(os.getenv('API_KEYS_TTL', 300)) # seconds after which the cached keys are reloaded in the background
+API_KEYS_MISS_INTERVAL = float(os.getenv('API_KEYS_MISS_INTERVAL', 5)) # minimum seconds between two reloads caused by an unknown key
 
-    Args:
-        microservice_id (str): The unique identifier of the microservice whose API key 
-                               needs to be retrieved.
+def retrieve_keys():
+    """
+    Retrieve the API keys of all the microservices from the database with a single query.
 
     Returns:
-        str or None: The API key associated with the specified microservice ID if found, 
-                     otherwise None.
-
-    Raises:
-        Exception: If there is an error during the database query execution, it will be 
-                   logged but not raised. The function will return None in such cases.
+        dict or None: A dictionary ServiceID -> API key, None if the database could not be queried.
     """
-
-    # Retrieve the API key for the specified microservice from the database
     connection, cursor = connect_db()
     if connection is None or cursor is None:
         logging.error("Database connection failed")
-        return None #json.load(open(API_KEYS_FILE_PATH, 'r'))['microservice'][microservice_id]    
+        return None
     try:
-        query = "SELECT KEY FROM Microservices WHERE ServiceID = %s"
-        cursor.execute(query, (microservice_id,))
-        row = cursor.fetchone()
-        if row:
-            result = row[0]
-        else:
-            result = None
+        cursor.execute("SELECT ServiceID, KEY FROM Microservices")
+        result = {service_id: key for service_id, key in cursor.fetchall()}
     except Exception as e:
         logging.error("Database query failed: %s", str(e))
-        #result = json.load(open(API_KEYS_FILE_PATH, 'r'))['microservice'][microservice_id]
+        result = None
     finally:
         cursor.close()
         connection.close()
     return result
-    
+
+class ApiKeyCache:
+    """
+    In-memory copy of the Microservices table, shared by all the requests of the service.
+
+    The keys are loaded at the first request and reloaded in a worker thread once they are older
+    than the TTL, the requests are verified with the previous keys meanwhile. Until a first load
+    succeeds every request tries to load the keys again, so a database unreachable at startup
+    does not reject all the callers until the next reload. An unknown key
+    triggers an immediate reload (at most once every miss_interval seconds), so a key added or
+    rotated in the database is accepted without waiting for the TTL. The database is never
+    queried on the event loop.
+
+    Attributes:
+        ttl (float): Seconds after which the keys are reloaded in the background.
+        miss_interval (float): Minimum seconds between two reloads caused by an unknown key.
+    """
+
+    def __init__(self, ttl=API_KEYS_TTL, miss_interval=API_KEYS_MISS_INTERVAL):
+        self.ttl = ttl
+        self.miss_interval = miss_interval
+        self._keys = {}
+        self._checked_at = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def refresh(self, max_age=0):
+        """
+        Reload the keys from the database, unless they were loaded less than max_age seconds ago.
+        Blocking. If the database cannot be queried the previous keys are kept and the load time
+        is not updated, the next reload is not delayed.
+        """
+        with self._lock:
+            if self._checked_at is not None and time.monotonic() - self._checked_at < max_age:
+                return
+            keys = retrieve_keys()
+            if keys is not None:
+                self._keys = keys
+                self._checked_at = time.monotonic()
+
+    def _background_refresh(self):
+        try:
+            self.refresh(self.ttl)
+        finally:
+            self._refreshing = False
+
+    def _matches(self, api_key, microservice_ids):
+        # every allowed key is compared, in constant time, so the timing tells nothing about the keys
+        keys = self._keys
+        matched = False
+        for microservice_id in microservice_ids:
+            key = keys.get(microservice_id)
+            if key is not None and hmac.compare_digest(api_key.encode(), key.encode()):
+                matched = True
+        return matched
+
+    async def verify(self, api_key, microservice_ids):
+        """
+        Check an API key against the keys of the given microservices.
+
+        Args:
+            api_key (str): The key sent by the caller.
+            microservice_ids (list): The microservice IDs allowed to call the endpoint.
+
+        Returns:
+            bool: True if the key belongs to one of the microservices.
+        """
+        if self._checked_at is None:
+            await asyncio.to_thread(self.refresh, self.miss_interval)
+        elif time.monotonic() - self._checked_at >= self.ttl and not self._refreshing:
+            self._refreshing = True
+            asyncio.get_running_loop().run_in_executor(None, self._background_refresh)
+        if self._matches(api_key, microservice_ids):
+            return True
+        if self._checked_at is None:
+            # the keys could not be loaded, this request already tried
+            return False
+        # the key may have been added or rotated since the last load
+        if time.monotonic() - self._checked_at < self.miss_interval:
+            return False
+        await asyncio.to_thread(self.refresh, self.miss_interval)
+        return self._matches(api_key, microservice_ids)
+
+api_key_cache = ApiKeyCache()
+
 def get_verify_api_key(microservice_ids: list):
     """
     Creates an asynchronous dependency function to verify an API key against a list of microservice IDs.
+    The keys are read from the in-memory cache of the service (see ApiKeyCache).
 
     Args:
-        microservice_ids (list): A list of microservice IDs to retrieve valid API keys from.
+        microservice_ids (list): A list of microservice IDs whose API keys are accepted.
 
     Returns:
         function: An asynchronous function that verifies the provided API key.
 
     Raises:
-        HTTPException: If the provided API key is not found in the list of valid API keys, an HTTP 401 Unauthorized exception is raised.
+        HTTPException: If the provided API key does not belong to any of the microservices, an HTTP 401 Unauthorized exception is raised.
     """
     async def verify_api_key(api_key: str = Depends(api_key_header)):
-        matched_keys = [retrieve_keys(microservice_id) for microservice_id in microservice_ids]
-        if api_key not in matched_keys:
+        if not await api_key_cache.verify(api_key, microservice_ids):
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid API key")
     return verify_api_key
 
@@ -83,6 +83,32 @@ app.add_middleware(
 )
 
 
+def validate_alert(alert: Alert):
+    """
+    Checks that an alert can be notified.
+
+    Args:
+        alert (Alert): The alert object containing notification details.
+    Raises:
+        HTTPException: If the alert has no title, description, notification method or recipients.
+    """
+    if not alert.title:
+        logging.error("Missing notification title")
+        raise HTTPException(status_code=400, detail="Missing notification title")
+
+    if not alert.description:
+        logging.error("Missing notification description")
+        raise HTTPException(status_code=400, detail="Missing notification description")
+
+    if not alert.isPush and not alert.isEmail:
+        logging.error("No notification method selected")
+        raise HTTPException(status_code=400, detail="No notification method selected")
+
+    if not alert.recipients or len(alert.recipients) == 0:
+        logging.error("No recipients specified")
+        raise HTTPException(status_code=400, detail="No recipients specified")
+
+
 @app.post("/smartfactory/postAlert")
 async def post_alert(alert: Alert, api_key: str = Depends(get_verify_api_key(["data"]))):
     """
@@ -101,21 +127,7 @@ async def post_alert(alert: Alert, api_key: str = Depends(get_verify_api_key(["d
     try:
         logging.info("Received alert with title: %s", alert.description)
 
-        if not alert.title:
-            logging.error("Missing notification title")
-            raise HTTPException(status_code=400, detail="Missing notification title")
-
-        if not alert.description:
-            logging.error("Missing notification description")
-            raise HTTPException(status_code=400, detail="Missing notification description")
-
-        if not alert.isPush and not alert.isEmail:
-            logging.error("No notification method selected")
-            raise HTTPException(status_code=400, detail="No notification method selected")
-
-        if not alert.recipients or len(alert.recipients) == 0:
-            logging.error("No recipients specified")
-            raise HTTPException(status_code=400, detail="No recipients specified")
+        validate_alert(alert)
 
         logging.info("Sending notification")
         send_notification(alert)
@@ -139,6 +151,34 @@ async def post_alert(alert: Alert, api_key: str = Depends(get_verify_api_key(["d
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/smartfactory/postAlerts")
+async def post_alerts(alerts: List[Alert], api_key: str = Depends(get_verify_api_key(["data"]))):
+    """
+    Endpoint to post a batch of alerts.
+    Every alert is validated and notified as by /smartfactory/postAlert, independently of the
+    others: an invalid alert or a failed notification does not fail the batch.
+    Args:
+        alerts (List[Alert]): The alert objects containing notification details.
+    Returns:
+        Response: A response object with status code 200 and, for every alert in order, its status:
+        'sent', 'rejected' (invalid alert) or 'failed' (the notification could not be sent).
+    """
+    logging.info("Received a batch of %d alerts", len(alerts))
+    results = []
+    for alert in alerts:
+        try:
+            validate_alert(alert)
+            # notifications write to the database and send emails, off the event loop
+            await asyncio.to_thread(send_notification, alert)
+            results.append({"status": "sent"})
+        except HTTPException as e:
+            results.append({"status": "rejected", "detail": e.detail})
+        except Exception as e:
+            logging.error("Exception: %s", str(e))
+            results.append({"status": "failed", "detail": str(e)})
+    return JSONResponse(content={"results": results}, status_code=200)
+
+
 @app.get("/smartfactory/alerts/{userId}")
 def get_alerts(userId: str, all: bool = True, api_key: str = Depends(get_verify_api_key(["gui"]))):
     """
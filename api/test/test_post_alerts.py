@@ -0,0 +1,95 @@
+import sys
+import os
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from fastapi.testclient import TestClient
+
+from app import app
+
+# statuses the alert outbox of data-processing counts (see AlertOutbox._post)
+OUTBOX_STATUSES = ('sent', 'rejected', 'failed')
+
+VALID_ALERT = {
+    "title": "Anomaly detected",
+    "type": "Anomaly",
+    "description": "The KPI consumption of Assembly Machine 1 is out of range",
+    "triggeredAt": "2024-10-10 10:00:00",
+    "machineName": "Assembly Machine 1",
+    "isPush": True,
+    "isEmail": False,
+    "recipients": ["FactoryFloorManager"],
+    "severity": "High"
+}
+
+class TestPostAlerts(unittest.TestCase):
+
+    def setUp(self):
+        # the API key check is not under test
+        route = next(r for r in app.routes if getattr(r, 'path', None) == '/smartfactory/postAlerts')
+        for dependency in route.dependant.dependencies:
+            app.dependency_overrides[dependency.call] = lambda: "test-key"
+        self.client = TestClient(app)
+
+    def tearDown(self):
+        app.dependency_overrides.clear()
+
+    @patch('app.send_notification')
+    def test_post_alerts_mixed_batch(self, mock_send_notification):
+        def send(alert):
+            if alert.title == 'Unreachable':
+                raise Exception("SMTP server unreachable")
+        mock_send_notification.side_effect = send
+
+        batch = [
+            VALID_ALERT,
+            dict(VALID_ALERT, title=""),
+            dict(VALID_ALERT, isPush=False, isEmail=False),
+            dict(VALID_ALERT, recipients=[]),
+            dict(VALID_ALERT, title="Unreachable")
+        ]
+        response = self.client.post('/smartfactory/postAlerts', json=batch)
+
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        # parsed as the outbox does
+        statuses = [r.get('status') for r in response.json().get('results', [])]
+        self.assertEqual(statuses, ['sent', 'rejected', 'rejected', 'rejected', 'failed'])
+        self.assertTrue(all(s in OUTBOX_STATUSES for s in statuses))
+        self.assertEqual(results[1]['detail'], "Missing notification title")
+        self.assertEqual(results[2]['detail'], "No notification method selected")
+        self.assertEqual(results[3]['detail'], "No recipients specified")
+        self.assertEqual(results[4]['detail'], "SMTP server unreachable")
+        # the rejected alerts are not notified
+        self.assertEqual(mock_send_notification.call_count, 2)
+
+    @patch('app.send_notification')
+    def test_post_alerts_all_sent(self, mock_send_notification):
+        response = self.client.post('/smartfactory/postAlerts', json=[VALID_ALERT] * 3)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['status'] for r in response.json()['results']], ['sent'] * 3)
+        self.assertEqual(mock_send_notification.call_count, 3)
+
+    @patch('app.send_notification')
+    def test_post_alerts_empty_batch(self, mock_send_notification):
+        response = self.client.post('/smartfactory/postAlerts', json=[])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"results": []})
+        mock_send_notification.assert_not_called()
+
+    @patch('app.send_notification')
+    def test_post_alerts_malformed_alert(self, mock_send_notification):
+        # a batch that does not match the Alert model is refused as a whole,
+        # the outbox sends it again in halves so that only the malformed alert is discarded
+        malformed = {k: v for k, v in VALID_ALERT.items() if k != 'severity'}
+        response = self.client.post('/smartfactory/postAlerts', json=[VALID_ALERT, malformed])
+
+        self.assertEqual(response.status_code, 422)
+        mock_send_notification.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
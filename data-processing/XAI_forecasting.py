@@ -1,13 +1,16 @@
-import torch
-import torch.nn as nn
+from __future__ import annotations  # torch.Tensor annotations must not import torch
 import numpy as np
-import matplotlib.pyplot as plt
-from aix360.algorithms.lime import LimeTabularExplainer
-from typing import Union, Any, List, Tuple
+from typing import Union, Any, List, Tuple, Optional
 import random
+from statistics import NormalDist
 from datetime import datetime, timedelta
-import xgboost as xgb
 import time
+from concurrent.futures import ThreadPoolExecutor
+from backends import get_backend, is_torch_module, is_torch_tensor
+
+# imported on first use: torch only serves nn.Module models, aix360 the LIME explanations
+torch = get_backend('torch')
+lime = get_backend('lime')
 
 class ForecastExplainer:
     def __init__(
@@ -16,7 +19,11 @@ class ForecastExplainer:
         training_data: Union[np.ndarray, torch.Tensor],
         training_outputs: Union[np.ndarray, torch.Tensor] = None,  # Made optional with default None
         use_residuals: bool = False,
-        device: torch.device = None
+        device: torch.device = None,
+        interval_quantiles: Optional[List[float]] = None,
+        interval_confidence: float = 0.95,
+        training_std: Optional[float] = None,
+        rng: Optional[np.random.Generator] = None
     ):
         """
         Initialize the ForecastExplainer.
@@ -28,7 +35,15 @@ class ForecastExplainer:
             training_outputs (Union[np.ndarray, torch.Tensor], optional): Training outputs of shape (num_samples,).
                 Required only when use_residuals is True. Defaults to None.
             use_residuals (bool): Whether to calculate bounds using residuals. Default is False.
-            device (torch.device, optional): Device to run the model on (CPU or GPU). If None, it is auto-selected.
+            device (torch.device, optional): Device to run the model on (CPU or GPU). If None, it is auto-selected for torch models.
+            interval_quantiles (List[float], optional): Half-widths of the prediction interval for each forecast step,
+                fitted at training time (e.g. split-conformal residual quantiles). When given, bounds are computed from
+                them and neither bootstrap nor residuals mode is used. Defaults to None.
+            interval_confidence (float): Coverage the interval_quantiles were fitted for. Default is 0.95.
+            training_std (float, optional): Standard deviation of the full training data, stored with the model.
+                When given, training_data can be just a sample of it (the LIME background). Defaults to None.
+            rng (np.random.Generator, optional): Generator of the bootstrap noise, pass a seeded one for reproducible
+                bounds. The global numpy state is never used, so concurrent explainers do not interfere. Defaults to None.
 
         Raises:
             ValueError: If use_residuals is True but training_outputs is None.
@@ -38,25 +53,31 @@ class ForecastExplainer:
             raise ValueError("training_outputs must be provided when use_residuals is True")
 
         self.model = model
-        self.device = device or (torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu'))
+        if device is None and is_torch_module(model):
+            device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+        self.device = device
         self.use_residuals = use_residuals
+        self.interval_quantiles = interval_quantiles
+        self.interval_confidence = interval_confidence
+        self.rng = rng if rng is not None else np.random.default_rng()
 
         # Convert training_data and training_outputs to numpy arrays if they're tensors
-        if isinstance(training_data, torch.Tensor):
+        if is_torch_tensor(training_data):
             training_data = training_data.detach().cpu().numpy()
-        if isinstance(training_outputs, torch.Tensor) and training_outputs is not None:
+        if is_torch_tensor(training_outputs):
             training_outputs = training_outputs.detach().cpu().numpy()
 
         self.training_data = training_data
         self.training_outputs = training_outputs
         self.num_samples, self.seq_length = self.training_data.shape
 
-        # Calculate and store training data statistics based on the selected mode
+        # Calculate and store training data statistics based on the selected mode, unless known
         if self.use_residuals:
             self.residuals = self.calculate_residuals()
+            self.residual_std = np.std(self.residuals)
         else:
             # Pre-calculate training data std for bootstrap mode
-            self.training_std = np.std(self.training_data)
+            self.training_std = training_std if training_std is not None else np.std(self.training_data)
 
     def calculate_residuals(self) -> np.ndarray:
         """
@@ -65,7 +86,7 @@ class ForecastExplainer:
         Returns:
             np.ndarray: Residuals of shape (num_samples,).
         """
-        if isinstance(self.model, nn.Module):
+        if is_torch_module(self.model):
             # For PyTorch models, predict in batches
             inputs_tensor = torch.from_numpy(self.training_data.reshape(self.num_samples, self.seq_length, 1)).float().to(self.device)
             self.model.eval()
@@ -105,10 +126,10 @@ class ForecastExplainer:
             np.ndarray: A 1D numpy array (shape (1,)) representing the model's prediction.
         """
         # Ensure input_data is a numpy array
-        if isinstance(input_data, torch.Tensor):
+        if is_torch_tensor(input_data):
             input_data = input_data.detach().cpu().numpy()
 
-        if isinstance(self.model, nn.Module):
+        if is_torch_module(self.model):
             # PyTorch model prediction
             input_data_reshaped = input_data.reshape(1, self.seq_length, 1)
             input_tensor = torch.from_numpy(input_data_reshaped).float().to(self.device)
@@ -122,6 +143,23 @@ class ForecastExplainer:
 
         return prediction
 
+    def interval_half_width(self, step: int) -> float:
+        """
+        Half-width of the stored prediction interval at a given forecast step.
+
+        Beyond the calibrated horizon the last quantile is scaled with the square root of the horizon.
+
+        Args:
+            step (int): The forecast step, starting from 0.
+
+        Returns:
+            float: The value to add and subtract to the point forecast.
+        """
+        n_calibrated = len(self.interval_quantiles)
+        if step < n_calibrated:
+            return self.interval_quantiles[step]
+        return self.interval_quantiles[-1] * np.sqrt((1 + step) / n_calibrated)
+
     def predict_with_uncertainty(
         self,
         input_data: np.ndarray,
@@ -132,7 +170,9 @@ class ForecastExplainer:
         """
         Make a prediction with uncertainty estimation.
 
-        Two modes of operation:
+        If interval_quantiles were given, the bounds are the raw prediction plus/minus the stored
+        quantile of the step (beyond the calibrated horizon the last quantile is scaled with the
+        square root of the horizon). Otherwise two modes of operation:
         1. Residuals mode (use_residuals=True):
            - Uses historical residuals to compute standard deviation
            - Applies z-scores based on confidence level
@@ -160,30 +200,30 @@ class ForecastExplainer:
         """
         mean_pred = self.predict(input_data)[0]
 
+        if self.interval_quantiles is not None:
+            half_width = self.interval_half_width(step)
+            return mean_pred, mean_pred - half_width, mean_pred + half_width, self.interval_confidence
+
         # Scale uncertainty with prediction horizon ("Square Root of Time" rule in volatility scaling)
         uncertainty_scale = np.sqrt(1 + step)  # Square root growth of uncertainty
 
         if self.use_residuals:
-            # Calculate statistics of residuals
-            residual_std = np.std(self.residuals)
-            
             # Calculate z-score for the desired confidence interval
             # For example, for 95% confidence, z_score ≈ 1.96
-            z_score = np.abs(np.percentile(np.random.standard_normal(10000), 
-                                         [((1-confidence)/2)*100, (1-(1-confidence)/2)*100]))
-            
+            z_score = NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+
             # Calculate bounds
-            lower_bound = mean_pred - z_score[0] * residual_std * uncertainty_scale
-            upper_bound = mean_pred + z_score[1] * residual_std * uncertainty_scale
+            lower_bound = mean_pred - z_score * self.residual_std * uncertainty_scale
+            upper_bound = mean_pred + z_score * self.residual_std * uncertainty_scale
 
         else:
             # Use pre-calculated training data std and scale it with step
             bootstrap_noise_std = self.training_std * uncertainty_scale
 
             perturbed_inputs = np.repeat(input_data.reshape(1, -1), n_samples, axis=0) 
-            perturbed_inputs += np.random.normal(0, bootstrap_noise_std, size=perturbed_inputs.shape)
+            perturbed_inputs += self.rng.normal(0, bootstrap_noise_std, size=perturbed_inputs.shape)
 
-            if isinstance(self.model, nn.Module):
+            if is_torch_module(self.model):
                 # PyTorch model: run batch through model
                 inputs_tensor = torch.from_numpy(perturbed_inputs.reshape(n_samples, self.seq_length, 1)).float().to(self.device)
                 self.model.eval()
@@ -205,7 +245,8 @@ class ForecastExplainer:
         self,
         input_data: np.ndarray,
         input_labels: List[str],
-        num_features: int = 10
+        num_features: int = 10,
+        output_index: Optional[int] = None
     ) -> List[Tuple[str, float]]:
         """
         Generate a LIME explanation for the model's prediction on input_data.
@@ -217,6 +258,8 @@ class ForecastExplainer:
             input_data (np.ndarray): Input data of shape (seq_length,).
             input_labels (List[str]): Labels corresponding to each step in input_data.
             num_features (int, optional): Number of features to include in the explanation. Default is 10.
+            output_index (int, optional): For multi-output (direct multi-horizon) models, the output to explain.
+                Default is None, for single-output models.
 
         Globals:
             None
@@ -231,7 +274,7 @@ class ForecastExplainer:
 
         def predict_fn(data):
             batch_size = data.shape[0]
-            if isinstance(self.model, nn.Module):
+            if is_torch_module(self.model):
                 # For PyTorch models, reshape to (batch, seq_length, 1)
                 inputs = data.reshape(batch_size, self.seq_length, 1)
                 inputs_tensor = torch.from_numpy(inputs).float().to(self.device)
@@ -240,14 +283,17 @@ class ForecastExplainer:
                     outputs = self.model(inputs_tensor).cpu().numpy()
             else:
                 outputs = self.model.predict(data)
+            if output_index is not None:
+                outputs = np.asarray(outputs).reshape(batch_size, -1)[:, output_index]
             return outputs.flatten()
 
         # Instantiate a new LimeTabularExplainer for the current labels
-        explainer = LimeTabularExplainer(
+        explainer = lime.LimeTabularExplainer(
             training_data=self.training_data,
             feature_names=input_labels,  # Use the current labels directly
             mode='regression',
-            verbose=False
+            verbose=False,
+            random_state=42  # same explanation for the same forecast, independently of the other threads
         )
 
         exp = explainer.explain_instance(
@@ -268,7 +314,8 @@ class ForecastExplainer:
         num_features: int = 5,
         confidence: float = 0.95,
         n_samples: int = 100,
-        use_mean_pred: bool = False
+        use_mean_pred: bool = False,
+        explain_steps: Optional[int] = None
     ) -> dict:
         """
         Perform autoregressive prediction and explanation for n_predictions steps.
@@ -291,6 +338,8 @@ class ForecastExplainer:
             use_mean_pred (bool, optional): If True and in bootstrap mode, use mean of bootstrap 
                                           predictions as final prediction; else use raw prediction. 
                                           Has no effect in residuals mode. Default is False.
+            explain_steps (int, optional): Number of leading steps to explain with LIME, the remaining
+                                          steps get an empty explanation. None explains every step. Default is None.
 
         Globals:
             None
@@ -307,7 +356,7 @@ class ForecastExplainer:
                 'Lime_explaination' (List[List[Tuple[str,float]]]): LIME explanations per step.
                 'Date_prediction' (List[str]): Predicted date labels for each step.
         """
-        if isinstance(input_data, torch.Tensor):
+        if is_torch_tensor(input_data):
             input_data = input_data.detach().cpu().numpy()
 
         predicted_values = []
@@ -317,21 +366,27 @@ class ForecastExplainer:
         lime_explanations = []
         date_predictions = []
 
-        current_input = input_data.copy()
+        # The input window slides over a buffer preallocated for the whole rollout,
+        # each step only writes its prediction instead of building a new window
+        n_input = len(input_data)
+        rollout = np.empty(n_input + n_predictions, dtype=float)
+        rollout[:n_input] = np.asarray(input_data, dtype=float).reshape(-1)
         current_labels = input_labels.copy()
 
         for i in range(n_predictions):
+            current_input = rollout[i:i + n_input]
             # Compute uncertainties
             mean_pred, lower_bound, upper_bound, confidence_level = self.predict_with_uncertainty(
                 current_input, n_samples=n_samples, confidence=confidence, step=i
             )
-            # Compute raw prediction
-            raw_pred = self.predict(current_input)[0]
 
-            # Decide which prediction to use
-            final_pred = mean_pred if use_mean_pred else raw_pred
+            # Decide which prediction to use, the raw prediction costs a model call only when needed
+            final_pred = mean_pred if use_mean_pred else self.predict(current_input)[0]
 
-            explanation = self.explain_prediction(current_input, current_labels, num_features=num_features)
+            if explain_steps is None or i < explain_steps:
+                explanation = self.explain_prediction(current_input, current_labels, num_features=num_features)
+            else:
+                explanation = []
 
             predicted_values.append(final_pred)
             lower_bounds.append(lower_bound)
@@ -340,7 +395,7 @@ class ForecastExplainer:
             lime_explanations.append(explanation)
 
             # Update the input_data and labels for the next step
-            current_input = np.append(current_input[1:], final_pred)
+            rollout[n_input + i] = final_pred
             last_label_date = datetime.strptime(current_labels[-1], "%Y-%m-%d")
             new_label_date = last_label_date + timedelta(days=1)
             new_label = new_label_date.strftime("%Y-%m-%d")
@@ -358,6 +413,175 @@ class ForecastExplainer:
 
         return out_dict
 
+    def explain_rollout(
+        self,
+        input_data: Union[np.ndarray, torch.Tensor],
+        input_labels: List[str],
+        predicted_values: List[float],
+        num_features: int = 5
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        Generate the LIME explanations of an autoregressive forecast that was computed without them.
+
+        The input window of every step is rebuilt from the initial input and the predicted values,
+        exactly as predict_and_explain shifts it, so the forecast itself is not recomputed.
+
+        Args:
+            input_data (Union[np.ndarray, torch.Tensor]): Initial input sequence of shape (seq_length,).
+            input_labels (List[str]): Labels corresponding to the input_data.
+            predicted_values (List[float]): The values returned by predict_and_explain.
+            num_features (int, optional): Number of features for LIME explanation. Default is 5.
+
+        Returns:
+            List[List[Tuple[str, float]]]: One list of (feature_label, importance) pairs per predicted value.
+        """
+        if is_torch_tensor(input_data):
+            input_data = input_data.detach().cpu().numpy()
+
+        lime_explanations = []
+        current_input = input_data.copy()
+        current_labels = input_labels.copy()
+
+        for pred in predicted_values:
+            lime_explanations.append(self.explain_prediction(current_input, current_labels, num_features=num_features))
+
+            current_input = np.append(current_input[1:], pred)
+            last_label_date = datetime.strptime(current_labels[-1], "%Y-%m-%d")
+            new_label = (last_label_date + timedelta(days=1)).strftime("%Y-%m-%d")
+            current_labels = current_labels[1:] + [new_label]
+
+        return lime_explanations
+
+    def predict_and_explain_direct(
+        self,
+        input_data: Union[np.ndarray, torch.Tensor],
+        n_predictions: int,
+        input_labels: List[str],
+        num_features: int = 5,
+        confidence: float = 0.95,
+        n_samples: int = 100,
+        explain_steps: Optional[int] = None
+    ) -> dict:
+        """
+        Perform direct multi-horizon prediction and explanation for n_predictions steps.
+
+        The model predicts a whole block of steps from one input window with a single call.
+        When n_predictions exceeds the model's horizon, the next block starts from the window
+        shifted by the previous block's predictions.
+
+        Uncertainty bounds come from interval_quantiles when available, otherwise from one batched
+        bootstrap call per block (percentiles computed for every output at once).
+
+        Args:
+            input_data (Union[np.ndarray, torch.Tensor]): Initial input sequence of shape (seq_length,).
+            n_predictions (int): Number of predictions to make.
+            input_labels (List[str]): Labels corresponding to the input_data.
+            num_features (int, optional): Number of features for LIME explanation. Default is 5.
+            confidence (float, optional): Confidence level for interval estimation. Default is 0.95.
+            n_samples (int, optional): Number of bootstrap samples for uncertainty estimation. Default is 100.
+            explain_steps (int, optional): Number of leading steps to explain with LIME. None explains every step.
+
+        Returns:
+            dict: The same keys as predict_and_explain, plus 'Blocks': the (input window, labels,
+                first step, number of steps) of every model call, used by explain_direct.
+        """
+        if is_torch_tensor(input_data):
+            input_data = input_data.detach().cpu().numpy()
+
+        predicted_values = []
+        lower_bounds = []
+        upper_bounds = []
+        confidence_scores = []
+        date_predictions = []
+        blocks = []
+
+        current_input = np.asarray(input_data, dtype=float).copy()
+        current_labels = input_labels.copy()
+
+        while len(predicted_values) < n_predictions:
+            first_step = len(predicted_values)
+            block = np.asarray(self.model.predict(current_input.reshape(1, -1))).reshape(-1)
+            n_block = min(len(block), n_predictions - first_step)
+            block = block[:n_block]
+
+            if self.interval_quantiles is not None:
+                half_widths = np.array([self.interval_half_width(first_step + h) for h in range(n_block)])
+                lower = block - half_widths
+                upper = block + half_widths
+                confidence_level = self.interval_confidence
+            else:
+                bootstrap_noise_std = self.training_std * np.sqrt(1 + first_step)
+                perturbed_inputs = np.repeat(current_input.reshape(1, -1), n_samples, axis=0)
+                perturbed_inputs += self.rng.normal(0, bootstrap_noise_std, size=perturbed_inputs.shape)
+                predictions = np.asarray(self.model.predict(perturbed_inputs)).reshape(n_samples, -1)[:, :n_block]
+                lower = np.percentile(predictions, ((1 - confidence) / 2) * 100, axis=0)
+                upper = np.percentile(predictions, (confidence + (1 - confidence) / 2) * 100, axis=0)
+                confidence_level = confidence
+
+            blocks.append((current_input.copy(), list(current_labels), first_step, n_block))
+            predicted_values.extend(block)
+            lower_bounds.extend(lower)
+            upper_bounds.extend(upper)
+            confidence_scores.extend([confidence_level] * n_block)
+
+            # Shift the window and the labels by the predicted block
+            last_label_date = datetime.strptime(current_labels[-1], "%Y-%m-%d")
+            new_labels = [(last_label_date + timedelta(days=h + 1)).strftime("%Y-%m-%d") for h in range(n_block)]
+            date_predictions.extend(new_labels)
+            current_input = np.concatenate([current_input, block])[-self.seq_length:]
+            current_labels = (current_labels + new_labels)[-self.seq_length:]
+
+        out_dict = {
+            'Predicted_value': predicted_values,
+            'Lower_bound': lower_bounds,
+            'Upper_bound': upper_bounds,
+            'Confidence_score': confidence_scores,
+            'Lime_explaination': self.explain_direct(blocks, num_features=num_features, explain_steps=explain_steps),
+            'Date_prediction': date_predictions,
+            'Blocks': blocks
+        }
+
+        return out_dict
+
+    def explain_direct(
+        self,
+        blocks: List[Tuple[np.ndarray, List[str], int, int]],
+        num_features: int = 5,
+        explain_steps: Optional[int] = None,
+        max_workers: int = 4
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        Generate the LIME explanations of a direct multi-horizon forecast.
+
+        Every step is explained with respect to the input window of the model call that produced it.
+        The steps are independent, so they are explained in parallel.
+
+        Args:
+            blocks (List[Tuple[np.ndarray, List[str], int, int]]): The 'Blocks' returned by predict_and_explain_direct.
+            num_features (int, optional): Number of features for LIME explanation. Default is 5.
+            explain_steps (int, optional): Number of leading steps to explain, the others get an empty explanation.
+            max_workers (int, optional): Number of threads used for the explanations. Default is 4.
+
+        Returns:
+            List[List[Tuple[str, float]]]: One list of (feature_label, importance) pairs per step.
+        """
+        n_steps = sum(block[3] for block in blocks)
+        tasks = [
+            (window, labels, h)
+            for window, labels, first_step, n_block in blocks
+            for h in range(n_block)
+            if explain_steps is None or first_step + h < explain_steps
+        ]
+        if len(tasks) == 0:
+            return [[] for _ in range(n_steps)]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            explanations = list(pool.map(
+                lambda task: self.explain_prediction(task[0], task[1], num_features=num_features, output_index=task[2]),
+                tasks
+            ))
+        return explanations + [[] for _ in range(n_steps - len(explanations))]
+
 
 def main():
     """
@@ -377,8 +601,10 @@ def main():
         None
     """
     # Seed
+    import matplotlib.pyplot as plt
+    import xgboost as xgb
+
     np.random.seed(42)
-    torch.manual_seed(42)
     random.seed(42)
 
     # Generate a sine wave
@@ -0,0 +1,235 @@
+import asyncio
+import json
+import os
+import threading
+from collections import deque
+
+import httpx
+from pydantic import ValidationError
+
+from model import Alert
+
+# Outbox of the alerts sent to the gateway. Monitoring and drift detection only queue their
+# alerts, which never blocks on the network: a task of the event loop sends them in batches to
+# /smartfactory/postAlerts through one pooled httpx.AsyncClient, with a timeout and retries.
+# When the gateway stays unreachable, or refuses the batch for now (API key not loaded or rotated,
+# too many requests), the batch goes back to the queue and is sent again at the next round. The
+# alerts are validated against the Alert model when queued, and a batch the gateway still refuses
+# as malformed is split so that only its invalid alerts are discarded. At shutdown the queue is flushed, what is still pending is written to ALERT_SPOOL
+# (when set) and queued again at the next start.
+
+ALERT_URL = os.getenv('ALERT_URL', 'http://api:8000/smartfactory/postAlerts')
+ALERT_BATCH_SIZE = int(os.getenv('ALERT_BATCH_SIZE', 50))
+ALERT_FLUSH_INTERVAL = float(os.getenv('ALERT_FLUSH_INTERVAL', 1.0)) # seconds between two sending rounds
+ALERT_TIMEOUT = float(os.getenv('ALERT_TIMEOUT', 10))
+ALERT_RETRIES = int(os.getenv('ALERT_RETRIES', 3)) # attempts after the first one, with exponential backoff
+ALERT_MAX_PENDING = int(os.getenv('ALERT_MAX_PENDING', 10000)) # past it the oldest alerts are dropped
+ALERT_SPOOL = os.getenv('ALERT_SPOOL', '') # file keeping the unsent alerts across restarts, none if empty
+# statuses of a batch the gateway may accept later, it is retried and then queued again
+RETRY_LATER_STATUSES = (401, 403, 408, 429)
+
+class AlertOutbox:
+  """
+  Queue of alerts sent in batches by a task of the event loop.
+
+  Attributes:
+  - url: str, batch endpoint of the gateway.
+  - batch_size: int, maximum number of alerts per request.
+  - interval: float, seconds between two sending rounds, a full batch is sent right away.
+  - timeout: float, seconds allowed to a request.
+  - retries: int, attempts after the first failed one.
+  - max_pending: int, maximum number of queued alerts.
+  - spool: str, file of the alerts still unsent at shutdown, '' to keep them in memory only.
+  """
+
+  def __init__(self, url = ALERT_URL, batch_size = ALERT_BATCH_SIZE, interval = ALERT_FLUSH_INTERVAL, timeout = ALERT_TIMEOUT,
+               retries = ALERT_RETRIES, max_pending = ALERT_MAX_PENDING, spool = ALERT_SPOOL):
+    self.url = url
+    self.batch_size = batch_size
+    self.interval = interval
+    self.timeout = timeout
+    self.retries = retries
+    self.max_pending = max_pending
+    self.spool = spool
+    self._pending = deque()
+    self._lock = threading.Lock()
+    self._loop = None
+    self._wakeup = None
+    self._task = None
+    self._client = None
+    self.sent = 0
+    self.rejected = 0
+    self.failed = 0
+    self.retried = 0
+    self.dropped = 0
+
+  def put(self, alert):
+    """
+    Queues an alert, from any thread.
+
+    :param alert: dictionary with the fields of the Alert model of the gateway, an alert not
+      matching the model is counted as rejected and not queued.
+    """
+    try:
+      Alert(**alert)
+    except (ValidationError, TypeError) as e:
+      print(f"Alert rejected, it does not match the Alert model: {e}")
+      with self._lock:
+        self.rejected += 1
+      return
+    with self._lock:
+      if len(self._pending) >= self.max_pending:
+        self._pending.popleft()
+        self.dropped += 1
+      self._pending.append(alert)
+      full = len(self._pending) >= self.batch_size
+      loop, wakeup = self._loop, self._wakeup
+    if full and loop is not None:
+      try:
+        loop.call_soon_threadsafe(wakeup.set)
+      except RuntimeError:
+        pass # the loop is closing, the alert is spooled by shutdown
+
+  def _take(self):
+    with self._lock:
+      return [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+
+  def _requeue(self, alerts):
+    with self._lock:
+      self._pending.extendleft(reversed(alerts))
+
+  async def _post(self, batch, api_key):
+    """
+    Sends a batch, retrying on network errors, server errors and the statuses of RETRY_LATER_STATUSES.
+    A batch refused as malformed (422) is sent again in halves, down to the single invalid alerts.
+
+    :return: list of the alerts not delivered because the gateway could not be reached or refused
+      them for now, they must be sent again. Empty if the whole batch was handled.
+    """
+    delay = 0.5
+    for attempt in range(self.retries + 1):
+      try:
+        response = await self._client.post(self.url, json=batch, headers={"x-api-key": api_key})
+        if response.status_code < 500 and response.status_code not in RETRY_LATER_STATUSES:
+          break
+        print(f"Alert batch failed with status {response.status_code}")
+      except httpx.HTTPError as e:
+        print(f"Alert batch failed: {e}")
+      if attempt < self.retries:
+        self.retried += 1
+        await asyncio.sleep(delay)
+        delay *= 2
+    else:
+      return batch
+    if response.status_code == 422 and len(batch) > 1:
+      half = len(batch) // 2
+      undelivered = await self._post(batch[:half], api_key)
+      if undelivered:
+        return undelivered + batch[half:]
+      return await self._post(batch[half:], api_key)
+    if response.status_code >= 400:
+      print(f"Alert batch rejected with status {response.status_code}: {response.text}")
+      self.rejected += len(batch)
+      return []
+    # the alerts whose notification failed are not sent again, the gateway may have saved them already
+    try:
+      statuses = [r.get('status') for r in response.json().get('results', [])]
+    except ValueError:
+      statuses = ['sent'] * len(batch)
+    self.sent += statuses.count('sent')
+    self.rejected += statuses.count('rejected')
+    self.failed += statuses.count('failed')
+    return []
+
+  async def _drain(self, api_key):
+    """Sends the queued alerts until the queue is empty or the gateway is unreachable."""
+    while True:
+      batch = self._take()
+      if not batch:
+        return
+      try:
+        undelivered = await self._post(batch, api_key)
+      except asyncio.CancelledError:
+        self._requeue(batch)
+        raise
+      except Exception as e:
+        print(f"Alert batch failed: {e}")
+        undelivered = batch
+      if undelivered:
+        self._requeue(undelivered)
+        return
+
+  async def _run(self):
+    api_key = os.getenv('my_key')
+    while True:
+      try:
+        await asyncio.wait_for(self._wakeup.wait(), self.interval)
+      except asyncio.TimeoutError:
+        pass
+      self._wakeup.clear()
+      await self._drain(api_key)
+
+  async def start(self):
+    """
+    Starts the sending task on the running event loop, with the alerts spooled at the last shutdown.
+    """
+    if self._task is not None:
+      return
+    self._client = httpx.AsyncClient(timeout=self.timeout, limits=httpx.Limits(max_connections=4, max_keepalive_connections=4))
+    with self._lock:
+      self._loop = asyncio.get_running_loop()
+      self._wakeup = asyncio.Event()
+    if self.spool and os.path.exists(self.spool):
+      with open(self.spool) as f:
+        spooled = [json.loads(line) for line in f if line.strip()]
+      os.remove(self.spool)
+      self._requeue(spooled)
+      print(f"{len(spooled)} spooled alerts queued again")
+    self._task = asyncio.create_task(self._run())
+
+  async def shutdown(self):
+    """
+    Stops the sending task, sends what is still queued, and spools what could not be sent.
+    """
+    if self._task is not None:
+      self._task.cancel()
+      try:
+        await self._task
+      except asyncio.CancelledError:
+        pass
+      self._task = None
+    with self._lock:
+      self._loop = None
+    if self._client is not None:
+      await self._drain(os.getenv('my_key'))
+      await self._client.aclose()
+      self._client = None
+    remaining = self._take_all()
+    if remaining and self.spool:
+      with open(self.spool, 'a') as f:
+        for alert in remaining:
+          f.write(json.dumps(alert) + '\n')
+      print(f"{len(remaining)} unsent alerts spooled to {self.spool}")
+    elif remaining:
+      self.dropped += len(remaining)
+      print(f"{len(remaining)} unsent alerts dropped, set ALERT_SPOOL to keep them")
+
+  def _take_all(self):
+    with self._lock:
+      remaining = list(self._pending)
+      self._pending.clear()
+    return remaining
+
+  def stats(self):
+    with self._lock:
+      return {
+          'pending': len(self._pending),
+          'running': self._task is not None,
+          'sent': self.sent,
+          'rejected': self.rejected,
+          'failed': self.failed,
+          'retried': self.retried,
+          'dropped': self.dropped
+      }
+
+alert_outbox = AlertOutbox()
@@ -0,0 +1,147 @@
+import importlib
+import os
+import sys
+import threading
+import time
+
+# Registry of the heavy frameworks used by the forecasting code.
+# Importing xgboost, statsmodels, scikit-learn, torch and aix360 takes seconds, and
+# most requests only need some of them (torch is only needed for nn.Module models,
+# statsmodels only for the ARIMA ones). The modules get a Backend proxy instead of the
+# framework, and the framework is imported the first time one of its attributes is used.
+
+BACKENDS = {
+    'xgboost': 'xgboost',
+    'arima': 'statsmodels.tsa.statespace.sarimax',
+    'stattools': 'statsmodels.tsa.stattools',
+    'preprocessing': 'sklearn.preprocessing',
+    'model_selection': 'sklearn.model_selection',
+    'metrics': 'sklearn.metrics',
+    'torch': 'torch',
+    'lime': 'aix360.algorithms.lime',
+}
+
+# comma separated backends imported at startup in background, e.g. 'xgboost,lime',
+# so the first request does not pay for them
+BACKENDS_PRELOAD = os.getenv('BACKENDS_PRELOAD', '')
+
+class Backend:
+  """
+  Proxy of a module imported on first attribute access.
+
+  Attributes:
+  - name: str, name of the backend in the registry.
+  - module_name: str, module imported by the proxy.
+  - load_seconds: float, time spent importing the module, None until it is loaded.
+  """
+
+  def __init__(self, name, module_name):
+    self.name = name
+    self.module_name = module_name
+    self.load_seconds = None
+    self._module = None
+    self._lock = threading.Lock()
+
+  def load(self):
+    """
+    :return: the module of the backend, imported if it was not yet.
+    """
+    module = self._module
+    if module is None:
+      with self._lock:
+        if self._module is None:
+          start = time.perf_counter()
+          self._module = importlib.import_module(self.module_name)
+          self.load_seconds = time.perf_counter() - start
+          print(f"Backend {self.name} loaded in {self.load_seconds:.2f} s")
+        module = self._module
+    return module
+
+  @property
+  def loaded(self):
+    return self._module is not None
+
+  def __getattr__(self, attr):
+    # only called for the attributes the proxy does not have, i.e. those of the module
+    if attr.startswith('__') or attr in ('_module', '_lock'):
+      raise AttributeError(attr)
+    return getattr(self.load(), attr)
+
+  def __repr__(self):
+    return f"<Backend {self.name} ({self.module_name}, {'loaded' if self.loaded else 'not loaded'})>"
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+def register_backend(name, module_name):
+  """
+  Adds a backend to the registry, or points an existing one to another module if not yet loaded.
+
+  :param name: str, name the backend is requested with.
+  :param module_name: str, module to import.
+  """
+  with _registry_lock:
+    BACKENDS[name] = module_name
+    backend = _registry.get(name)
+    if backend is not None and not backend.loaded:
+      backend.module_name = module_name
+
+def get_backend(name):
+  """
+  :param name: str, a name of BACKENDS.
+  :return: Backend, the proxy of the framework, the same object for every call.
+  """
+  with _registry_lock:
+    backend = _registry.get(name)
+    if backend is None:
+      backend = _registry[name] = Backend(name, BACKENDS[name])
+    return backend
+
+def backend_stats():
+  """
+  :return: dictionary name -> {'module', 'loaded', 'load_seconds'} of the registered backends.
+  """
+  with _registry_lock:
+    names = list(BACKENDS)
+  stats = {}
+  for name in names:
+    backend = get_backend(name)
+    stats[name] = {'module': backend.module_name, 'loaded': backend.loaded, 'load_seconds': backend.load_seconds}
+  return stats
+
+def preload(names = None):
+  """
+  Imports backends in a background thread.
+
+  :param names: list of backend names, BACKENDS_PRELOAD if None.
+  :return: the started thread, None if there is nothing to load.
+  """
+  if names is None:
+    names = [n.strip() for n in BACKENDS_PRELOAD.split(',') if n.strip()]
+  if not names:
+    return None
+
+  def load_all():
+    for name in names:
+      try:
+        get_backend(name).load()
+      except Exception as e:
+        print(f"Could not preload backend {name}: {e}")
+  thread = threading.Thread(target=load_all, name="backends-preload", daemon=True)
+  thread.start()
+  return thread
+
+def is_torch_module(obj):
+  """
+  True if obj is a torch nn.Module. Does not import torch: if nobody imported it,
+  obj cannot be a torch object.
+  """
+  torch = sys.modules.get('torch')
+  return torch is not None and isinstance(obj, torch.nn.Module)
+
+def is_torch_tensor(obj):
+  """
+  True if obj is a torch Tensor, without importing torch (see is_torch_module).
+  """
+  torch = sys.modules.get('torch')
+  return torch is not None and isinstance(obj, torch.Tensor)
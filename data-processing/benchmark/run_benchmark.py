@@ -0,0 +1,261 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import threading
+import time
+import tracemalloc
+import numpy as np
+from datetime import datetime
+
+import f_dataprocessing
+from f_dataprocessing import characterize_KPI, make_prediction
+from forecast_cache import forecast_cache
+from model import ExplanationMode
+from XAI_forecasting import ForecastExplainer
+from benchmark.synthetic import SCENARIOS, generate_series, druid_rows
+from benchmark import stubs
+
+# Offline benchmark of the forecasting pipeline on synthetic series, run from data-processing/:
+#   python -m benchmark.run_benchmark --save-baseline
+#   python -m benchmark.run_benchmark --compare benchmark/baseline.json
+# For every scenario and model type it reports the training time, the forecast latency per
+# horizon and explanation mode (split in interval estimation and LIME), the peak memory
+# and the accuracy on the held-out last days of the series.
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+KPI = 'bench_avg'
+
+class PhaseTimer:
+  """
+  Accumulates the time spent in the interval estimation and in the LIME explanations of
+  ForecastExplainer, by wrapping its methods while the benchmark runs. LIME may run in
+  several threads at once (direct models), its time is then summed over the threads.
+  """
+
+  PHASES = {'predict_with_uncertainty': 'intervals', 'explain_prediction': 'lime'}
+
+  def __init__(self):
+    self.totals = {}
+    self._lock = threading.Lock()
+    self._original = {}
+
+  def _wrap(self, method, phase):
+    def timed(*args, **kwargs):
+      start = time.perf_counter()
+      try:
+        return method(*args, **kwargs)
+      finally:
+        with self._lock:
+          self.totals[phase] = self.totals.get(phase, 0.0) + time.perf_counter() - start
+    return timed
+
+  def reset(self):
+    with self._lock:
+      self.totals = {phase: 0.0 for phase in self.PHASES.values()}
+
+  def __enter__(self):
+    for name, phase in self.PHASES.items():
+      self._original[name] = getattr(ForecastExplainer, name)
+      setattr(ForecastExplainer, name, self._wrap(self._original[name], phase))
+    self.reset()
+    return self
+
+  def __exit__(self, *exc):
+    for name, method in self._original.items():
+      setattr(ForecastExplainer, name, method)
+
+@contextlib.contextmanager
+def quiet(enabled):
+  """Silences the prints of the forecasting code."""
+  if enabled:
+    with contextlib.redirect_stdout(io.StringIO()):
+      yield
+  else:
+    yield
+
+def traced(fn, *args, measure_memory = True):
+  """
+  Runs fn and measures it.
+
+  :return: (result of fn, elapsed seconds, peak traced memory in MB or None)
+  """
+  if measure_memory:
+    tracemalloc.start()
+  start = time.perf_counter()
+  try:
+    result = fn(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 2**20 if measure_memory else None
+  finally:
+    if measure_memory:
+      tracemalloc.stop()
+  return result, elapsed, peak
+
+def accuracy(result, actual):
+  """
+  :param result: forecast as returned by make_prediction.
+  :param actual: np.ndarray, the held-out values of the forecast days.
+  :return: dictionary with MAE, RMSE, sMAPE and the coverage of the prediction interval.
+  """
+  n = min(len(actual), len(result['Predicted_value']))
+  pred = np.asarray(result['Predicted_value'][:n])
+  lower = np.asarray(result['Lower_bound'][:n])
+  upper = np.asarray(result['Upper_bound'][:n])
+  actual = actual[:n]
+  error = pred - actual
+  denom = np.abs(pred) + np.abs(actual)
+  return {
+      'mae': float(np.mean(np.abs(error))),
+      'rmse': float(np.sqrt(np.mean(error ** 2))),
+      'smape': float(np.mean(np.where(denom > 0, 2 * np.abs(error) / np.where(denom > 0, denom, 1), 0.0))),
+      'coverage': float(np.mean((actual >= lower) & (actual <= upper)))
+  }
+
+def bench_series(scenario, model_type, args, timer, store):
+  """
+  Trains and benchmarks the model of one synthetic series.
+
+  :return: dictionary with the measures of the series.
+  """
+  machine = f"bench_{scenario}"
+  values = generate_series(args.days, seed=args.seed, **SCENARIOS[scenario])
+  actual = values[-args.holdout:]
+
+  record = {'scenario': scenario, 'model': model_type}
+  with quiet(args.quiet):
+    status, train_time, train_peak = traced(characterize_KPI, machine, KPI, model_type,
+                                            measure_memory=not args.no_memory)
+  record['train'] = {'status': status, 'seconds': train_time, 'peak_mb': train_peak,
+                     'model_bytes': store.size_bytes(KPI, machine)}
+  if status != 0:
+    return record
+
+  latency = {}
+  for mode in args.modes:
+    for horizon in args.horizons:
+      runs = []
+      for _ in range(args.repeats):
+        forecast_cache.invalidate(machine, KPI)
+        timer.reset()
+        with quiet(args.quiet):
+          start = time.perf_counter()
+          make_prediction(machine, KPI, horizon, ExplanationMode(mode))
+          elapsed = time.perf_counter() - start
+        runs.append({'seconds': elapsed, **timer.totals})
+      latency[f"{mode}/{horizon}"] = {key: statistics.median(r[key] for r in runs) for key in runs[0]}
+  record['latency'] = latency
+
+  # memory of the most expensive request, and accuracy of a plain forecast of the held-out days
+  forecast_cache.invalidate(machine, KPI)
+  with quiet(args.quiet):
+    _, _, predict_peak = traced(make_prediction, machine, KPI, max(args.horizons), ExplanationMode(args.modes[-1]),
+                                measure_memory=not args.no_memory)
+    forecast_cache.invalidate(machine, KPI)
+    result = make_prediction(machine, KPI, args.holdout, ExplanationMode.NONE)
+  record['predict_peak_mb'] = predict_peak
+  record['accuracy'] = accuracy(result, actual)
+  return record
+
+def flatten(record, prefix = ''):
+  """Flattens the nested numeric measures of a record in 'a.b.c' keys."""
+  out = {}
+  for key, value in record.items():
+    if isinstance(value, dict):
+      out.update(flatten(value, f"{prefix}{key}."))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+      out[f"{prefix}{key}"] = value
+  return out
+
+def compare(report, baseline, tolerance):
+  """
+  Prints the relative change of every measure against a baseline report.
+
+  :return: list of the measures worse than the baseline by more than tolerance (the interval
+    coverage is better when higher, the other measures when lower).
+  """
+  previous = {(r['scenario'], r['model']): flatten(r) for r in baseline['results']}
+  regressions = []
+  for record in report['results']:
+    key = (record['scenario'], record['model'])
+    if key not in previous:
+      continue
+    for name, value in flatten(record).items():
+      old = previous[key].get(name)
+      if old is None or old == 0 or name.startswith('train.status'):
+        continue
+      change = (value - old) / abs(old)
+      higher_is_better = name.endswith('coverage')
+      worse = -change if higher_is_better else change
+      flag = ''
+      if worse > tolerance:
+        flag = '  <-- regression'
+        regressions.append((key, name, old, value))
+      print(f"{key[0]:>10} {key[1]:>15} {name:<40} {old:>12.4f} -> {value:>12.4f} ({change:+.1%}){flag}")
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description="Offline benchmark of the data-processing forecasters")
+  parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+  parser.add_argument('--models', nargs='+', default=['xgboost', 'xgboost_direct', 'ARIMA', 'seasonal_naive', 'ses', 'theta', 'auto'])
+  parser.add_argument('--horizons', nargs='+', type=int, default=[1, 7, 30])
+  parser.add_argument('--modes', nargs='+', default=['none', 'first_step', 'full'],
+                      choices=[m.value for m in ExplanationMode if m != ExplanationMode.DEFERRED],
+                      help="explanation modes, the last one is used for the memory measure")
+  parser.add_argument('--days', type=int, default=365, help="length of the synthetic series")
+  parser.add_argument('--holdout', type=int, default=30, help="last days kept out of training to measure the accuracy")
+  parser.add_argument('--repeats', type=int, default=3, help="runs per latency measure, the median is reported")
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--no-memory', action='store_true', help="skip the tracemalloc measures, which slow the code down")
+  parser.add_argument('--quiet', action='store_true', help="silence the prints of the forecasting code")
+  parser.add_argument('--output', default=None, help="where to write the report (JSON)")
+  parser.add_argument('--save-baseline', action='store_true', help=f"write the report to {DEFAULT_BASELINE}")
+  parser.add_argument('--compare', default=None, help="baseline report to compare with")
+  parser.add_argument('--tolerance', type=float, default=0.2, help="relative change reported as a regression")
+  args = parser.parse_args()
+
+  druid = stubs.LocalDruid()
+  for scenario in args.scenarios:
+    values = generate_series(args.days, seed=args.seed, **SCENARIOS[scenario])
+    druid.add_rows(druid_rows(f"bench_{scenario}", f_dataprocessing.split_kpi_name(KPI)[0], values[:-args.holdout]))
+  store = stubs.LocalModelStore()
+  _, restore = stubs.install(druid, store, stubs.LocalKB(druid))
+
+  results = []
+  try:
+    with PhaseTimer() as timer:
+      for scenario in args.scenarios:
+        for model_type in args.models:
+          print(f"benchmarking {scenario} / {model_type}")
+          results.append(bench_series(scenario, model_type, args, timer, store))
+  finally:
+    restore()
+
+  report = {
+      'meta': {
+          'date': datetime.now().isoformat(),
+          'python': platform.python_version(),
+          'machine': platform.machine(),
+          'cpu_count': os.cpu_count(),
+          'args': {k: v for k, v in vars(args).items() if k not in ('output', 'save_baseline', 'compare')}
+      },
+      'results': results
+  }
+  for record in results:
+    print(json.dumps(record))
+
+  output = DEFAULT_BASELINE if args.save_baseline else args.output
+  if output:
+    with open(output, 'w') as f:
+      json.dump(report, f, indent=2)
+    print(f"report written to {output}")
+  if args.compare:
+    with open(args.compare) as f:
+      regressions = compare(report, json.load(f), args.tolerance)
+    print(f"{len(regressions)} measures regressed by more than {args.tolerance:.0%}")
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,131 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from backends import BACKENDS
+
+# Import-time profile and startup regression check of the service, run from data-processing/:
+#   python -m benchmark.startup                          <- profile of 'import main'
+#   python -m benchmark.startup --max-seconds 3 --check  <- exits with 1 on a regression
+# Every run imports the module in a fresh interpreter with -X importtime and reports the
+# total import time, the slowest top-level packages and the lazy backends that were loaded.
+# The forecasting frameworks of backends.BACKENDS must not be imported at startup.
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'modules': sorted(sys.modules)}}))
+"""
+
+def lazy_packages():
+  """:return: set of the top-level packages of the registered backends."""
+  return {module.split('.')[0] for module in BACKENDS.values()}
+
+def parse_importtime(stderr):
+  """
+  Parses the -X importtime output.
+
+  :return: dictionary top-level package -> import time in seconds of all its modules. The self
+    times are summed, so a package imported by another one is counted on its own and the
+    times of the packages add up to the whole import.
+  """
+  packages = {}
+  for line in stderr.splitlines():
+    if not line.startswith('import time:') or 'cumulative' in line:
+      continue
+    try:
+      self_time, _, name = line[len('import time:'):].split('|')
+    except ValueError:
+      continue
+    package = name.strip().split('.')[0]
+    packages[package] = packages.get(package, 0.0) + int(self_time) / 1e6
+  return packages
+
+def profile_once(module):
+  """
+  Imports module in a new interpreter.
+
+  :return: (seconds, list of loaded modules, dictionary package -> seconds)
+  """
+  proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', _PROBE.format(module=module)],
+                        cwd=SERVICE_DIR, capture_output=True, text=True)
+  if proc.returncode != 0:
+    raise RuntimeError(f"import of {module} failed:\n{proc.stderr[-2000:]}")
+  probe = json.loads(proc.stdout.strip().splitlines()[-1])
+  return probe['seconds'], probe['modules'], parse_importtime(proc.stderr)
+
+def profile(module, repeats):
+  """
+  :return: report with the median import time, the median time of the slowest packages and
+    the lazy backends loaded at import.
+  """
+  runs = [profile_once(module) for _ in range(repeats)]
+  packages = {}
+  for _, _, times in runs:
+    for name, seconds in times.items():
+      packages.setdefault(name, []).append(seconds)
+  lazy = lazy_packages()
+  loaded = sorted({m.split('.')[0] for m in runs[-1][1]} & lazy)
+  return {
+      'module': module,
+      'python': sys.version.split()[0],
+      'seconds': statistics.median(seconds for seconds, _, _ in runs),
+      'packages': dict(sorted(((name, statistics.median(t)) for name, t in packages.items()),
+                              key=lambda item: -item[1])),
+      'eager_backends': loaded
+  }
+
+def check(report, max_seconds = None, baseline = None, tolerance = 0.2):
+  """
+  :return: list of the regressions of the report, as messages
+  """
+  problems = []
+  if report['eager_backends']:
+    problems.append(f"backends imported at startup: {', '.join(report['eager_backends'])}")
+  if max_seconds is not None and report['seconds'] > max_seconds:
+    problems.append(f"import took {report['seconds']:.2f} s, more than {max_seconds:.2f} s")
+  if baseline is not None and report['seconds'] > baseline['seconds'] * (1 + tolerance):
+    problems.append(f"import took {report['seconds']:.2f} s, {report['seconds'] / baseline['seconds'] - 1:+.0%} over the baseline")
+  return problems
+
+def main():
+  parser = argparse.ArgumentParser(description="Import-time profile of the data-processing service")
+  parser.add_argument('--module', default='main', help="module to import, from data-processing/")
+  parser.add_argument('--repeats', type=int, default=3, help="fresh imports, the median is reported")
+  parser.add_argument('--top', type=int, default=15, help="slowest packages to print")
+  parser.add_argument('--max-seconds', type=float, default=None, help="startup time budget")
+  parser.add_argument('--compare', default=None, help="previous report to compare with")
+  parser.add_argument('--tolerance', type=float, default=0.2, help="relative slowdown reported as a regression")
+  parser.add_argument('--output', default=None, help="where to write the report (JSON)")
+  parser.add_argument('--check', action='store_true', help="exit with status 1 on a regression")
+  args = parser.parse_args()
+
+  report = profile(args.module, args.repeats)
+  print(f"import {report['module']}: {report['seconds']:.3f} s (median of {args.repeats})")
+  for name, seconds in list(report['packages'].items())[:args.top]:
+    marker = '  <-- lazy backend' if name in lazy_packages() else ''
+    print(f"  {name:<30} {seconds:>8.3f} s{marker}")
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+    print(f"report written to {args.output}")
+  baseline = None
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+  problems = check(report, args.max_seconds, baseline, args.tolerance)
+  for problem in problems:
+    print(f"REGRESSION: {problem}")
+  if args.check and problems:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,134 @@
+import json
+import re
+from datetime import datetime
+
+import f_dataprocessing
+
+# In-process stand-ins for Druid, MinIO/Postgres and the KB, so the forecasting code
+# can be benchmarked on synthetic data without the rest of the platform.
+
+_COLUMN = r'"?(\w+)"?'
+
+def _parse_list(text):
+  return [v.strip().strip("'").replace("''", "'") for v in text.split(',')]
+
+def _parse_time(text):
+  return datetime.strptime(text[:19].replace('T', ' '), "%Y-%m-%d %H:%M:%S")
+
+class LocalDruid:
+  """
+  Answers the Druid SQL queries of the data-processing service from rows kept in memory.
+
+  Only the query shapes used by the service are supported: column selection or SELECT *,
+  MAX(__time), filters on name and kpi (= or IN) and on __time (>=), ORDER BY __time and LIMIT.
+  """
+
+  def __init__(self, rows = None):
+    self.rows = list(rows or [])
+    self.queries = 0
+
+  def add_rows(self, rows):
+    self.rows.extend(rows)
+
+  def _filter(self, where):
+    rows = self.rows
+    for column in ('name', 'kpi'):
+      m = re.search(rf"\b{column}\s+IN\s*\(([^)]*)\)", where, re.IGNORECASE)
+      if m:
+        allowed = set(_parse_list(m.group(1)))
+        rows = [r for r in rows if r[column] in allowed]
+        continue
+      m = re.search(rf"\b{column}\s*=\s*'((?:[^']|'')*)'", where, re.IGNORECASE)
+      if m:
+        value = m.group(1).replace("''", "'")
+        rows = [r for r in rows if r[column] == value]
+    m = re.search(r"__time\s*>=\s*TIMESTAMP\s*'([^']*)'", where, re.IGNORECASE)
+    if m:
+      start = _parse_time(m.group(1))
+      rows = [r for r in rows if _parse_time(r['__time']) >= start]
+    return rows
+
+  def execute(self, body):
+    """
+    Same contract as f_dataprocessing.execute_druid_query.
+
+    :param body: dictionary with the SQL query under 'query'.
+    :return: list of result rows.
+    """
+    self.queries += 1
+    query = ' '.join(body['query'].split())
+    m = re.match(r"SELECT (.*?) FROM \"timeseries\"(.*)$", query, re.IGNORECASE)
+    if m is None:
+      raise ValueError(f"Unsupported query: {query}")
+    select, rest = m.group(1), m.group(2)
+    where = re.split(r"\bORDER BY\b|\bLIMIT\b", rest, flags=re.IGNORECASE)[0]
+    rows = self._filter(where)
+
+    m = re.match(r"MAX\(__time\)(?:\s+AS\s+(\w+))?", select, re.IGNORECASE)
+    if m:
+      alias = m.group(1) or 'EXPR$0'
+      return [{alias: max((r['__time'] for r in rows), default=None)}]
+
+    rows = sorted(rows, key=lambda r: r['__time'],
+                  reverse=re.search(r"ORDER BY __time DESC", rest, re.IGNORECASE) is not None)
+    m = re.search(r"LIMIT (\d+)", rest, re.IGNORECASE)
+    if m:
+      rows = rows[:int(m.group(1))]
+    if select.strip() == '*':
+      return [dict(r) for r in rows]
+    columns = [re.fullmatch(_COLUMN, c.strip()).group(1) for c in select.split(',')]
+    return [{c: r[c] for c in columns} for r in rows]
+
+class LocalModelStore:
+  """
+  In-memory replacement of the model registry, with the signatures of storage_operations.
+  Models are serialized to JSON as in MinIO, so their (de)serialization cost is kept.
+  """
+
+  def __init__(self):
+    self.objects = {}
+
+  def insert_model_to_storage(self, bucket_name, file_name, json_data, kpi, machine_name, trained_on = None, version = None):
+    self.objects[(kpi, machine_name)] = json.dumps(json_data)
+
+  def retrieve_model_from_storage(self, kpi, machine_name):
+    data = self.objects.get((kpi, machine_name))
+    return json.loads(data) if data is not None else None
+
+  def size_bytes(self, kpi, machine_name):
+    return len(self.objects.get((kpi, machine_name), ''))
+
+class LocalKB:
+  """
+  Replacement of the KB check of the KPIs: a KPI exists if Druid has rows for it.
+  """
+
+  def __init__(self, druid):
+    self.druid = druid
+
+  def kpi_exists(self, machine, KPI, api_key):
+    kpi_name, _ = f_dataprocessing.split_kpi_name(KPI)
+    return any(r['name'] == machine and r['kpi'] == kpi_name for r in self.druid.rows)
+
+def install(druid, store, kb):
+  """
+  Points f_dataprocessing to the local stand-ins. Alerts are collected instead of sent.
+
+  :return: (list collecting the alerts, callable restoring the original functions)
+  """
+  alerts = []
+  replaced = {
+      'execute_druid_query': druid.execute,
+      'insert_model_to_storage': store.insert_model_to_storage,
+      'retrieve_model_from_storage': store.retrieve_model_from_storage,
+      'kpi_exists': kb.kpi_exists,
+      'send_Alert': alerts.append,
+  }
+  original = {name: getattr(f_dataprocessing, name) for name in replaced}
+  for name, fn in replaced.items():
+    setattr(f_dataprocessing, name, fn)
+
+  def restore():
+    for name, fn in original.items():
+      setattr(f_dataprocessing, name, fn)
+  return alerts, restore
@@ -0,0 +1,70 @@
+import numpy as np
+from datetime import datetime, timedelta
+
+# Synthetic KPI series for the benchmark, with the shapes met in the factory data:
+# weekly seasonality, slow trends, noise, missing days and streaks of zeros.
+
+# name -> keyword arguments of generate_series
+SCENARIOS = {
+    'seasonal': {'trend': 0.0, 'season_amplitude': 20.0, 'noise': 2.0},
+    'trending': {'trend': 0.5, 'season_amplitude': 5.0, 'noise': 2.0},
+    'noisy': {'trend': 0.1, 'season_amplitude': 5.0, 'noise': 15.0},
+    'gappy': {'trend': 0.1, 'season_amplitude': 10.0, 'noise': 3.0, 'gap_rate': 0.05, 'zero_streaks': 3},
+}
+
+def generate_series(n_days = 365, level = 100.0, trend = 0.1, season_period = 7, season_amplitude = 10.0,
+                    noise = 2.0, gap_rate = 0.0, zero_streaks = 0, zero_streak_length = 4, seed = 0):
+  """
+  Generates a daily KPI series.
+
+  :param n_days: int, number of daily values.
+  :param level: float, starting level of the series.
+  :param trend: float, increment of the level per day.
+  :param season_period: int, period of the seasonal component in days.
+  :param season_amplitude: float, amplitude of the seasonal component.
+  :param noise: float, standard deviation of the gaussian noise.
+  :param gap_rate: float, fraction of the days without a value (nan).
+  :param zero_streaks: int, number of streaks of zeros, as a machine stopped for some days.
+  :param zero_streak_length: int, length of every streak of zeros.
+  :param seed: int, seed of the random generator.
+  :return: np.ndarray of n_days values, nan for the missing days.
+  """
+  rng = np.random.default_rng(seed)
+  t = np.arange(n_days)
+  values = (level + trend * t + season_amplitude * np.sin(2 * np.pi * t / season_period)
+            + rng.normal(0.0, noise, n_days))
+  values = np.maximum(values, 0.0)
+  # the last days are kept clean, the benchmark holds them out to measure the accuracy
+  editable = max(n_days - 60, 0)
+  for _ in range(zero_streaks):
+    if editable <= zero_streak_length:
+      break
+    start = rng.integers(0, editable - zero_streak_length)
+    values[start:start + zero_streak_length] = 0.0
+  if gap_rate > 0 and editable > 0:
+    gaps = rng.choice(editable, int(gap_rate * editable), replace=False)
+    values[gaps] = np.nan
+  return values
+
+def series_times(n_days, start = datetime(2024, 3, 1)):
+  """
+  :return: list of n_days daily timestamps, formatted as Druid returns them.
+  """
+  return [(start + timedelta(days=i)).strftime("%Y-%m-%dT%H:%M:%S.000Z") for i in range(n_days)]
+
+def druid_rows(machine, kpi_name, values, start = datetime(2024, 3, 1)):
+  """
+  Converts a series in the rows of the Druid "timeseries" datasource. The same value is used
+  for every aggregation column, nan becomes null.
+
+  :param machine: str, the machine name.
+  :param kpi_name: str, the KPI name without its aggregation suffix.
+  :param values: array-like, the daily values.
+  :return: list of dictionaries with the columns of "timeseries".
+  """
+  rows = []
+  for time, v in zip(series_times(len(values), start), values):
+    v = None if np.isnan(v) else float(v)
+    rows.append({'__time': time, 'name': machine, 'kpi': kpi_name,
+                 'sum': v, 'min': v, 'max': v, 'avg': v})
+  return rows
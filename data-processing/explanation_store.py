@@ -0,0 +1,65 @@
+import threading
+import uuid
+from collections import OrderedDict
+
+# Deferred explanations are kept in memory: they are only meant to be fetched
+# shortly after the forecast they belong to, so the oldest ones are dropped
+# once the store is full.
+MAX_STORED_EXPLANATIONS = 500
+
+class ExplanationStore:
+  """
+  Thread-safe, size-bounded store of the explanations computed in background
+  for the forecasts requested in ExplanationMode.DEFERRED.
+
+  Every entry is a dictionary with:
+  - status: 'pending', 'done' or 'failed'
+  - explanation: list of LIME explanations, one per forecast step
+  - error: description of the failure, if any
+  """
+
+  def __init__(self, max_size=MAX_STORED_EXPLANATIONS):
+    self.max_size = max_size
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def reserve(self):
+    """
+    Registers a new pending explanation.
+
+    :return: str, the prediction id to give back to the caller
+    """
+    prediction_id = uuid.uuid4().hex
+    with self._lock:
+      self._entries[prediction_id] = {'status': 'pending', 'explanation': [], 'error': ''}
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+    return prediction_id
+
+  def compute(self, prediction_id, explain_fn):
+    """
+    Runs explain_fn and stores its result under prediction_id. Meant to be run in background.
+
+    :param prediction_id: str, id returned by reserve
+    :param explain_fn: callable returning the list of explanations
+    """
+    try:
+      explanation = explain_fn()
+      entry = {'status': 'done', 'explanation': explanation, 'error': ''}
+    except Exception as e:
+      print(f"Error computing the explanation of prediction {prediction_id}: {e}")
+      entry = {'status': 'failed', 'explanation': [], 'error': str(e)}
+    with self._lock:
+      # the entry may have been evicted meanwhile, in that case nobody can ask for it anymore
+      if prediction_id in self._entries:
+        self._entries[prediction_id] = entry
+
+  def get(self, prediction_id):
+    """
+    :param prediction_id: str, id returned by reserve
+    :return: the stored entry or None if the id is unknown
+    """
+    with self._lock:
+      return self._entries.get(prediction_id)
+
+explanation_store = ExplanationStore()
@@ -1,35 +1,40 @@
 
 import pandas as pd
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
-from statsmodels.tsa.stattools import adfuller
 import itertools
-from tqdm import notebook
-from statsmodels.tsa.statespace.sarimax import SARIMAX
-import xgboost as xgb
-from xgboost import XGBRegressor
-from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import GridSearchCV
-from sklearn.model_selection import ParameterGrid
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import mean_squared_error, mean_absolute_error
-from model import Severity, Alert
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from backends import get_backend
+from model import Severity, Alert, ExplanationMode
 from math import isnan
 
 import json
 import os
 import base64
-
-import matplotlib.pyplot as plt
-import matplotlib.ticker as mticker
-import matplotlib.dates as mdates
+import threading
+from functools import partial
 
 import requests
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date
 
 from XAI_forecasting import ForecastExplainer
-from storage.storage_operations import insert_model_to_storage, retrieve_model_from_storage
-
+from storage.storage_operations import insert_model_to_storage, retrieve_model_from_storage, get_forecast_values
+from forecast_cache import forecast_cache
+from alert_outbox import alert_outbox
+from streaming_stats import StreamingStats
+from predictor import get_predictor
+import retraining
+import statistical_forecasters
+from statistical_forecasters import STATISTICAL_MODELS
+
+# frameworks imported on their first use, see backends
+xgb = get_backend('xgboost')
+arima = get_backend('arima')
+stattools = get_backend('stattools')
+preprocessing = get_backend('preprocessing')
+model_selection = get_backend('model_selection')
+metrics = get_backend('metrics')
 
 ####################################
 #####==========================#####
@@ -43,6 +48,35 @@ from storage.storage_operations import insert_model_to_storage, retrieve_model_f
 # historical data
 
 observation_window = 15
+direct_horizon = 30 # number of steps predicted at once by the 'xgboost_direct' models
+GLOBAL_MACHINE = '__global__' # machine name under which the global cross-series models are stored
+outlier_window = 30 # number of recent values a new data point is compared with
+TRAINING_WORKERS = int(os.getenv('TRAINING_WORKERS', 2)) # models trained concurrently by characterize_many
+# incremental updates of the boosters after a drift (see update_KPI)
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'continue') # 'continue' boosting the stored booster or 'refit' it with its hyperparameters
+UPDATE_ROUNDS = int(os.getenv('UPDATE_ROUNDS', 20)) # trees added by a 'continue' update
+UPDATE_WINDOWS = int(os.getenv('UPDATE_WINDOWS', 90)) # newest windows a 'continue' update is trained on
+UPDATE_HOLDOUT = int(os.getenv('UPDATE_HOLDOUT', 14)) # newest points the updated model is checked on
+UPDATE_TOLERANCE = float(os.getenv('UPDATE_TOLERANCE', 0.1)) # holdout RMSE allowed over the one of the stored booster
+FULL_SEARCH_DAYS = int(os.getenv('FULL_SEARCH_DAYS', 30)) # age of the last grid search after which a drift triggers a new one
+EXPLAINER_BACKGROUND = int(os.getenv('EXPLAINER_BACKGROUND', 200)) # training windows stored with a model for LIME
+FORECAST_TABLE_HORIZON = int(os.getenv('FORECAST_TABLE_HORIZON', 30)) # steps materialized in the Forecasts table, 0 disables it
+# hyperparameters searched for the boosters (see xgboost_parameter_select)
+XGB_PARAM_GRID = {
+    "n_estimators": [50, 100, 200, 300, 400],
+    "max_depth": [3, 5, 7],
+    "learning_rate": [0.01, 0.1, 0.2],
+}
+# a direct model grows one tree per forecast step at every round: its search is much smaller and its
+# rounds are bounded, which bounds both the training time and the size of the stored model
+DIRECT_MAX_ROUNDS = int(os.getenv('DIRECT_MAX_ROUNDS', 100))
+DIRECT_PARAM_GRID = {
+    "n_estimators": [DIRECT_MAX_ROUNDS],
+    "max_depth": [3, 5],
+    "learning_rate": [0.1, 0.2],
+}
+# fixed parameters of the reference booster the statistical models are compared with by the 'auto' selection
+AUTO_XGB_PARAMS = {'objective': 'reg:squarederror', 'max_depth': 3, 'eta': 0.1, 'num_boost_round': 100}
 
 def execute_druid_query(body):
     """
@@ -64,13 +98,12 @@ def execute_druid_query(body):
         print(f"An error occurred: {e}")
         return None
 
-def data_load(machine,kpi):
+def split_kpi_name(kpi):
   """
-  Loads time-series data for a specific machine and KPI.
+  Splits a KPI id in the name stored in Druid and its aggregation column.
 
-  :param machine: The machine ID to filter data.
-  :param kpi: The KPI name to filter data.
-  :return: Tuple of time and average values as lists.
+  :param kpi: The KPI id, e.g. 'consumption_avg'.
+  :return: Tuple of KPI name and aggregation ('sum', 'min', 'max' or 'avg'), empty strings if there is none.
   """
   # Controlla gli ultimi tre caratteri
   # Tipi di aggregazione validi
@@ -85,6 +118,35 @@ def data_load(machine,kpi):
       # Dividi il nome del KPI
       kpi_name = kpi[:split_index]  # Parte prima dell'underscore
       data_type = kpi[split_index + 1:]  # Parte dopo l'underscore
+  return kpi_name, data_type
+
+def data_load_latest(machine, kpi):
+  """
+  Loads only the most recent data point of a machine and KPI.
+
+  :param machine: The machine ID to filter data.
+  :param kpi: The KPI name to filter data.
+  :return: Tuple of time and value of the last data point, (None, None) if there is none.
+  """
+  kpi_name, data_type = split_kpi_name(kpi)
+  query_body = {
+        "query": f"SELECT __time, \"{data_type}\" FROM \"timeseries\" where name = '{machine}' AND kpi = '{kpi_name}' "
+                 f"ORDER BY __time DESC LIMIT 1"
+  }
+  response = execute_druid_query(query_body)
+  if not response:
+    return None, None
+  return response[0]['__time'], response[0][data_type]
+
+def data_load(machine,kpi):
+  """
+  Loads time-series data for a specific machine and KPI.
+
+  :param machine: The machine ID to filter data.
+  :param kpi: The KPI name to filter data.
+  :return: Tuple of time and average values as lists.
+  """
+  kpi_name, data_type = split_kpi_name(kpi)
   query_body = {
         "query": f"SELECT * FROM \"timeseries\" where name = '{machine}' AND kpi = '{kpi_name}'"
   } # Execute the query
@@ -96,6 +158,50 @@ def data_load(machine,kpi):
     avg_t.append(r['__time'])
   return avg_t,avg_r
 
+def sql_list(values):
+  """Formats a list of strings as a SQL list literal."""
+  return ", ".join("'" + str(v).replace("'", "''") + "'" for v in values)
+
+def data_load_bulk(series, machines_per_query = 50):
+  """
+  Loads many time-series with a few queries instead of one query per series.
+
+  The requested machines are split in groups of machines_per_query, every group is loaded
+  with one query on all the requested KPIs and the rows are split per series with a groupby.
+
+  :param series: list of (machine, kpi) tuples.
+  :param machines_per_query: int, number of machines covered by a single query.
+  :return: dictionary (machine, kpi) -> (list of times, np.ndarray of values), as data_load
+    but with nan for the null values. Series without data have empty lists.
+  """
+  series = list(dict.fromkeys(series))
+  columns = {kpi: split_kpi_name(kpi) for _, kpi in series}
+  kpi_names = sorted({kpi_name for kpi_name, _ in columns.values()})
+  machines = sorted({machine for machine, _ in series})
+
+  groups = {}
+  for start in range(0, len(machines), machines_per_query):
+    chunk = machines[start:start + machines_per_query]
+    response = execute_druid_query({
+        "query": f"SELECT __time, name, kpi, \"sum\", \"min\", \"max\", \"avg\" FROM \"timeseries\" "
+                 f"WHERE name IN ({sql_list(chunk)}) AND kpi IN ({sql_list(kpi_names)})"
+    })
+    if not response:
+      continue
+    frame = pd.DataFrame(response).sort_values('__time', kind='stable')
+    for key, rows in frame.groupby(['name', 'kpi'], sort=False):
+      groups[key] = rows
+
+  loaded = {}
+  for machine, kpi in series:
+    kpi_name, data_type = columns[kpi]
+    rows = groups.get((machine, kpi_name))
+    if rows is None:
+      loaded[(machine, kpi)] = ([], np.array([], dtype=float))
+    else:
+      loaded[(machine, kpi)] = (rows['__time'].tolist(), pd.to_numeric(rows[data_type], errors='coerce').to_numpy(dtype=float))
+  return loaded
+
 def data_extract_trends(ts):
   """
   trend extraction from any time series
@@ -119,7 +225,7 @@ def perform_adfuller(series):
     :return: the test statistic and p-value
     """
     try:
-      result = adfuller(series, regression='ct')
+      result = stattools.adfuller(series, regression='ct')
       return 0,result[0], result[1]  # Returns test statistic and p-value
     except ValueError as e:
       if "x is constant" in str(e):
@@ -151,7 +257,7 @@ def data_normalize_params(data):
   :param data: the time series to be normalized
   :return: the normalized time series
   """
-  scaler = StandardScaler()
+  scaler = preprocessing.StandardScaler()
   array_value = data.values.reshape(-1,1)
   array_scaled = scaler.fit_transform(array_value)
   normalized_data = pd.Series(array_scaled.flatten(),index=data.index,name='Timestamp')
@@ -200,6 +306,8 @@ def create_model_data():
       'q': 0,
       'xgb_bytes': ''
   }
+  a_dict['intervals'] = {} # prediction intervals fitted at training time (see fit_conformal_intervals)
+  a_dict['explainer'] = {} # statistics of the training windows used by the explainer (see explainer_statistics)
   return a_dict
 
 
@@ -212,9 +320,13 @@ def save_model_data(machine, kpi, n_dict):
   :param n_dict: Dictionary containing the model's metadata.
   :return: None
   """
-  file_name = f'{machine}_{kpi}.json'
+  metadata = n_dict.get('model', {}).get('metadata', {})
+  version = metadata.get('version')
+  # every trained version is kept in its own object, the registry points to the active one
+  file_name = f'{machine}_{kpi}/{version}.json' if version else f'{machine}_{kpi}.json'
 
-  insert_model_to_storage("models", file_name, n_dict, kpi, machine)
+  insert_model_to_storage("models", file_name, n_dict, kpi, machine,
+                          metadata.get('trained_on'), version)
 
   # final_path = os.path.join(models_path, f'{machine}_{kpi}.json')
   # with open(final_path, 'w') as outfile:
@@ -242,9 +354,59 @@ def load_model(machine, kpi): #handle loading with a query
   #     dct = json.load(file)
   #   return dct
 
+# keys of the model metadata produced by training, the other ones hold the monitoring state
+TRAINED_KEYS = ['trends', 'stationarity', 'model', 'intervals', 'streaming', 'explainer']
+_model_locks = {}
+_model_locks_guard = threading.Lock()
+
+def model_lock(machine, kpi):
+  """
+  Lock serializing the read-modify-write cycles of the metadata of one model, between the
+  monitoring and the background retraining.
+
+  :param machine: The machine ID.
+  :param kpi: The KPI name.
+  :return: threading.Lock of the model
+  """
+  with _model_locks_guard:
+    return _model_locks.setdefault((machine, kpi), threading.Lock())
+
+def save_trained_model(machine, kpi, a_dict):
+  """
+  Switches a series to a freshly trained model in one step: the trained parts of a_dict
+  replace the ones of the stored metadata, the monitoring state saved meanwhile is kept.
+
+  :param machine: The machine ID.
+  :param kpi: The KPI name.
+  :param a_dict: Dictionary containing the trained model's metadata.
+  """
+  with model_lock(machine, kpi):
+    current = load_model(machine, kpi)
+    for key in TRAINED_KEYS:
+      if key in a_dict:
+        current[key] = a_dict[key]
+    save_model_data(machine, kpi, current)
+
+def load_forecast_model(machine, kpi):
+  """
+  Loads the model used to forecast a series: its own model if it has one, otherwise
+  the global model of the KPI if the machine was part of its training.
+
+  :param machine: The machine ID.
+  :param kpi: The KPI name.
+  :return: Dictionary containing the model's metadata, None if no model can forecast the series.
+  """
+  dct = retrieve_model_from_storage(kpi,machine)
+  if dct != None:
+    return dct
+  dct = retrieve_model_from_storage(kpi,GLOBAL_MACHINE)
+  if dct != None and machine in dct['model'].get('machines', []):
+    return dct
+  return None
+
 def check_model_exists(machine, kpi):
   """
-    Confirms the existence of a model
+    Confirms the existence of a model, either the series' own or a global one covering it
 
     :param machine: the machine id
     :param kpi: the kpi name
@@ -252,7 +414,7 @@ def check_model_exists(machine, kpi):
     :returns bool: True or false if the machine exists or not
 
   """
-  dct = retrieve_model_from_storage(kpi,machine)
+  dct = load_forecast_model(machine, kpi)
   if dct == None:
      return False
   else:
@@ -261,46 +423,84 @@ def check_model_exists(machine, kpi):
 
    
 
-def optimize_ARIMA(endog, order_list, d):
+def fit_ARIMA_order(endog, order, d):
+  """
+  Fits one ARIMA(p, d, q) model. Module-level so that it can run in a process pool.
+
+  :param endog: The dependent variable (time series)
+  :param order: the (p, q) combination to fit
+  :param d: Degree of differencing for ARIMA
+  :return: the (p, q) order, its AIC (inf if the fit failed) and the fitted parameters
+  """
+  try:
+    res = arima.SARIMAX(endog, order=(order[0], d, order[1]), simple_differencing=False).fit(disp=False)
+    return order, res.aic, res.params.tolist()
+  except Exception:
+    return order, float('inf'), None
+
+def optimize_ARIMA(endog, order_list, d, stepwise = True, max_workers = None):
   """
   Select the best ARIMA parameters based on the AIC score.
 
+  Candidate orders are fitted in parallel in a process pool. With the stepwise strategy
+  (Hyndman-Khandakar) only a few starting orders are fitted, then the neighbours of the best
+  order found so far (p and/or q changed by one) until the AIC stops improving, instead of
+  the whole grid.
+
   :param endog: The dependent variable (time series)
-  :param order_list: List of ARIMA (p, q) combinations to try
+  :param order_list: List of ARIMA (p, q) combinations allowed
   :param d: Degree of differencing for ARIMA
-  :return: DataFrame containing the best parameter combinations and AIC scores
+  :param stepwise: bool, use the stepwise search instead of fitting every order
+  :param max_workers: int, size of the process pool (defaults to the number of CPUs)
+  :return: DataFrame containing the fitted parameter combinations, AIC scores and fitted parameters, best first
   """
-  results = []
-  for order in tqdm_notebook(order_list):
-      try:
-          model = SARIMAX(endog, order=(order[0], d, order[1]), simple_differencing=False).fit(disp=False)
-          aic = model.aic
-          results.append([order, aic])
-      except:
-          continue
+  allowed = set(tuple(order) for order in order_list)
+  fitted = {}
+
+  with ProcessPoolExecutor(max_workers=max_workers) as pool:
+    def fit_all(orders):
+      orders = [o for o in orders if o in allowed and o not in fitted]
+      for order, aic, params in pool.map(fit_ARIMA_order, [endog] * len(orders), orders, [d] * len(orders)):
+        fitted[order] = (aic, params)
 
-  optimize_ARIMA_results = pd.DataFrame(results, columns=['(p,q)', 'AIC'])
+    if not stepwise:
+      fit_all(list(allowed))
+    else:
+      fit_all([(2, 2), (0, 0), (1, 0), (0, 1)])
+      if len(fitted) == 0:
+        # none of the usual starting points is allowed, start from the smallest order
+        fit_all([min(allowed)])
+      best = min(fitted, key=lambda o: fitted[o][0])
+      while True:
+        p, q = best
+        fit_all([(p + dp, q + dq) for dp in (-1, 0, 1) for dq in (-1, 0, 1)])
+        new_best = min(fitted, key=lambda o: fitted[o][0])
+        if new_best == best:
+          break
+        best = new_best
+
+  results = [[order, aic, params] for order, (aic, params) in fitted.items() if params is not None]
+  optimize_ARIMA_results = pd.DataFrame(results, columns=['(p,q)', 'AIC', 'params'])
   optimize_ARIMA_results = optimize_ARIMA_results.sort_values(by='AIC', ascending=True).reset_index(drop=True)
   return optimize_ARIMA_results
 
-def xgboost_parameter_select(X_train,y_train):
+def xgboost_parameter_select(X_train,y_train, param_grid = None):
   """
   Perform hyperparameter tuning for XGBoost.
 
   :param X_train: Training features
   :param y_train: Training labels
-  :return: The best XGBoost model
+  :param param_grid: grid of 'n_estimators', 'max_depth' and 'learning_rate' to search, XGB_PARAM_GRID if None
+  :return: The best XGBoost model, the parameters it was trained with
+    (the xgb.train params plus 'num_boost_round') and its cross-validation RMSE
   """
   # Define the XGBoost regressor
-  xgb_model = XGBRegressor(objective="reg:squarederror", random_state=42)
+  xgb_model = xgb.XGBRegressor(objective="reg:squarederror", random_state=42)
 
   # Define a small parameter grid
-  param_grid = {
-      "n_estimators": [50, 100, 200, 300, 400],
-      "max_depth": [3, 5, 7],
-      "learning_rate": [0.01, 0.1, 0.2],
-  }
-  param_combinations = list(ParameterGrid(param_grid))
+  if param_grid is None:
+    param_grid = XGB_PARAM_GRID
+  param_combinations = list(model_selection.ParameterGrid(param_grid))
   # ParameterGrid
   # Set up GridSearchCV
   # grid_search = GridSearchCV(estimator=xgb_model, param_grid=param_grid, cv=3, scoring="neg_mean_squared_error", verbose=1)
@@ -345,7 +545,7 @@ def xgboost_parameter_select(X_train,y_train):
       # Update best parameters if score improves
       if mean_rmse < best_score:
           best_score = mean_rmse
-          best_params = params
+          best_params = dict(xgb_params, num_boost_round=int(best_iteration + 1))
           best_model = xgb.train(
             params=xgb_params,
             dtrain=dtrain,
@@ -358,7 +558,69 @@ def xgboost_parameter_select(X_train,y_train):
 
 
 
-  return best_model
+  return best_model, best_params, float(best_score)
+
+def fit_conformal_intervals(data, window_size, xgb_params, horizon = 30, confidence = 0.95, calibration_fraction = 0.2, min_samples = 10,
+                            direct = False):
+  """
+  Fits split-conformal prediction intervals for the recursive or direct XGBoost forecast.
+
+  A booster with the selected hyperparameters is trained on the first part of the series,
+  then every point of the held-out part is used as the start of a forecast (a recursive
+  rollout, or a single multi-output prediction when direct is True).
+  The absolute forecast errors give, for each forecast step, the quantile to add and
+  subtract to the point forecast at serving time.
+
+  :param data: np.ndarray, the cleaned time series
+  :param window_size: int, length of the input window of the model
+  :param xgb_params: dict, xgb.train params plus 'num_boost_round' (see xgboost_parameter_select)
+  :param horizon: int, maximum number of forecast steps to calibrate
+  :param confidence: float, target coverage of the intervals
+  :param calibration_fraction: float, fraction of the series held out for calibration
+  :param min_samples: int, minimum number of residuals needed to calibrate a step
+  :param direct: bool, calibrate a direct multi-horizon model predicting horizon steps at once
+  :return: dictionary with the interval method, its confidence and one quantile per calibrated step,
+    None if the series is too short to calibrate
+  """
+  data = np.asarray(data, dtype=float)
+  split = int(len(data) * (1 - calibration_fraction))
+  if split - window_size - 1 < min_samples or len(data) - split < min_samples:
+    return None
+
+  params = dict(xgb_params)
+  num_boost_round = params.pop('num_boost_round')
+  if direct:
+    X_cal, y_cal = custom_tts_direct(data[:split], window_size, horizon)
+  else:
+    X_cal, y_cal = custom_tts(data[:split], None, window_size)
+  booster = xgb.train(params=params, dtrain=xgb.DMatrix(X_cal, label=y_cal), num_boost_round=num_boost_round)
+
+  # all the rollouts move forward together, one batched prediction per step
+  starts = np.arange(max(split, window_size), len(data))
+  windows = sliding_window_view(data, window_size)[starts - window_size]
+  if direct:
+    direct_preds = booster.predict(xgb.DMatrix(windows)).reshape(len(starts), -1)
+  quantiles = []
+  for h in range(horizon):
+    valid = starts + h < len(data)
+    if valid.sum() < min_samples:
+      break
+    preds = direct_preds[:, h] if direct else booster.predict(xgb.DMatrix(windows))
+    residuals = np.abs(data[starts[valid] + h] - preds[valid])
+    n = len(residuals)
+    # finite-sample correction of split conformal prediction
+    level = min(1.0, np.ceil((n + 1) * confidence) / n)
+    quantiles.append(float(np.quantile(residuals, level)))
+    if not direct:
+      windows = np.column_stack([windows[:, 1:], preds])
+
+  if len(quantiles) == 0:
+    return None
+  return {
+      'method': 'conformal',
+      'confidence': confidence,
+      'quantiles': quantiles
+  }
 
 
 def custom_tts(data, labels, window_size = 20):
@@ -370,15 +632,13 @@ def custom_tts(data, labels, window_size = 20):
   :param window_size: Size of the window for time-series input
   :return: Train-test splits for features and labels
   """
-  X_train = []
-  y_train = []
-  total_points = len(data)
-  for i in range(total_points - window_size - 1):
-      X_train.append(data[i:i+window_size])
-      y_train.append(data[i+window_size])
-
-  X_train = np.array(X_train)
-  y_train = np.array(y_train)
+  # the windows are a read-only view on the series, nothing is copied
+  data = np.asarray(data, dtype=float)
+  n_windows = max(len(data) - window_size - 1, 0)
+  if n_windows == 0:
+    return np.empty((0, window_size)), np.empty(0)
+  X_train = sliding_window_view(data, window_size)[:n_windows]
+  y_train = data[window_size:window_size + n_windows]
 
   # # Train XGBoost model
   # model.fit(X_train, y_train)
@@ -394,32 +654,298 @@ def custom_tts(data, labels, window_size = 20):
   # X_train, X_test, y_train, y_test = train_test_split(X,y, test_size=0.15, random_state=42) #decide what to do
   return X_train, y_train
 
+def custom_tts_direct(data, window_size = 20, horizon = 30):
+  """
+  Create the training set of a direct multi-horizon model: every window is paired
+  with the horizon values that follow it.
+
+  :param data: The time-series values
+  :param window_size: Size of the window for time-series input
+  :param horizon: Number of future values predicted from each window
+  :return: features of shape (n, window_size) and labels of shape (n, horizon)
+  """
+  data = np.asarray(data, dtype=float)
+  n_windows = len(data) - window_size - horizon + 1
+  if n_windows <= 0:
+    return np.empty((0, window_size)), np.empty((0, horizon))
+  X_train = sliding_window_view(data[:window_size + n_windows - 1], window_size)
+  y_train = sliding_window_view(data[window_size:], horizon)
+  return X_train, y_train
+
+def explainer_statistics(data, window_size, background_size = EXPLAINER_BACKGROUND):
+  """
+  Computes at training time what ForecastExplainer needs from the training windows, so that
+  serving does not window the whole history again: the standard deviation of the windows
+  (bootstrap intervals) and an evenly spaced sample of the windows, the most recent one included,
+  used as LIME background. The residual quantiles are the conformal intervals, stored under 'intervals'.
+
+  :param data: np.ndarray, the cleaned series
+  :param window_size: int, length of the input window of the model
+  :param background_size: int, maximum number of windows in the background sample
+  :return: dictionary with 'training_std' and 'background', empty if the series is too short
+  """
+  X_train, _ = custom_tts(data, None, window_size)
+  if len(X_train) == 0:
+    return {}
+  sample = np.unique(np.linspace(0, len(X_train) - 1, min(background_size, len(X_train))).astype(int))
+  stats = {
+      'training_std': float(np.std(X_train)),
+      'background': X_train[sample].tolist()
+  }
+  return stats
+
+class GlobalSeriesModel:
+  """
+  Adapter exposing a global cross-series booster as the model of a single series.
+
+  Input windows are normalized with the series' mean and standard deviation and tagged
+  with the machine code used at training time, predictions are brought back to the
+  series' scale. The adapter can be used wherever a model with a predict method is expected.
+  """
+
+  def __init__(self, predictor, machine_code, mean, std):
+    """
+    :param predictor: BoosterPredictor of the global model
+    :param machine_code: int, index of the machine in the model's machine list
+    :param mean: float, mean of the series at training time
+    :param std: float, standard deviation of the series at training time
+    """
+    self.predictor = predictor
+    self.machine_code = machine_code
+    self.mean = mean
+    self.std = std
+
+  def predict(self, X):
+    X = np.asarray(X, dtype=float)
+    X = X.reshape(-1, X.shape[-1])
+    features = global_features((X - self.mean) / self.std, np.full(len(X), self.machine_code))
+    return self.predictor.predict(features) * self.std + self.mean
+
+def global_features(windows, machine_codes):
+  """
+  Builds the input matrix of a global model: the normalized windows followed by the machine code.
+
+  :param windows: np.ndarray of shape (n, window_size), normalized input windows
+  :param machine_codes: np.ndarray of shape (n,), machine code of every window
+  :return: np.ndarray of shape (n, window_size + 1)
+  """
+  return np.column_stack([windows, machine_codes])
+
+def fit_global_conformal_intervals(series_list, window_size, xgb_params, horizon = 30, confidence = 0.95, calibration_fraction = 0.2, min_samples = 10):
+  """
+  Fits split-conformal prediction intervals for a global cross-series model.
+
+  Same procedure as fit_conformal_intervals, applied to all the normalized series at once:
+  the calibration booster is trained on the first part of every series and the rollouts of
+  all the held-out parts move forward together. The quantiles are in normalized units and
+  must be multiplied by the standard deviation of a series to be used on it.
+
+  :param series_list: list of np.ndarray, the normalized series, in machine code order
+  :param window_size: int, length of the input window of the model
+  :param xgb_params: dict, xgb.train params plus 'num_boost_round' (see xgboost_parameter_select)
+  :return: dictionary with the interval method, its confidence and one quantile per calibrated step,
+    None if the series are too short to calibrate
+  """
+  params = dict(xgb_params)
+  num_boost_round = params.pop('num_boost_round')
+  X_parts, y_parts = [], []
+  windows, codes, targets, starts = [], [], [], []
+  for code, series in enumerate(series_list):
+    split = int(len(series) * (1 - calibration_fraction))
+    if split - window_size - 1 <= 0:
+      continue
+    X_cal, y_cal = custom_tts(series[:split], None, window_size)
+    X_parts.append(global_features(X_cal, np.full(len(X_cal), code)))
+    y_parts.append(y_cal)
+    for t in range(max(split, window_size), len(series)):
+      windows.append(series[t - window_size:t])
+      codes.append(code)
+      targets.append(series[t:])
+      starts.append(t)
+  if len(X_parts) == 0 or len(windows) < min_samples:
+    return None
+
+  booster = xgb.train(params=params, dtrain=xgb.DMatrix(np.vstack(X_parts), label=np.concatenate(y_parts)),
+                      num_boost_round=num_boost_round)
+  windows = np.array(windows)
+  codes = np.array(codes)
+  remaining = np.array([len(t) for t in targets])
+  quantiles = []
+  for h in range(horizon):
+    valid = remaining > h
+    if valid.sum() < min_samples:
+      break
+    preds = booster.predict(xgb.DMatrix(global_features(windows, codes)))
+    actual = np.array([targets[i][h] for i in np.flatnonzero(valid)])
+    residuals = np.abs(actual - preds[valid])
+    n = len(residuals)
+    level = min(1.0, np.ceil((n + 1) * confidence) / n)
+    quantiles.append(float(np.quantile(residuals, level)))
+    windows = np.column_stack([windows[:, 1:], preds])
+
+  if len(quantiles) == 0:
+    return None
+  return {
+      'method': 'conformal',
+      'confidence': confidence,
+      'quantiles': quantiles
+  }
+
+def load_series(machine, kpi, series = None):
+  """
+  Loads a series and fills its missing values.
+
+  :param machine: The machine ID
+  :param kpi: The KPI name
+  :param series: tuple of times and values already loaded (see data_load_bulk), loaded from Druid if None
+  :return: the list of timestamps and the np.ndarray of cleaned values
+  """
+  kpi_data_Time, kpi_data_Avg = series if series is not None else data_load(machine, kpi)
+  timeseries = pd.DataFrame({'Timestamp':pd.to_datetime(kpi_data_Time), 'Value': kpi_data_Avg})
+  timeseries.set_index('Timestamp', inplace=True)
+  data = data_clean_missing_values(timeseries)
+  return kpi_data_Time, data['Value'].values.astype(float)
+
+def characterize_global_KPI(kpi, machines, series = None):
+  """
+  Trains one global XGBoost model for a KPI over the stacked windows of all the given machines.
+
+  Every series is normalized with its own mean and standard deviation and its windows are
+  tagged with a machine code, so a single model (one grid search, one stored object) serves
+  the whole fleet. Constant or too short series are left out.
+
+  :param kpi: The KPI name
+  :param machines: list of machine IDs
+  :param series: dictionary (machine, kpi) -> (times, values) already loaded (see data_load_bulk),
+    loaded from Druid with one bulk query if None
+  :return: 0 on success, -1 if no series could be used
+  """
+  if series is None:
+    series = data_load_bulk([(machine, kpi) for machine in machines])
+  usable = {}
+  for machine in machines:
+    _, values = load_series(machine, kpi, series.get((machine, kpi)))
+    if len(values) <= observation_window + 1 or np.std(values) == 0:
+      print(f"Skipping {machine} for the global model of {kpi}: series too short or constant")
+      continue
+    usable[machine] = values
+  if len(usable) == 0:
+    return -1
+
+  machine_list = sorted(usable)
+  scaling = {m: [float(np.mean(usable[m])), float(np.std(usable[m]))] for m in machine_list}
+  normalized = [(usable[m] - scaling[m][0]) / scaling[m][1] for m in machine_list]
+
+  X_parts, y_parts = [], []
+  for code, values in enumerate(normalized):
+    X, y = custom_tts(values, None, observation_window)
+    X_parts.append(global_features(X, np.full(len(X), code)))
+    y_parts.append(y)
+  booster, best_params, _ = xgboost_parameter_select(np.vstack(X_parts), np.concatenate(y_parts))
+
+  a_dict = create_model_data()
+  a_dict['model'] = {
+    'name': 'xgboost_global',
+    'xgb_bytes': base64.b64encode(booster.save_raw()).decode('utf-8'),
+    'machines': machine_list,
+    'scaling': scaling,
+    'metadata': {
+        'trained_on': str(datetime.today().date()),
+        'version': datetime.now().isoformat(),
+        'hyperparameters': best_params},
+  }
+  a_dict['intervals'] = fit_global_conformal_intervals(normalized, observation_window, best_params) or {}
+  save_model_data(GLOBAL_MACHINE, kpi, a_dict)
+  return 0
+
+def xgboost_backtest(values, horizon = statistical_forecasters.BACKTEST_HORIZON):
+  """
+  Backtests a recursive XGBoost model with the fixed AUTO_XGB_PARAMS (no grid search) on the
+  last horizon points of a series, as statistical_forecasters.backtest does for its models.
+
+  :param values: np.ndarray, the cleaned series
+  :return: the mean absolute error of the backtest, None if the series is too short
+  """
+  train = values[:-horizon]
+  if len(train) - observation_window - 1 < 2 * observation_window:
+    return None
+  X_train, y_train = custom_tts(train, None, observation_window)
+  params = dict(AUTO_XGB_PARAMS)
+  num_boost_round = params.pop('num_boost_round')
+  booster = xgb.train(params=params, dtrain=xgb.DMatrix(X_train, label=y_train), num_boost_round=num_boost_round)
+  window = np.array(train[-observation_window:], dtype=np.float32)
+  preds = np.empty(horizon)
+  for h in range(horizon):
+    preds[h] = booster.inplace_predict(window[None, :])[0]
+    window = np.append(window[1:], np.float32(preds[h]))
+  return float(np.mean(np.abs(preds - values[-horizon:])))
+
+def select_model(values, model_selected, statistical = None):
+  """
+  Resolves a request for an 'auto' model or for a statistical model (see statistical_forecasters).
+
+  'auto' backtests the statistical models and a reference booster on the series and takes the
+  cheapest model within SELECTION_MARGIN of the most accurate: a booster (then trained with the
+  full grid search) is only used for the series where it is clearly better.
+
+  :param values: np.ndarray, the cleaned series
+  :param model_selected: 'auto' or one of STATISTICAL_MODELS
+  :param statistical: result of statistical_forecasters.select for the series, computed if None
+  :return: the model to train and the selection result, with the reference booster error added
+    to its backtest errors for 'auto'
+  """
+  if statistical is None:
+    statistical = statistical_forecasters.select([values])[0]
+  if model_selected != 'auto':
+    return model_selected, statistical
+  errors = dict(statistical['backtest'])
+  errors['xgboost'] = xgboost_backtest(values)
+  chosen = statistical_forecasters.choose(errors) or statistical['name']
+  return chosen, dict(statistical, backtest=errors)
+
 #########################
 ### 1. data profiling ###
 #########################
 
-def characterize_KPI(machine, kpi):
+def characterize_KPI(machine, kpi, model_selected = 'xgboost', series = None, statistical = None):
   """
   Characterizes a specific KPI for a given machine by performing data loading,
   trend extraction, missing value handling, stationarity checks, and model training.
 
   :param machine: The machine ID
   :param kpi: The KPI name
+  :param model_selected: the model to train: 'xgboost' (one-step model used recursively),
+    'xgboost_direct' (multi-output model predicting direct_horizon steps at once), 'ARIMA',
+    one of the numpy models of STATISTICAL_MODELS, or 'auto' (chosen by backtest, see select_model)
+  :param series: tuple of times and values already loaded (see data_load_bulk), loaded from Druid if None
+  :param statistical: the statistical_forecasters.select result of the series when already computed
+    with other series (see characterize_many), only used by 'auto' and the statistical models
+  :return: 0 if the model was saved, -1 if there is no data, -2 if the model could not be fitted,
+    -3 if the model type is unknown, the status of the stationarity check if it failed
   """
   # DATA LOADING
   a_dict = load_model(machine, kpi)
-  kpi_data_Time, kpi_data_Avg = data_load(machine, kpi) # load a single time series
+  if series is not None:
+    kpi_data_Time, kpi_data_Avg = series
+  else:
+    kpi_data_Time, kpi_data_Avg = data_load(machine, kpi) # load a single time series
+  if len(kpi_data_Time) == 0:
+    print(f"No data found for {machine}, {kpi}")
+    return -1
 
   # EXTRACT DATA TRENDS
   # conversion of the two arrays in a dataframe
   timestamps = pd.to_datetime(kpi_data_Time)
   timeseries = pd.DataFrame({'Timestamp':timestamps, 'Value': kpi_data_Avg})
   timeseries.set_index('Timestamp', inplace=True)
-  trends = data_extract_trends(timeseries['Value']) # find range, distribution, or any pattern that may be used
-                                                    # to treat missing values or outliers.
-                                                    # maybe also find correlations and mutual information
+  # the streaming statistics are seeded once here and then updated one point at a time by the monitoring
+  stats = StreamingStats.from_series(timeseries['Value'].values, outlier_window)
+  trends = stats.trends() # find range, distribution, or any pattern that may be used
+                          # to treat missing values or outliers.
+                          # maybe also find correlations and mutual information
   
   a_dict['trends'] = trends
+  a_dict['streaming'] = stats.to_dict()
 
   # MISSING VALUE HANDLING
   data = data_clean_missing_values(timeseries)  # mean/median OR Interpolation OR Forward/backward fill
@@ -465,13 +991,18 @@ def characterize_KPI(machine, kpi):
     ###########################
     ### 3. Model definition ###
     ###########################
-    model_selected = 'xgboost'
+    selection = None
+    if model_selected == 'auto' or model_selected in STATISTICAL_MODELS:
+      requested = model_selected
+      model_selected, selection = select_model(data['Value'].values.astype(float), model_selected, statistical)
+      print(f"Model {model_selected} selected for {machine}, {kpi}, backtest errors: {selection['backtest']}")
     if model_selected == 'ARIMA':
       # Set up the p and q ranges
       # p = range(0, 10,1)  # You can adjust the range as needed
       # q = range(0, 20,1)  # You can adjust the range as needed
-      p = range(2, 4,1)  # You can adjust the range as needed
-      q = range(2, 4,1)  # You can adjust the range as needed
+      # the stepwise search only visits a few orders, so the allowed ranges can be wide
+      p = range(0, 6,1)  # You can adjust the range as needed
+      q = range(0, 6,1)  # You can adjust the range as needed
       order_list = list(itertools.product(p, q))
 
       # Differencing parameter
@@ -479,14 +1010,28 @@ def characterize_KPI(machine, kpi):
 
       # Create an empty list to store optimization results
       best_arima = optimize_ARIMA(data['Value'].values, order_list, d)
+      if len(best_arima) == 0:
+        return -2
       pq_tuple = best_arima.iloc[0].iloc[0]
-      p = pq_tuple[0]
-      q = pq_tuple[1]
+      p = int(pq_tuple[0])
+      q = int(pq_tuple[1])
       print(p,q)
+      params = best_arima.iloc[0]['params']
+      # evaluated once here, serving does not backtest the model again
+      evaluation = evaluate_ARIMA(data['Value'].values, p, q, d, params)
+      if evaluation is not None:
+        print(f"Evaluation Metrics for {machine} - {kpi}: RMSE {evaluation['rmse']:.3f}, MAE {evaluation['mae']:.3f}")
       a_dict['model'] = {
           'name': 'ARIMA',
           'p': p,
-          'q': q
+          'q': q,
+          'd': d,
+          # fitted parameters, serving only filters the data with them (no re-estimation)
+          'params': params,
+          'metadata': {
+              'trained_on': str(datetime.today().date()),
+              'version': datetime.now().isoformat(),
+              'evaluation': evaluation},
       }
     elif model_selected == 'xgboost':
       # parameter selection for xgboost
@@ -497,20 +1042,65 @@ def characterize_KPI(machine, kpi):
       # model.fit(X_train, y_train)
 
       # booster = model.get_booster()
-      booster = xgboost_parameter_select(X_train,y_train)
+      booster, best_params, cv_rmse = xgboost_parameter_select(X_train,y_train)
       model_bytes = booster.save_raw()
       encoded_model = base64.b64encode(model_bytes).decode('utf-8')
       a_dict['model'] = {
         'name': 'xgboost',
         'xgb_bytes': encoded_model,
         'metadata': {
-            'trained_on': str(datetime.today().date())},
-            # 'hyperparameters': model.get_params()},
+            'trained_on': str(datetime.today().date()),
+            'version': datetime.now().isoformat(),
+            'hyperparameters': best_params,
+            # reference of the incremental updates (see update_KPI)
+            'searched_on': str(datetime.today().date()),
+            'cv_rmse': cv_rmse},
       }
+      # intervals are calibrated once here, serving only reads the stored quantiles
+      a_dict['intervals'] = fit_conformal_intervals(data['Value'].values, observation_window, best_params) or {}
+      a_dict['explainer'] = explainer_statistics(data['Value'].values, observation_window)
+    elif model_selected == 'xgboost_direct':
+      # one multi-output booster predicts the whole horizon from the last window
+      X_train, y_train = custom_tts_direct(data['Value'].values, observation_window, direct_horizon)
+      if len(X_train) == 0:
+        return -2
+      booster, best_params, cv_rmse = xgboost_parameter_select(X_train,y_train, DIRECT_PARAM_GRID)
+      encoded_model = base64.b64encode(booster.save_raw()).decode('utf-8')
+      a_dict['model'] = {
+        'name': 'xgboost_direct',
+        'xgb_bytes': encoded_model,
+        'horizon': direct_horizon,
+        'metadata': {
+            'trained_on': str(datetime.today().date()),
+            'version': datetime.now().isoformat(),
+            'hyperparameters': best_params,
+            'searched_on': str(datetime.today().date()),
+            'cv_rmse': cv_rmse},
+      }
+      a_dict['intervals'] = fit_conformal_intervals(data['Value'].values, observation_window, best_params,
+                                                    horizon=direct_horizon, direct=True) or {}
+      a_dict['explainer'] = explainer_statistics(data['Value'].values, observation_window)
+    elif model_selected in STATISTICAL_MODELS:
+      # the state is recomputed from the data at forecast time, only the parameters are stored
+      a_dict['model'] = {
+        'name': model_selected,
+        **selection['params'][model_selected],
+        'metadata': {
+            'trained_on': str(datetime.today().date()),
+            'version': datetime.now().isoformat()},
+      }
+      # the intervals follow from the model's error variance
+      a_dict['intervals'] = {}
+    else:
+      # nothing is saved, a model without a name would be taken as trained and never forecast
+      print(f"Unknown model type {model_selected} for {machine}, {kpi}")
+      return -3
+    if selection is not None:
+      a_dict['model']['metadata']['selection'] = {'requested': requested, 'backtest': selection['backtest']}
     ############################
     ### 4. Meta-Data storage ###
     ############################
-    save_model_data(machine, kpi, a_dict)
+    save_trained_model(machine, kpi, a_dict)
     return 0
   else:
     return call_status
@@ -527,10 +1117,184 @@ def characterize_KPI(machine, kpi):
 ### Alerts generation ###
 #########################
 
-def rolling_forecast(data, train_len: int, horizon: int, window: int, p: int , q: int, d: int) -> list:
+def boost_update(model_info, values, direct):
+  """
+  Trains the updated booster of a series, with the stored hyperparameters and no search.
+
+  :param model_info: dictionary stored under 'model' in the model metadata
+  :param values: np.ndarray, the part of the cleaned series to train on
+  :param direct: bool, the model is a direct multi-horizon model
+  :return: the updated xgb.Booster, None if the series is too short
+  """
+  if direct:
+    X_train, y_train = custom_tts_direct(values, observation_window, model_info.get('horizon', direct_horizon))
+  else:
+    X_train, y_train = custom_tts(values, None, observation_window)
+  if len(X_train) == 0:
+    return None
+  params = dict(model_info['metadata']['hyperparameters'])
+  num_boost_round = params.pop('num_boost_round')
+  booster = xgb.Booster()
+  booster.load_model(bytearray(base64.b64decode(model_info['xgb_bytes'])))
+  # the trees added by successive updates are bounded, past twice the searched size the booster is refitted
+  if UPDATE_MODE == 'continue' and booster.num_boosted_rounds() + UPDATE_ROUNDS <= 2 * num_boost_round:
+    dtrain = xgb.DMatrix(X_train[-UPDATE_WINDOWS:], label=y_train[-UPDATE_WINDOWS:])
+    return xgb.train(params=params, dtrain=dtrain, num_boost_round=UPDATE_ROUNDS, xgb_model=booster)
+  return xgb.train(params=params, dtrain=xgb.DMatrix(X_train, label=y_train), num_boost_round=num_boost_round)
+
+def holdout_rmse(booster, values, starts, direct):
+  """
+  :param booster: xgb.Booster, a recursive or direct model of the series
+  :param values: np.ndarray, the cleaned series
+  :param starts: np.ndarray, indexes of the first held-out point of every forecast window
+  :param direct: bool, the model predicts a block of steps: all its steps with an observed value are scored
+  :return: the RMSE of the model on the held-out points
+  """
+  preds = np.asarray(booster.inplace_predict(sliding_window_view(values, observation_window)[starts - observation_window]))
+  if not direct:
+    return float(np.sqrt(np.mean((values[starts] - preds) ** 2)))
+  preds = preds.reshape(len(starts), -1)
+  targets = starts[:, None] + np.arange(preds.shape[1])
+  observed = targets < len(values)
+  return float(np.sqrt(np.mean((values[targets[observed]] - preds[observed]) ** 2)))
+
+def update_KPI(machine, kpi, series = None, model_info = None):
+  """
+  Updates the booster of a series after a drift without a new hyperparameter search: it keeps
+  boosting the stored booster on the newest windows ('continue') or refits it with the stored
+  hyperparameters ('refit'), see UPDATE_MODE. Stationarity and trends are not recomputed, the
+  intervals are recalibrated.
+
+  The update is first trained without the last UPDATE_HOLDOUT points and checked on them, against
+  the stored booster forecasting the same windows: if its RMSE exceeds the stored booster's by more
+  than UPDATE_TOLERANCE, the series needs a full training instead.
+
+  :param machine: The machine ID
+  :param kpi: The KPI name
+  :param series: tuple of times and values already loaded (see data_load_bulk), loaded from Druid if None
+  :param model_info: the 'model' section of the stored model when already loaded, loaded if None
+  :return: 0 if the model was updated, 1 if it needs a full training with characterize_KPI: the model
+    has no incremental update (not a booster, or trained before the updates existed), its last search is
+    older than FULL_SEARCH_DAYS, or the update is not accurate enough
+  """
+  if model_info is None:
+    model_info = load_model(machine, kpi).get('model', {})
+  metadata = model_info.get('metadata', {})
+  if model_info.get('name') not in ('xgboost', 'xgboost_direct') or 'searched_on' not in metadata:
+    return 1
+  if retraining.staleness_days(metadata['searched_on']) >= FULL_SEARCH_DAYS:
+    print(f"Last search of {machine}, {kpi} on {metadata['searched_on']}, full training")
+    return 1
+  if series is None:
+    series = data_load(machine, kpi)
+  if len(series[0]) <= UPDATE_HOLDOUT + 2 * observation_window:
+    return 1
+  _, values = load_series(machine, kpi, series)
+  direct = model_info['name'] == 'xgboost_direct'
+
+  booster = boost_update(model_info, values[:-UPDATE_HOLDOUT], direct)
+  if booster is None:
+    return 1
+  starts = np.arange(max(len(values) - UPDATE_HOLDOUT, observation_window), len(values))
+  stored = xgb.Booster()
+  stored.load_model(bytearray(base64.b64decode(model_info['xgb_bytes'])))
+  rmse = holdout_rmse(booster, values, starts, direct)
+  stored_rmse = holdout_rmse(stored, values, starts, direct)
+  if rmse > stored_rmse * (1 + UPDATE_TOLERANCE):
+    print(f"Update of {machine}, {kpi} not accurate enough (RMSE {rmse:.3f}, stored model {stored_rmse:.3f}), full training")
+    return 1
+
+  # the accepted update is trained again with the held-out points
+  booster = boost_update(model_info, values, direct)
+  encoded_model = base64.b64encode(booster.save_raw()).decode('utf-8')
+  params = metadata['hyperparameters']
+  updated = {
+      'model': dict(model_info, xgb_bytes=encoded_model, metadata=dict(
+          metadata,
+          trained_on=str(datetime.today().date()),
+          version=datetime.now().isoformat(),
+          update_rmse=rmse)),
+      'explainer': explainer_statistics(values, observation_window)
+  }
+  if direct:
+    updated['intervals'] = fit_conformal_intervals(values, observation_window, params,
+                                                   horizon=model_info.get('horizon', direct_horizon), direct=True) or {}
+  else:
+    updated['intervals'] = fit_conformal_intervals(values, observation_window, params) or {}
+  # only the parts above change, the rest of the metadata is kept as stored
+  save_trained_model(machine, kpi, updated)
+  return 0
+
+def characterize_many(requests, max_workers = None, series = None):
+  """
+  Trains the models of many series, loading all their data with a few bulk queries first.
+
+  :param requests: list of (machine, kpi, model_selected) tuples, model_selected as in characterize_KPI.
+    The 'xgboost_global' requests of the same KPI are trained together by characterize_global_KPI,
+    the statistical models of the 'auto' and statistical requests are backtested together in one batch.
+  :param max_workers: int, number of models trained concurrently (TRAINING_WORKERS by default)
+  :param series: dictionary (machine, kpi) -> (times, values) already loaded (see data_load_bulk),
+    loaded with a few bulk queries if None
+  :return: dictionary (machine, kpi) -> status code of the training (see characterize_KPI),
+    None if the training raised an error
+  """
+  if series is None:
+    series = data_load_bulk([(machine, kpi) for machine, kpi, _ in requests])
+
+  global_requests = {}
+  single_requests = {} # a series requested twice is trained once, with the last model type asked
+  for machine, kpi, model_selected in requests:
+    if model_selected == 'xgboost_global':
+      global_requests.setdefault(kpi, []).append(machine)
+    else:
+      single_requests[(machine, kpi)] = model_selected
+
+  statistical = {}
+  batch = [key for key, model_selected in single_requests.items()
+           if (model_selected == 'auto' or model_selected in STATISTICAL_MODELS) and len(series[key][0]) > 0]
+  if len(batch) != 0:
+    values = [load_series(machine, kpi, series[(machine, kpi)])[1] for machine, kpi in batch]
+    statistical = dict(zip(batch, statistical_forecasters.select(values)))
+
+  statuses = {}
+  with ThreadPoolExecutor(max_workers=max_workers or TRAINING_WORKERS) as pool:
+    futures = {pool.submit(characterize_KPI, machine, kpi, model_selected, series[(machine, kpi)],
+                           statistical.get((machine, kpi))): (machine, kpi)
+               for (machine, kpi), model_selected in single_requests.items()}
+    for kpi, machines in global_requests.items():
+      futures[pool.submit(characterize_global_KPI, kpi, machines, series)] = (GLOBAL_MACHINE, kpi)
+    for future, key in futures.items():
+      try:
+        statuses[key] = future.result()
+      except Exception as e:
+        print(f"Training of {key[0]}, {key[1]} failed: {e}")
+        statuses[key] = None
+  return statuses
+
+def fit_ARIMA(data, p: int, q: int, d: int, params = None):
+  """
+  Fits an ARIMA model, or only runs the Kalman filter when its parameters are already known.
+
+  :param data: Time-series data as a NumPy array or list.
+  :param p: ARIMA order parameter p (AR terms).
+  :param q: ARIMA order parameter q (MA terms).
+  :param d: ARIMA order parameter d (degree of differencing).
+  :param params: list of fitted parameters (as stored by characterize_KPI), None to estimate them.
+  :return: the statsmodels results object.
+  """
+  model = arima.SARIMAX(data, order=(p, d, q))
+  if params is not None:
+    return model.filter(params)
+  return model.fit(disp=False)
+
+def rolling_forecast(data, train_len: int, horizon: int, window: int, p: int , q: int, d: int, params = None) -> list:
     """
     Generates rolling ARIMA forecasts for a given dataset.
 
+    The model is fitted once on the training set. At every window position the fitted
+    state-space results are extended with the newly observed values, which only runs the
+    filter over the new observations and does not re-estimate the parameters.
+
     :param data: Time-series data as a Pandas Series or list.
     :param train_len: Length of the initial training set.
     :param horizon: Number of steps to forecast into the future.
@@ -538,27 +1302,50 @@ def rolling_forecast(data, train_len: int, horizon: int, window: int, p: int , q
     :param p: ARIMA order parameter p (AR terms).
     :param q: ARIMA order parameter q (MA terms).
     :param d: ARIMA order parameter d (degree of differencing).
+    :param params: fitted parameters, if given the initial fit is skipped.
     :return: List of predicted values for the specified horizon.
     """
+    data = np.asarray(data, dtype=float)
     total_len = train_len + horizon
     pred_ARIMA = []
 
+    res = fit_ARIMA(data[:train_len], p, q, d, params)
     for i in range(train_len, total_len, window):
-        # Convert data to Series if it's not already
-        if not isinstance(data, pd.Series):
-            data = pd.Series(data)
-
-        model = SARIMAX(data[:i], order=(p, d, q)) 
-        res = model.fit(disp=False)
+        new_obs = data[i:i + window]
+        if len(new_obs) < window:
+            # no more observed data, forecast the rest of the horizon in one go
+            pred_ARIMA.extend(res.forecast(total_len - i))
+            break
 
         # Get predictions for the next window size
-        predictions = res.get_prediction(start=i, end=min(i + window - 1, total_len - 1))
-        oos_pred = predictions.predicted_mean
-        pred_ARIMA.extend(oos_pred)
+        pred_ARIMA.extend(res.forecast(min(window, total_len - i)))
+        res = res.extend(new_obs)
 
     return pred_ARIMA[:horizon]
 
-def XAI_PRED(data,Last_date, model, total_points, seq_length = 10, n_predictions = 30):
+def evaluate_ARIMA(values, p: int, q: int, d: int, params, test_fraction = 0.15):
+  """
+  Evaluates a fitted ARIMA model with one-step rolling forecasts on the last part of the series.
+
+  :param values: np.ndarray, the cleaned series
+  :param params: fitted parameters of the model
+  :param test_fraction: float, fraction of the series held out for the evaluation
+  :return: dictionary with the 'rmse' and 'mae' of the forecasts and the number of test 'points',
+    None if the series leaves no test data
+  """
+  train_len = int(len(values) * (1 - test_fraction))
+  test = values[train_len:]
+  if len(test) == 0:
+    return None
+  preds = rolling_forecast(values, train_len=train_len, horizon=len(test), window=1, p=p, q=q, d=d, params=params)
+  return {
+      'rmse': float(np.sqrt(metrics.mean_squared_error(test, preds))),
+      'mae': float(metrics.mean_absolute_error(test, preds)),
+      'points': int(len(test))
+  }
+
+def XAI_PRED(data,Last_date, model, total_points, seq_length = 10, n_predictions = 30, explanation_mode = ExplanationMode.FULL,
+             intervals = None, direct = False, explainer_stats = None):
   """
   Explains predictions using XGBoost and interpretable machine learning techniques.
 
@@ -568,22 +1355,29 @@ def XAI_PRED(data,Last_date, model, total_points, seq_length = 10, n_predictions
   :param total_points: Total number of data points in the series.
   :param seq_length: Length of the input sequence for prediction.
   :param n_predictions: Number of future points to predict.
-  :return: None. Displays explanations and prediction results.
+  :param explanation_mode: ExplanationMode, which LIME explanations to compute. In DEFERRED mode
+    the result holds no explanation but a 'Deferred_explanation' callable that computes them.
+  :param intervals: dictionary stored by fit_conformal_intervals, if given the bounds come from its
+    quantiles instead of bootstrapping the model.
+  :param direct: bool, the model is a direct multi-horizon model predicting a block of steps per call.
+  :param explainer_stats: dictionary stored by explainer_statistics, if given the training windows are not
+    rebuilt: LIME uses the stored background sample and the bootstrap the stored standard deviation.
+  :return: dictionary with the predictions, their bounds and explanations.
   """
-  np.random.seed(42)
-
-  # Prepare training data for XGBoost: predict next value from last seq_length values
-  X_train = []
-  y_train = []
-  for i in range(total_points - seq_length - 1):
-      X_train.append(data[i:i+seq_length])
-      y_train.append(data[i+seq_length])
+  # a seeded generator of its own: the same data gives the same bootstrap rollout, also when other
+  # forecasts run concurrently in threads (forecast table, monitoring)
+  rng = np.random.default_rng(42)
 
-  X_train = np.array(X_train)
-  y_train = np.array(y_train)
+  if explainer_stats:
+    X_train = np.asarray(explainer_stats['background'], dtype=float)
+    training_std = explainer_stats['training_std']
+  else:
+    # models trained without the statistics: windows of the history, predicting the next value
+    X_train, _ = custom_tts(data[:total_points], None, seq_length)
+    training_std = None
 
-  # Perform predictions beyond the training range
-  input_data = data[(total_points - seq_length - n_predictions): (total_points - n_predictions)]
+  # Perform predictions beyond the last observed point, the window matches input_labels
+  input_data = data[total_points - seq_length: total_points]
 
   # Generate labels for the input_data
   print(Last_date, type(Last_date))
@@ -592,35 +1386,78 @@ def XAI_PRED(data,Last_date, model, total_points, seq_length = 10, n_predictions
   input_labels = [(start_date + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(seq_length)]
 
   # Initialize the explainer
-  explainer = ForecastExplainer(model, X_train)
-
-  # Perform autoregressive predictions
-  results = explainer.predict_and_explain(
-      input_data=input_data,
-      n_predictions=n_predictions,
-      input_labels=input_labels,
-      num_features=5,
-      confidence=0.95,
-      n_samples=100,
-      use_mean_pred=True
-  )
+  if intervals:
+    explainer = ForecastExplainer(model, X_train, interval_quantiles=intervals['quantiles'],
+                                  interval_confidence=intervals['confidence'], training_std=training_std, rng=rng)
+  else:
+    explainer = ForecastExplainer(model, X_train, training_std=training_std, rng=rng)
+
+  explain_steps = {
+      ExplanationMode.FULL: None,
+      ExplanationMode.FIRST_STEP: 1,
+      ExplanationMode.NONE: 0,
+      ExplanationMode.DEFERRED: 0
+  }[explanation_mode]
+
+  if direct:
+    # Perform direct multi-horizon predictions
+    results = explainer.predict_and_explain_direct(
+        input_data=input_data,
+        n_predictions=n_predictions,
+        input_labels=input_labels,
+        num_features=5,
+        confidence=0.95,
+        n_samples=100,
+        explain_steps=explain_steps
+    )
+    blocks = results.pop('Blocks')
+    deferred_explanation = partial(explainer.explain_direct, blocks, num_features=5)
+  else:
+    # Perform autoregressive predictions
+    results = explainer.predict_and_explain(
+        input_data=input_data,
+        n_predictions=n_predictions,
+        input_labels=input_labels,
+        num_features=5,
+        confidence=0.95,
+        n_samples=100,
+        use_mean_pred=True,
+        explain_steps=explain_steps
+    )
+    deferred_explanation = partial(explainer.explain_rollout, input_data, input_labels,
+                                   list(results['Predicted_value']), num_features=5)
+  if explanation_mode == ExplanationMode.DEFERRED:
+    results['Lime_explaination'] = []
+    results['Deferred_explanation'] = deferred_explanation
+  elif explanation_mode == ExplanationMode.NONE:
+    results['Lime_explaination'] = []
   return results
 
-def make_prediction(machine, kpi, length):
+def make_prediction(machine, kpi, length, explanation_mode = ExplanationMode.FULL, series = None):
   """
   Forecasts KPI values using a trained model (ARIMA or XGBoost).
 
   :param machine: str, machine identifier.
   :param kpi: str, KPI to be predicted.
   :param length: int, number of steps to forecast.
+  :param explanation_mode: ExplanationMode, which LIME explanations to compute.
+  :param series: tuple of times and values already loaded (see data_load_bulk), loaded from Druid if None
 
-  :return: None (prints evaluation metrics and forecasts).
+  :return: dictionary with the forecast (ARIMA forecasts have no LIME explanation).
+    Forecasts are cached per model version and last data point, deferred explanations are never cached.
   """
-  a_dict = load_model(machine, kpi)
+  a_dict = load_forecast_model(machine, kpi) or create_model_data()
 
-  kpi_data_Time, kpi_data_Avg = data_load(machine, kpi) # load a single time series
+  kpi_data_Time, kpi_data_Avg = series if series is not None else data_load(machine, kpi) # load a single time series
   Last_date = kpi_data_Time[-1]
 
+  model_version = a_dict['model'].get('metadata', {}).get('version')
+  use_cache = explanation_mode != ExplanationMode.DEFERRED
+  if use_cache:
+    cached = forecast_cache.get(machine, kpi, model_version, Last_date, explanation_mode.value, length)
+    if cached is not None:
+      return cached
+
   timestamps = pd.to_datetime(kpi_data_Time)
   timeseries = pd.DataFrame({'Timestamp':timestamps, 'Value': kpi_data_Avg})
   timeseries.set_index('Timestamp', inplace=True)
@@ -628,14 +1465,6 @@ def make_prediction(machine, kpi, length):
 
   avg_values1 = data['Value'].values
   if a_dict['model']['name'] == 'ARIMA':
-
-    # Split into train and test sets
-    train_len = int(len(avg_values1) * 0.85)
-    train, test = avg_values1[:train_len], avg_values1[train_len:]
-
-    window = 1
-    horizon = length
-
     # model = any
     # training_data: Union[np.ndarray, torch.Tensor]
     # explainer = ForecastExplainer(model, training_data)
@@ -645,46 +1474,69 @@ def make_prediction(machine, kpi, length):
     # Predicted_value, Lower_bound, Upper_bound, Confidence_score, Lime_explaination = explainer.predict_and_explain(input_data, n_predictions, input_labels)
     # Model MUST be able to do prediction = model.predict(input_data) <- predict should return a single value
 
-    pred_ARIMA = rolling_forecast(
-        avg_values1,
-        train_len=train_len,
-        horizon=horizon,
-        window=window,
-        p=a_dict['model']['p'],
-        q=a_dict['model']['q'],
-        d=a_dict['stationarity']['Differencing']
-    )
-
-    # Evaluate predictions
-    if len(test) > 0:
-        test_length = min(len(test), horizon)
-        rmse = np.sqrt(mean_squared_error(test[:test_length], pred_ARIMA[:test_length]))
-        mae = mean_absolute_error(test[:test_length], pred_ARIMA[:test_length])
-        print(f"Evaluation Metrics for {machine} - {kpi}:")
-        print(f"  RMSE: {rmse:.3f}")
-        print(f"  MAE: {mae:.3f}")
-    else:
-        print(f"No test data available for evaluation for {machine} - {kpi}")
-
-  elif a_dict['model']['name'] == 'xgboost':
-    # Decode the Base64 string back to raw bytes
-    encoded_model = a_dict['model']['xgb_bytes']
-    raw_model_bytes = bytearray(base64.b64decode(encoded_model))
+    p = a_dict['model']['p']
+    q = a_dict['model']['q']
+    d = a_dict['model'].get('d', a_dict['stationarity']['Differencing'])
+    params = a_dict['model'].get('params')
+    # the model was evaluated at training time (see evaluate_ARIMA), here it is only filtered and forecast
+    # forecast from the last observed point with the stored parameters
+    res = fit_ARIMA(avg_values1, p, q, d, params)
+    forecast = res.get_forecast(length)
+    bounds = np.asarray(forecast.conf_int(alpha=0.05))
+    last_day = datetime.strptime(Last_date, "%Y-%m-%dT%H:%M:%S.%fZ")
+    results = {
+        'Predicted_value': [float(v) for v in forecast.predicted_mean],
+        'Lower_bound': [float(v) for v in bounds[:, 0]],
+        'Upper_bound': [float(v) for v in bounds[:, 1]],
+        'Confidence_score': [0.95] * length,
+        'Lime_explaination': [],
+        'Date_prediction': [(last_day + timedelta(days=h + 1)).strftime("%Y-%m-%d") for h in range(length)]
+    }
+    if use_cache:
+      forecast_cache.put(machine, kpi, model_version, Last_date, explanation_mode.value, length, results)
+    return results
 
-    # Load the model from raw bytes
-    booster = xgb.Booster()
-    booster.load_model(raw_model_bytes)
+  elif a_dict['model']['name'] in STATISTICAL_MODELS:
+    # the level of the series is filtered again with the stored parameters, no LIME explanation
+    mean, half = statistical_forecasters.predict(a_dict['model'], avg_values1, length)
+    last_day = datetime.strptime(Last_date, "%Y-%m-%dT%H:%M:%S.%fZ")
+    results = {
+        'Predicted_value': mean.tolist(),
+        'Lower_bound': (mean - half).tolist(),
+        'Upper_bound': (mean + half).tolist(),
+        'Confidence_score': [0.95] * length,
+        'Lime_explaination': [],
+        'Date_prediction': [(last_day + timedelta(days=h + 1)).strftime("%Y-%m-%d") for h in range(length)]
+    }
+    if use_cache:
+      forecast_cache.put(machine, kpi, model_version, Last_date, explanation_mode.value, length, results)
+    return results
 
-    # Optionally, wrap the Booster back into an XGBRegressor for convenience
-    loaded_model = xgb.XGBRegressor()
-    loaded_model._Booster = booster
+  elif a_dict['model']['name'] in ('xgboost', 'xgboost_direct', 'xgboost_global'):
+    # the booster is decoded and loaded once per model, then served by inplace prediction
+    predictor = get_predictor(a_dict['model']['xgb_bytes'])
+
+    intervals = a_dict.get('intervals')
+    explainer_stats = a_dict.get('explainer')
+    if a_dict['model']['name'] == 'xgboost_global':
+      # the stored statistics of a global model would be those of the normalized fleet
+      explainer_stats = None
+      # the global model works on normalized windows, its quantiles are scaled to the series
+      mean, std = a_dict['model']['scaling'][machine]
+      loaded_model = GlobalSeriesModel(predictor, a_dict['model']['machines'].index(machine), mean, std)
+      if intervals:
+        intervals = dict(intervals, quantiles=[q * std for q in intervals['quantiles']])
+    else:
+      loaded_model = predictor
 
     # Use the loaded model for predictions
 
     # explainer = ForecastExplainer(loaded_model, X_train)
     # formatted_dates = [datetime.strptime(date, "%Y-%m-%dT%H:%M:%SZ").strftime("%Y-%m-%d") for date in kpi_data_Time[-11:-1]]
 
-    results = XAI_PRED(avg_values1,Last_date, loaded_model,len(avg_values1),seq_length = observation_window,n_predictions = length)
+    results = XAI_PRED(avg_values1,Last_date, loaded_model,len(avg_values1),seq_length = observation_window,n_predictions = length,
+                       explanation_mode = explanation_mode, intervals = intervals,
+                       direct = a_dict['model']['name'] == 'xgboost_direct', explainer_stats = explainer_stats)
     
     #convert numpy(float) to float
     x = [r.item() for r in results['Predicted_value']]
@@ -695,9 +1547,77 @@ def make_prediction(machine, kpi, length):
     results['Lower_bound'] = y
     results['Upper_bound'] = z
     # results['Confidence_score'] = k
-    
+
+    if use_cache:
+      forecast_cache.put(machine, kpi, model_version, Last_date, explanation_mode.value, length, results)
     return results
 
+def make_fleet_prediction(kpi, machines, length, series = None):
+  """
+  Forecasts a KPI for many machines at once with its global cross-series model.
+
+  The last windows of all the machines are stacked in one matrix, so every forecast step
+  is a single batched model call for the whole fleet. Bounds come from the stored
+  conformal quantiles, no LIME explanation is computed.
+
+  :param kpi: str, KPI to be predicted.
+  :param machines: list of machine identifiers.
+  :param length: int, number of steps to forecast.
+  :param series: dictionary (machine, kpi) -> series already loaded (see data_load_bulk), the
+    missing series are loaded from Druid.
+  :return: dictionary machine -> forecast (same keys as make_prediction), machines not covered
+    by the global model are left out.
+  """
+  a_dict = retrieve_model_from_storage(kpi, GLOBAL_MACHINE)
+  if a_dict is None:
+    return {}
+  model_info = a_dict['model']
+  covered = [m for m in machines if m in model_info['machines']]
+  if len(covered) == 0:
+    return {}
+
+  predictor = get_predictor(model_info['xgb_bytes'])
+
+  windows, last_dates = [], []
+  for machine in covered:
+    kpi_data_Time, values = load_series(machine, kpi, (series or {}).get((machine, kpi)))
+    mean, std = model_info['scaling'][machine]
+    windows.append((values[-observation_window:] - mean) / std)
+    last_dates.append(datetime.strptime(kpi_data_Time[-1], "%Y-%m-%dT%H:%M:%S.%fZ"))
+  windows = np.array(windows)
+  codes = np.array([model_info['machines'].index(m) for m in covered])
+  means = np.array([model_info['scaling'][m][0] for m in covered])
+  stds = np.array([model_info['scaling'][m][1] for m in covered])
+
+  predictions = np.empty((len(covered), length))
+  for step in range(length):
+    predictions[:, step] = predictor.predict(global_features(windows, codes))
+    windows = np.column_stack([windows[:, 1:], predictions[:, step]])
+
+  quantiles = a_dict.get('intervals', {}).get('quantiles')
+  if quantiles:
+    n_calibrated = len(quantiles)
+    half_widths = np.array([quantiles[h] if h < n_calibrated else quantiles[-1] * np.sqrt((1 + h) / n_calibrated)
+                            for h in range(length)])
+    confidence = a_dict['intervals']['confidence']
+  else:
+    half_widths = np.zeros(length)
+    confidence = 0.0
+
+  results = {}
+  for i, machine in enumerate(covered):
+    values = predictions[i] * stds[i] + means[i]
+    half = half_widths * stds[i]
+    results[machine] = {
+        'Predicted_value': values.tolist(),
+        'Lower_bound': (values - half).tolist(),
+        'Upper_bound': (values + half).tolist(),
+        'Confidence_score': [confidence] * length,
+        'Lime_explaination': [],
+        'Date_prediction': [(last_dates[i] + timedelta(days=h + 1)).strftime("%Y-%m-%d") for h in range(length)]
+    }
+  return results
+
 def kpi_exists(machine, KPI, api_key):
   """
   Checks if a specific KPI exists for a machine by querying a knowledge base API.
@@ -747,15 +1667,18 @@ class DDM: # Drift Detection Modelworks by keeping track of the error rate in a
   - p_mean, s_mean: float, running mean and standard deviation of errors.
   """  
   
-  def __init__(self,state_json, warning_level=2.0, drift_level=3.0):
+  def __init__(self,state_json, warning_level=2.0, drift_level=3.0, min_instances=30):
     """
     - warning_level: float, threshold for raising a warning.
     - drift_level: float, threshold for detecting a drift.
     - state_file: str, file path for saving and loading the DDM state.
+    - min_instances: int, number of instances needed before warnings and drifts are reported.
     """
     self.warning_level = warning_level
     self.drift_level = drift_level
+    self.min_instances = min_instances
     self.state_json = state_json
+    self.severity = 0.0
 
     # Initialize state variables
     self.num_instances = 0
@@ -777,23 +1700,29 @@ class DDM: # Drift Detection Modelworks by keeping track of the error rate in a
     self.p_mean += (error - self.p_mean) / self.num_instances
     self.s_mean = np.sqrt(self.p_mean * (1 - self.p_mean) / self.num_instances)
 
-    # Calculate thresholds
-    warning_threshold = self.p_mean + self.warning_level * self.s_mean
-    drift_threshold = self.p_mean + self.drift_level * self.s_mean
+    self.drift_detected = 0
+    self.severity = 0.0
+    if self.num_instances < self.min_instances:
+      return self.save_state(), self.drift_detected
 
     # Update p_min and s_min (historical minimum values)
     if self.p_mean + self.s_mean < self.p_min + self.s_min:
       self.p_min = self.p_mean
       self.s_min = self.s_mean
 
+    # Calculate thresholds, relative to the best error rate observed so far
+    warning_threshold = self.p_min + self.warning_level * self.s_min
+    drift_threshold = self.p_min + self.drift_level * self.s_min
+
     # Check for warning or drift
-    self.drift_detected = 0
     if self.p_mean + self.s_mean > drift_threshold:
       print(f"Drift detected at instance {self.num_instances}: p_mean={self.p_mean:.4f}")
       self.drift_detected = 2
+      # how many minimum standard deviations the error rate moved, used to prioritize the retraining
+      self.severity = (self.p_mean + self.s_mean - self.p_min) / self.s_min if self.s_min > 0 else self.drift_level
       # Reset the detector after drift detection
       self.reset()
-    if self.p_mean + self.s_mean > warning_threshold:
+    elif self.p_mean + self.s_mean > warning_threshold:
       print(f"Warning at instance {self.num_instances}: p_mean={self.p_mean:.4f}")
       self.drift_detected = 1
 
@@ -830,6 +1759,10 @@ class DDM: # Drift Detection Modelworks by keeping track of the error rate in a
     self.s_min = self.state_json['drift']["s_min"]
     self.p_mean = self.state_json['drift']["p_mean"]
     self.s_mean = self.state_json['drift']["s_mean"]
+    if self.num_instances == 0:
+      # fresh state (see create_model_data), the minimum is not known yet
+      self.p_min = float('inf')
+      self.s_min = float('inf')
 
 def missingdata_check(current_value):
   """
@@ -854,53 +1787,48 @@ def outlier_check(new_value, data):
     :return: bool, True if outlier, False otherwise.
     """
     multiplier = 3
-    mean = sum(data)/len(data)
-    variance = sum((x - mean) ** 2 for x in data)/len(data)
-    std_dev = variance ** 0.5
-    return abs(new_value - mean) > std_dev * multiplier
+    data = np.asarray(data, dtype=float)
+    return abs(new_value - np.mean(data)) > np.std(data) * multiplier
     # return [f"An anomaly has been detected: {new_value} deviates significantly from the {mean}"]
 
 
 
-def send_Alert(url, data, api_key):
+def send_Alert(data):
   """
-  Sends an alert to another microservice using an HTTP POST request.
+  Queues an alert for the gateway, the alert outbox sends the queued alerts in batches (see alert_outbox).
 
-  :param url: URL of the target microservice.
   :param data: Dictionary containing alert data.
-  :param api_key: security key
   :return: None
   """
-  headers = {
-      "x-api-key": api_key
-  }
-
-  try:
-      new_al = {
-        "title": data["title"],
-        "type": data["type"],
-        "description": data["description"],
-        "triggeredAt": data["alert_date"],
-        "machineName": data["machine"],
-        "isPush": True,
-        "isEmail": True,
-        "recipients": data["recipients"],
-        "severity": data["severity"].value
-      }  
-      response = requests.post(url, json=new_al, headers=headers)
-      print(f"Response status code: {response.status_code}")
-      print(f"Response body: {response.json()}")
-  except requests.RequestException as e:
-      print(f"Request failed: {e}")
-  except Exception as e:
-      print(f"Unexpected error: {e}")
-       
-def elaborate_new_datapoint(machine, kpi):
+  alert_outbox.put({
+      "title": data["title"],
+      "type": data["type"],
+      "description": data["description"],
+      "triggeredAt": data["alert_date"],
+      "machineName": data["machine"],
+      "isPush": True,
+      "isEmail": True,
+      "recipients": data["recipients"],
+      "severity": data["severity"].value
+  })
+
+def elaborate_new_datapoint(machine, kpi, latest = None, is_outlier = None, alerted = False):
   """
   Processes new KPI data point, detects drift, and generates alerts.
 
+  Only the latest data point is loaded: the outlier check and the trends rely on the
+  streaming statistics stored in the model metadata, which are updated with the new value.
+  The expected value of the point is looked up in the materialized forecasts (see forecast_table),
+  the series is only forecast here when they do not cover it.
+
   :param machine: str, machine identifier.
   :param kpi: str, key performance indicator name.
+  :param latest: tuple of time and value of the new data point, when already fetched
+    by the monitoring pipeline. Loaded from Druid otherwise.
+  :param is_outlier: bool, outcome of the outlier check when already computed by the
+    monitoring pipeline. Checked against the streaming statistics otherwise.
+  :param alerted: bool, the missing, zero and outlier alerts were already sent by the monitoring
+    pipeline, which keeps the streaks of the whole fleet (see monitoring.update_streaks).
 
   :return: None (updates model, triggers alerts, and saves state).
   """
@@ -910,84 +1838,118 @@ def elaborate_new_datapoint(machine, kpi):
 
   # LOADING NEW DATA and KPI metadata
   # d = read_value(machine, kpi)
-  kpi_data_Date, kpi_data_Avg = data_load(machine, kpi) # load a single time series
-
-  d_date = datetime.date(kpi_data_Date[-1])
-  d = kpi_data_Avg[-1]
-
-  a_dict = load_model(machine,kpi)
+  if latest is None:
+    latest = data_load_latest(machine, kpi) # load only the new data point
+  d_time, d = latest
+  if d_time is None:
+    return
+  d_date = datetime.strptime(d_time, "%Y-%m-%dT%H:%M:%S.%fZ").date()
+  if d is None:
+    d = float('nan')
+
+  # the model metadata is only written back under its lock, so a retraining finishing
+  # meanwhile is not overwritten
+  with model_lock(machine, kpi):
+    a_dict = load_model(machine,kpi)
+    if 'streaming' in a_dict:
+      stats = StreamingStats.from_dict(a_dict['streaming'])
+    else:
+      # models trained before the streaming statistics existed are seeded from the history once
+      _, kpi_data_Avg = data_load(machine, kpi)
+      stats = StreamingStats.from_series(kpi_data_Avg[:-1], outlier_window)
   
-  last_pred =  datetime.date(a_dict['predictions']['date_prediction'][0],
-                             a_dict['predictions']['date_prediction'][1],
-                             a_dict['predictions']['date_prediction'][2])
-
-
-  # if missing_count >= threshold_count:
-  #     return [f"No valid data received for {missing_count} consecutive days."]
-  # elif zeros_count >= threshold_count:
-  #     return [f"Zeros data received for {zeros_count} consecutive days."]  
-  alert_data = {
-     'title': "",
-     'type': "",
-     'description': "",
-     'machine': "",
-     'isPush': True,
-     'isEmail': True,
-     'alert_date': str(datetime.now()),
-     'recipients': [],
-     'severity': Severity.MEDIUM
-  }
+    last_pred =  date(*[int(x) for x in a_dict['predictions']['date_prediction']])
+    expected = a_dict['predictions']['first_prediction']
+    table_values = {}
+    if FORECAST_TABLE_HORIZON > 0:
+      # the expected values of this point and of the next one, from the materialized forecasts
+      table_values = get_forecast_values(kpi, machine, [d_date, d_date + timedelta(days=1)])
+      expected = table_values.get(d_date, expected)
+
+
+    # if missing_count >= threshold_count:
+    #     return [f"No valid data received for {missing_count} consecutive days."]
+    # elif zeros_count >= threshold_count:
+    #     return [f"Zeros data received for {zeros_count} consecutive days."]  
+    alert_data = {
+       'title': "",
+       'type': "",
+       'description': "",
+       'machine': "",
+       'isPush': True,
+       'isEmail': True,
+       'alert_date': str(datetime.now()),
+       'recipients': [],
+       'severity': Severity.MEDIUM
+    }
 
-  url_alert = f"http://api:8000/smartfactory/postAlert"
-  if last_pred < d_date: # if the prediction is relative to a new date
-    is_missing = missingdata_check(d)
-    if is_missing == -1: # the data is 'nan', fill it and send an alert
-      d = a_dict['predictions']['first_prediction']
-      alert_data['title'] = 'missing value'
-      alert_data['description'] = f'{machine} did not yield a new value for: {kpi}'
-      alert_data['machine'] = machine
-      alert_data['recipients'] = ["FactoryFloorManager"]
-      alert_data['type'] = 'machine_unreachable'
-      send_Alert(url_alert, alert_data)
-    elif is_missing == 0:
-      a_dict['missingval']['missing_streak'] += 1
-      if a_dict['missingval']['missing_streak'] > 2 and not a_dict['missingval']['alert_sent']:
-        alert_data['title'] = 'Zero streak'
-        alert_data['description'] = f"{kpi} for {machine} returned zeros for {a_dict['missingval']['missing_streak']} days in a row"
-        alert_data['machine'] = machine
-        alert_data['recipients'] = ["FactoryFloorManager"]
-        alert_data['type'] = 'machine_unreachable'
-        if a_dict['missingval']['missing_streak'] > 5:
-           alert_data['severity'] = Severity.HIGH 
-           a_dict['missingval']['alert_sent'] = True       
-        send_Alert(url_alert, alert_data)        
-    else:
-      a_dict['missingval']['alert_sent'] = False
-      a_dict['missingval']['missing_streak'] = 0
-    #if the value is not missing we test if it is within range
-    if is_missing != -1:
+    if last_pred < d_date: # if the prediction is relative to a new date
+      is_missing = missingdata_check(d)
+      if is_missing == -1: # the data is 'nan', fill it and send an alert
+        d = expected
+        if not alerted:
+          alert_data['title'] = 'missing value'
+          alert_data['description'] = f'{machine} did not yield a new value for: {kpi}'
+          alert_data['machine'] = machine
+          alert_data['recipients'] = ["FactoryFloorManager"]
+          alert_data['type'] = 'machine_unreachable'
+          send_Alert(alert_data)
+      elif alerted:
+        pass # the streaks are kept by the monitoring pipeline
+      elif is_missing == 0:
+        a_dict['missingval']['missing_streak'] += 1
+        if a_dict['missingval']['missing_streak'] > 2 and not a_dict['missingval']['alert_sent']:
+          alert_data['title'] = 'Zero streak'
+          alert_data['description'] = f"{kpi} for {machine} returned zeros for {a_dict['missingval']['missing_streak']} days in a row"
+          alert_data['machine'] = machine
+          alert_data['recipients'] = ["FactoryFloorManager"]
+          alert_data['type'] = 'machine_unreachable'
+          if a_dict['missingval']['missing_streak'] > 5:
+             alert_data['severity'] = Severity.HIGH 
+             a_dict['missingval']['alert_sent'] = True       
+          send_Alert(alert_data)
+      else:
+        a_dict['missingval']['alert_sent'] = False
+        a_dict['missingval']['missing_streak'] = 0
+      #if the value is not missing we test if it is within range
+      if is_missing != -1:
       
-      is_outlier = outlier_check(d, kpi_data_Avg[-31:-1])
-      if is_outlier:
-        alert_data['title'] = 'Outlier detected'
-        alert_data['description'] = f'{kpi} for {machine} returned a value higher than expected'
-        alert_data['machine'] = machine
-        alert_data['recipients'] = ["FactoryFloorManager","SpecialityManufacturingOwner"]
-        alert_data['type'] = 'unexpected output'        
-        send_Alert(url_alert, alert_data) 
-      prediction_error = d - a_dict['predictions']['first_prediction']
-      error = 0
-      if prediction_error > 2*a_dict['trends']['std']: # a_dict['predictions']['error_threshold']:
-        error = 1
-      # Initialize DDM with warning level and drift level thresholds
-      ddm = DDM(a_dict, warning_level=2.0, drift_level=3.0)
-      a_dict, is_drifting = ddm.update(error)
-      if is_drifting == 2:
-        characterize_KPI(machine, kpi)
-      #if is_drifting == 1: warning
-      #predict only the first data point after the series and save it here
-    d,v = make_prediction(machine,kpi,1)
-    a_dict['predictions']['first_prediction'] = v #put here first predicted value
-    a_dict['predictions']['date_prediction'] = f"{d.Year}/{d.Month}/{d.Day}" 
-
-    save_model_data(machine, kpi, a_dict)
\ No newline at end of file
+        if is_outlier is None:
+          is_outlier = stats.is_outlier(d)
+        stats.update(d)
+        if is_outlier and not alerted:
+          alert_data['title'] = 'Outlier detected'
+          alert_data['description'] = f'{kpi} for {machine} returned a value higher than expected'
+          alert_data['machine'] = machine
+          alert_data['recipients'] = ["FactoryFloorManager","SpecialityManufacturingOwner"]
+          alert_data['type'] = 'unexpected output'        
+          send_Alert(alert_data)
+        prediction_error = d - expected
+        error = 0
+        if prediction_error > 2*a_dict['trends']['std']: # a_dict['predictions']['error_threshold']:
+          error = 1
+        # Initialize DDM with warning level and drift level thresholds
+        ddm = DDM(a_dict, warning_level=2.0, drift_level=3.0)
+        ddm.load_state()
+        a_dict, is_drifting = ddm.update(error)
+        if is_drifting == 2:
+          # trained in background, the new model replaces this one when it is ready
+          retraining.retrain_queue.submit(machine, kpi, ddm.severity,
+                                          a_dict['model'].get('metadata', {}).get('trained_on'))
+        #if is_drifting == 1: warning
+        #predict only the first data point after the series and save it here
+      a_dict['streaming'] = stats.to_dict()
+      a_dict['trends'] = stats.trends()
+      next_date = d_date + timedelta(days=1)
+      if next_date in table_values:
+        a_dict['predictions']['first_prediction'] = table_values[next_date]
+        a_dict['predictions']['date_prediction'] = [next_date.year, next_date.month, next_date.day]
+      else:
+        # no materialized forecast of the series yet, it is forecast here
+        result = make_prediction(machine,kpi,1,ExplanationMode.NONE)
+        if result is not None:
+          next_date = datetime.strptime(result['Date_prediction'][0], "%Y-%m-%d")
+          a_dict['predictions']['first_prediction'] = result['Predicted_value'][0] #put here first predicted value
+          a_dict['predictions']['date_prediction'] = [next_date.year, next_date.month, next_date.day]
+
+      save_model_data(machine, kpi, a_dict)
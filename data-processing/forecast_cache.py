@@ -0,0 +1,111 @@
+import os
+import threading
+from collections import OrderedDict
+
+# keys of a forecast result holding one element per forecast step
+STEP_KEYS = ['Predicted_value', 'Lower_bound', 'Upper_bound', 'Confidence_score', 'Lime_explaination', 'Date_prediction']
+
+class ForecastCache:
+  """
+  Size-bounded LRU cache of forecast results.
+
+  Entries are keyed by (machine, kpi, model version, last data timestamp, explanation mode),
+  so a retrained model or a new data point never hits an old entry. Every key stores the longest
+  horizon computed so far: a request for a shorter horizon is served with its prefix, since the
+  recursive forecast of the first steps does not depend on how many steps follow.
+
+  The key alone keeps the entries correct, nothing needs to be invalidated when a model is trained
+  or activated. This matters since every process has its own cache: the forecast pool workers
+  serving /predict cannot be reached by the service process that trains the models.
+
+  Attributes:
+  - max_entries: int, maximum number of stored forecasts, least recently used ones are evicted.
+  - hits, prefix_hits, misses, evictions: int, counters exposed by stats().
+  """
+
+  def __init__(self, max_entries=256):
+    self.max_entries = max_entries
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.prefix_hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, machine, kpi, model_version, watermark, mode, horizon):
+    """
+    Looks for a cached forecast covering at least horizon steps.
+
+    :param machine: str, machine identifier.
+    :param kpi: str, KPI name.
+    :param model_version: version of the model the forecast was computed with.
+    :param watermark: timestamp of the last data point the forecast starts from.
+    :param mode: str, the explanation mode of the request.
+    :param horizon: int, number of requested steps.
+    :return: a copy of the first horizon steps of the cached forecast, None on a miss.
+    """
+    key = (machine, kpi, model_version, watermark, mode)
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None or entry['horizon'] < horizon:
+        self.misses += 1
+        return None
+      self._entries.move_to_end(key)
+      if entry['horizon'] == horizon:
+        self.hits += 1
+      else:
+        self.prefix_hits += 1
+      result = entry['result']
+    out = dict(result)
+    for k in STEP_KEYS:
+      if k in result:
+        out[k] = list(result[k][:horizon])
+    return out
+
+  def put(self, machine, kpi, model_version, watermark, mode, horizon, result):
+    """
+    Stores a forecast, replacing the entries of the same series computed with an older
+    model or on older data. A shorter forecast never replaces a longer one.
+
+    :param result: dict, the forecast as returned by make_prediction.
+    """
+    key = (machine, kpi, model_version, watermark, mode)
+    with self._lock:
+      stale = [k for k in self._entries if k[:2] == (machine, kpi) and k[2:4] != (model_version, watermark)]
+      for k in stale:
+        del self._entries[k]
+      entry = self._entries.get(key)
+      if entry is not None and entry['horizon'] >= horizon:
+        self._entries.move_to_end(key)
+        return
+      self._entries[key] = {'horizon': horizon, 'result': {k: v for k, v in result.items() if k != 'Deferred_explanation'}}
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+        self.evictions += 1
+
+  def invalidate(self, machine, kpi):
+    """
+    Drops every cached forecast of a series, e.g. to measure a cold forecast in the benchmark.
+    """
+    with self._lock:
+      for k in [k for k in self._entries if k[:2] == (machine, kpi)]:
+        del self._entries[k]
+
+  def stats(self):
+    """
+    :return: dictionary with the cache size and its hit-rate counters.
+    """
+    with self._lock:
+      lookups = self.hits + self.prefix_hits + self.misses
+      return {
+          'size': len(self._entries),
+          'max_entries': self.max_entries,
+          'hits': self.hits,
+          'prefix_hits': self.prefix_hits,
+          'misses': self.misses,
+          'evictions': self.evictions,
+          'hit_rate': (self.hits + self.prefix_hits) / lookups if lookups else 0.0
+      }
+
+forecast_cache = ForecastCache(int(os.getenv('FORECAST_CACHE_SIZE', 256)))
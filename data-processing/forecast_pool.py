@@ -0,0 +1,199 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from math import ceil
+
+import f_dataprocessing
+import forecast_table
+from forecast_cache import forecast_cache
+from model import ExplanationMode
+
+# Forecasts are CPU bound (XGBoost, bootstrap, LIME): they run in a dedicated pool of
+# processes instead of the thread pool of FastAPI, so they neither fight over the GIL
+# nor starve the other endpoints. The pool admits a bounded number of forecasts: past
+# PREDICT_WORKERS running and PREDICT_QUEUE_DEPTH waiting ones, new requests are refused
+# (429) with an estimate of when to retry, and every request has a deadline.
+
+PREDICT_WORKERS = int(os.getenv('PREDICT_WORKERS', max(1, (os.cpu_count() or 2) - 1)))
+PREDICT_QUEUE_DEPTH = int(os.getenv('PREDICT_QUEUE_DEPTH', 16))
+PREDICT_TIMEOUT = float(os.getenv('PREDICT_TIMEOUT', 120))
+NO_MODEL = 1 # status of forecast_job for a series that has no model yet
+
+class PoolFull(Exception):
+  """
+  Raised when a request would exceed the admission limit of the pool.
+
+  Attributes:
+  - retry_after: int, seconds after which the pool is expected to have room again.
+  """
+
+  def __init__(self, retry_after):
+    super().__init__(f"forecast pool full, retry after {retry_after} s")
+    self.retry_after = retry_after
+
+def _forecast(machine, kpi, horizon, explanation_mode):
+  """
+  Runs in a worker process: forecasts a series with its model. A series without a model is not
+  trained here, it would hold the worker past the deadline of the request: the caller queues its
+  training (see retraining.retrain_queue). Requests without explanations fitting in the materialized
+  horizon are served from the Forecasts table (see forecast_table) while it is up to date.
+
+  :return: tuple of the status (0 if the series was forecast, NO_MODEL if it has no model yet) and
+    the forecast, None on error. Deferred explanations are computed by explanation_job.
+  """
+  if explanation_mode in (ExplanationMode.NONE, ExplanationMode.DEFERRED):
+    # the rollout is seeded, explanation_job explains the same forecast as the stored one
+    stored = forecast_table.stored_forecast(machine, kpi, horizon)
+    if stored is not None:
+      return 0, stored
+  if not f_dataprocessing.check_model_exists(machine, kpi):
+    return NO_MODEL, None
+  result = f_dataprocessing.make_prediction(machine, kpi, horizon, explanation_mode)
+  if result is None:
+    # the stored model has no forecaster (e.g. saved with an unknown type before it was rejected)
+    return -3, None
+  # bound to the explainer of this process, it cannot be sent back
+  result.pop('Deferred_explanation', None)
+  return 0, result
+
+def forecast_job(machine, kpi, horizon, explanation_mode):
+  """
+  Runs in a worker process, see _forecast.
+
+  :return: the status and the forecast of _forecast, and the counters of the forecast cache of the
+    worker: every worker has its own cache, the service only sees it through these reports.
+  """
+  status, result = _forecast(machine, kpi, horizon, explanation_mode)
+  return status, result, dict(forecast_cache.stats(), pid=os.getpid())
+
+def explanation_job(machine, kpi, horizon):
+  """
+  Runs in a worker process: computes the explanations of a forecast requested in deferred mode.
+  The rollout is seeded, so the explained forecast is the one that was returned.
+
+  :return: the list of LIME explanations, one per forecast step
+  """
+  result = f_dataprocessing.make_prediction(machine, kpi, horizon, ExplanationMode.DEFERRED)
+  # ARIMA and the statistical models have no explanation
+  explain = result.get('Deferred_explanation')
+  return explain() if explain is not None else []
+
+class ForecastPool:
+  """
+  Process pool with admission control for the forecasts.
+
+  Attributes:
+  - workers: int, number of worker processes.
+  - max_queue: int, number of admitted forecasts waiting for a worker.
+  - timeout: float, seconds a request waits for its forecasts.
+  """
+
+  def __init__(self, workers = PREDICT_WORKERS, max_queue = PREDICT_QUEUE_DEPTH, timeout = PREDICT_TIMEOUT):
+    self.workers = workers
+    self.max_queue = max_queue
+    self.timeout = timeout
+    self._executor = None
+    self._lock = threading.Lock()
+    self._in_flight = 0
+    self._avg_duration = 5.0 # seconds, moving average of the job durations
+    self.completed = 0
+    self.rejected = 0
+    self.timeouts = 0
+    self._cache_stats = {} # pid -> last forecast cache counters reported by the worker
+
+  def _get_executor(self):
+    # created on first use; spawned workers do not inherit the threads of the service
+    with self._lock:
+      if self._executor is None:
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+      return self._executor
+
+  def _admit(self, n_jobs, force = False):
+    with self._lock:
+      if not force and self._in_flight + n_jobs > self.workers + self.max_queue:
+        self.rejected += 1
+        waves = (self._in_flight + n_jobs - self.workers) / self.workers
+        raise PoolFull(max(1, ceil(waves * self._avg_duration)))
+      self._in_flight += n_jobs
+
+  def _submit(self, fn, args):
+    start = time.monotonic()
+    future = self._get_executor().submit(fn, *args)
+
+    def release(_):
+      # a slot is only freed when the job ends, also when its request gave up waiting
+      with self._lock:
+        self._in_flight -= 1
+        self.completed += 1
+        self._avg_duration = 0.8 * self._avg_duration + 0.2 * (time.monotonic() - start)
+    future.add_done_callback(release)
+    return future
+
+  async def run_all(self, jobs):
+    """
+    Runs a request's jobs in the pool, all of them or none.
+
+    :param jobs: list of (function, args) tuples, the functions must be importable by the workers.
+    :return: the list of the job results, in order.
+    :raise PoolFull: if the jobs would exceed the admission limit.
+    :raise asyncio.TimeoutError: if the jobs did not end within the timeout.
+    """
+    self._admit(len(jobs))
+    futures = [asyncio.wrap_future(self._submit(fn, args)) for fn, args in jobs]
+    try:
+      return await asyncio.wait_for(asyncio.gather(*futures), self.timeout)
+    except asyncio.TimeoutError:
+      with self._lock:
+        self.timeouts += 1
+      raise
+
+  def run_sync(self, fn, *args):
+    """
+    Runs a job of an already accepted request (e.g. a deferred explanation) from a worker
+    thread, bypassing the admission limit. Blocks until the job ends.
+    """
+    self._admit(1, force=True)
+    return self._submit(fn, args).result()
+
+  def record_cache_stats(self, stats):
+    """
+    Keeps the forecast cache counters reported by a worker with its forecast (see forecast_job).
+    """
+    with self._lock:
+      self._cache_stats[stats['pid']] = stats
+
+  def cache_stats(self):
+    """
+    :return: the forecast cache counters summed over the workers, with their overall hit rate.
+    """
+    with self._lock:
+      reported = list(self._cache_stats.values())
+    totals = {k: sum(s[k] for s in reported) for k in ('size', 'max_entries', 'hits', 'prefix_hits', 'misses', 'evictions')}
+    lookups = totals['hits'] + totals['prefix_hits'] + totals['misses']
+    return dict(totals, workers=len(reported),
+                hit_rate=(totals['hits'] + totals['prefix_hits']) / lookups if lookups else 0.0)
+
+  def stats(self):
+    with self._lock:
+      return {
+          'workers': self.workers,
+          'max_queue': self.max_queue,
+          'timeout': self.timeout,
+          'in_flight': self._in_flight,
+          'avg_duration': self._avg_duration,
+          'completed': self.completed,
+          'rejected': self.rejected,
+          'timeouts': self.timeouts
+      }
+
+  def shutdown(self):
+    with self._lock:
+      if self._executor is not None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+      self._cache_stats = {}
+
+forecast_pool = ForecastPool()
@@ -0,0 +1,170 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import f_dataprocessing
+import statistical_forecasters
+from f_dataprocessing import GLOBAL_MACHINE, FORECAST_TABLE_HORIZON
+from model import ExplanationMode
+from statistical_forecasters import STATISTICAL_MODELS
+from storage.storage_operations import (list_models_from_storage, fetch_models_from_storage, get_active_model_version,
+                                        save_forecasts, get_stored_forecast)
+
+# Materialized forecasts: a batch job forecasts FORECAST_TABLE_HORIZON steps of every series with an
+# active model and stores them in the Forecasts table of Postgres, one row per step. The data of the
+# whole fleet is loaded with a few bulk queries, the statistical models are forecast in batches of
+# series and the machines covered only by a global model with one batched call per step.
+# /predict serves the requests fitting in the stored horizon from the table, and the monitoring reads
+# the expected value of a new data point with a single lookup. A stored forecast is only served while
+# it was made by the active model version on the last data point of the series.
+
+FORECAST_TABLE_WORKERS = int(os.getenv('FORECAST_TABLE_WORKERS', 4)) # boosters and ARIMA models forecast concurrently
+
+def _row(machine, kpi, version, last_observed, forecast):
+  return dict(forecast, KPI=kpi, MachineName=machine, ModelVersion=version or '', LastObserved=last_observed)
+
+def _statistical_rows(entries, series, horizon):
+  """
+  :param entries: list of (machine, kpi, version, model_info) of the series with a statistical model
+  :return: the rows of their forecasts, all the series of a model forecast at once
+  """
+  rows = []
+  kept, values_list = [], []
+  for machine, kpi, version, model_info in entries:
+    times, values = f_dataprocessing.load_series(machine, kpi, series[(machine, kpi)])
+    if len(values) == 0:
+      continue
+    kept.append((machine, kpi, version, model_info, times[-1]))
+    values_list.append(values)
+  if len(kept) == 0:
+    return rows
+  forecasts = statistical_forecasters.predict_many([entry[3] for entry in kept], values_list, horizon)
+  for (machine, kpi, version, _, last_time), (mean, half) in zip(kept, forecasts):
+    last_day = datetime.strptime(last_time, "%Y-%m-%dT%H:%M:%S.%fZ")
+    rows.append(_row(machine, kpi, version, last_time, {
+        'Predicted_value': mean.tolist(),
+        'Lower_bound': (mean - half).tolist(),
+        'Upper_bound': (mean + half).tolist(),
+        'Confidence_score': [0.95] * horizon,
+        'Date_prediction': [(last_day + timedelta(days=h + 1)).strftime("%Y-%m-%d") for h in range(horizon)]
+    }))
+  return rows
+
+def _model_rows(entries, series, horizon, max_workers):
+  """
+  :param entries: list of (machine, kpi, version) of the series with a booster or an ARIMA model
+  :return: the rows of their forecasts, made by make_prediction on the series already loaded
+  """
+  def forecast(entry):
+    machine, kpi, version = entry
+    times, _ = series[(machine, kpi)]
+    if len(times) == 0:
+      return None
+    result = f_dataprocessing.make_prediction(machine, kpi, horizon, ExplanationMode.NONE, series=series[(machine, kpi)])
+    return _row(machine, kpi, version, times[-1], result)
+
+  rows = []
+  with ThreadPoolExecutor(max_workers=max_workers) as pool:
+    futures = {pool.submit(forecast, entry): entry for entry in entries}
+    for future, (machine, kpi, _) in futures.items():
+      try:
+        row = future.result()
+      except Exception as e:
+        print(f"Forecast of {machine}, {kpi} for the table failed: {e}")
+        continue
+      if row is not None:
+        rows.append(row)
+  return rows
+
+def _global_rows(global_models, machines_per_kpi, series, horizon):
+  """
+  :param global_models: dictionary kpi -> entry of list_models_from_storage of its global model
+  :param machines_per_kpi: dictionary kpi -> machines without a model of their own
+  :return: the rows of the forecasts of the machines covered by the global models
+  """
+  rows = []
+  for kpi, machines in machines_per_kpi.items():
+    try:
+      results = f_dataprocessing.make_fleet_prediction(kpi, machines, horizon, series=series)
+    except Exception as e:
+      print(f"Fleet forecast of {kpi} for the table failed: {e}")
+      continue
+    for machine, result in results.items():
+      times, _ = series[(machine, kpi)]
+      rows.append(_row(machine, kpi, global_models[kpi]['Version'], times[-1], result))
+  return rows
+
+def materialize_forecasts(horizon = FORECAST_TABLE_HORIZON, machines = None, max_workers = FORECAST_TABLE_WORKERS):
+  """
+  Forecasts the series with an active model and replaces their rows in the Forecasts table.
+  Blocking, meant to run off the event loop after the monitoring pass.
+
+  :param horizon: int, number of steps stored per series.
+  :param machines: list of machines to forecast, all of them if None. The machines covered by a
+    global model are forecast with it when they have no model of their own.
+  :param max_workers: int, number of boosters and ARIMA models forecast concurrently.
+  :return: number of series stored.
+  """
+  if horizon <= 0:
+    return 0
+  models = list_models_from_storage()
+  if machines is not None:
+    machines = set(machines)
+  global_models = {m['KPI']: m for m in models if m['MachineName'] == GLOBAL_MACHINE}
+  own = [m for m in models if m['MachineName'] != GLOBAL_MACHINE and (machines is None or m['MachineName'] in machines)]
+  with_model = {(m['MachineName'], m['KPI']) for m in own}
+
+  # the global models are needed to know which machines they cover
+  fetched = fetch_models_from_storage(own + list(global_models.values()))
+  statistical, boosted, machines_per_kpi = [], [], {}
+  for m in fetched:
+    model_info = m['Data'].get('model', {})
+    if m['MachineName'] == GLOBAL_MACHINE:
+      covered = [machine for machine in model_info.get('machines', [])
+                 if (machine, m['KPI']) not in with_model and (machines is None or machine in machines)]
+      if covered:
+        machines_per_kpi[m['KPI']] = covered
+    elif model_info.get('name') in STATISTICAL_MODELS:
+      statistical.append((m['MachineName'], m['KPI'], m['Version'], model_info))
+    else:
+      boosted.append((m['MachineName'], m['KPI'], m['Version']))
+
+  keys = [(machine, kpi) for machine, kpi, *_ in statistical + boosted]
+  keys += [(machine, kpi) for kpi, covered in machines_per_kpi.items() for machine in covered]
+  if len(keys) == 0:
+    return 0
+  series = f_dataprocessing.data_load_bulk(keys)
+
+  rows = _statistical_rows(statistical, series, horizon)
+  rows += _model_rows(boosted, series, horizon, max_workers)
+  rows += _global_rows(global_models, machines_per_kpi, series, horizon)
+  stored = save_forecasts(rows)
+  print(f"Forecast table: {len(rows)} of {len(keys)} series forecast, {stored} rows stored")
+  return len(rows) if stored > 0 else 0
+
+def stored_forecast(machine, kpi, length):
+  """
+  Returns the materialized forecast of a series, if it is still the one its model would make now.
+
+  :param machine: str, machine identifier.
+  :param kpi: str, KPI name.
+  :param length: int, number of steps requested.
+  :return: dictionary with the keys of make_prediction (no LIME explanation), None if the request does
+    not fit in the stored horizon, or if the forecast is older than the model or the data.
+  """
+  if length > FORECAST_TABLE_HORIZON:
+    return None
+  stored = get_stored_forecast(kpi, machine, length)
+  if stored is None:
+    return None
+  try:
+    active = get_active_model_version(kpi, machine) or get_active_model_version(kpi, GLOBAL_MACHINE)
+  except Exception as e:
+    print("Error reading the active model version:", e)
+    return None
+  if active is None or (active[1] or '') != stored.pop('ModelVersion'):
+    return None
+  last_time, _ = f_dataprocessing.data_load_latest(machine, kpi)
+  if last_time != stored.pop('LastObserved'):
+    return None
+  return stored
@@ -0,0 +1,238 @@
+import os
+import threading
+import time
+from collections import Counter
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+import requests
+
+import f_dataprocessing
+import statistical_forecasters
+from storage.storage_operations import get_stored_forecasts
+
+# Aggregate forecasts of a KPI for the machine types of the KB and for the whole plant.
+# The hierarchy is plant -> machine types (the main classes of /kb/retrieveMachines) -> machines.
+# No model is run for a request: the per-machine forecasts are read from the Forecasts table
+# (see forecast_table) and reconciled up the hierarchy, either bottom-up (sums of the machine
+# forecasts) or with MinT (the aggregates also get a base forecast, by the numpy statistical
+# models on their history, and all the levels are combined with the minimum trace weights).
+# The intervals are combined with the covariance of the forecast errors: per-step standard
+# deviations from the stored intervals, correlations between the series from their recent history.
+
+PLANT = 'all' # name of the root of the hierarchy, all the machines of the plant
+RECONCILIATION_METHODS = ('bottom_up', 'mint')
+AGGREGATIONS = ('sum', 'mean')
+HIERARCHY_TTL = int(os.getenv('HIERARCHY_TTL', 3600)) # seconds the machine hierarchy and the error correlations are kept
+HIERARCHY_WINDOW = int(os.getenv('HIERARCHY_WINDOW', 90)) # days of history the correlations are estimated on
+HIERARCHY_SHRINKAGE = float(os.getenv('HIERARCHY_SHRINKAGE', 0.5)) # weight of the identity in the shrunk correlations
+HIERARCHY_CONFIDENCE = 0.95 # coverage of the aggregate intervals
+
+_hierarchy = None # (expiry time, dictionary machine type -> machines)
+_history_cache = {} # (kpi, machines, summing matrix) -> (expiry time, last observed, node histories, correlations)
+_cache_lock = threading.Lock()
+
+def machine_groups(api_key):
+  """
+  Loads the machines of the KB grouped by machine type, cached for HIERARCHY_TTL seconds.
+
+  :param api_key: the authentication key for the KB.
+  :return: dictionary machine type -> sorted list of machine names
+  """
+  global _hierarchy
+  with _cache_lock:
+    if _hierarchy is not None and _hierarchy[0] > time.monotonic():
+      return _hierarchy[1]
+  url_KB = f"http://kb:8000/kb/retrieveMachines"
+  response = requests.get(url_KB, headers={"x-api-key": api_key})
+  response.raise_for_status()
+  groups = {group: sorted(machines) for group, machines in response.json().items() if isinstance(machines, dict) and machines}
+  with _cache_lock:
+    _hierarchy = (time.monotonic() + HIERARCHY_TTL, groups)
+  return groups
+
+def summing_matrix(groups, aggregation = 'sum', root = True):
+  """
+  :param groups: dictionary group -> machines, the groups of the hierarchy below the root
+  :param aggregation: 'sum' or 'mean' of the machines of every aggregate
+  :param root: bool, the hierarchy has a PLANT node above the groups
+  :return: the node names (the root, the groups, then the machines) and the matrix S of shape
+    (n_nodes, n_machines) giving every node from the machines
+  """
+  machines = sorted({machine for members in groups.values() for machine in members})
+  column = {machine: j for j, machine in enumerate(machines)}
+  aggregates = ([(PLANT, machines)] if root else []) + sorted(groups.items())
+  S = np.zeros((len(aggregates) + len(machines), len(machines)))
+  for i, (_, members) in enumerate(aggregates):
+    S[i, [column[machine] for machine in members]] = 1.0 / len(members) if aggregation == 'mean' else 1.0
+  S[len(aggregates):] = np.eye(len(machines))
+  return [name for name, _ in aggregates] + machines, S
+
+def shrunk_correlation(histories, shrinkage = HIERARCHY_SHRINKAGE):
+  """
+  Correlation of the one-step errors of a naive forecast (the daily changes) of the nodes, shrunk
+  towards the identity so it stays well conditioned with a short history.
+
+  :param histories: np.ndarray (n_nodes, T), aligned histories of the nodes
+  :return: np.ndarray (n_nodes, n_nodes)
+  """
+  if histories.shape[1] < 4:
+    return np.eye(len(histories))
+  changes = np.diff(histories, axis=1)
+  std = changes.std(axis=1)
+  centered = changes - changes.mean(axis=1, keepdims=True)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    correlation = (centered @ centered.T) / changes.shape[1] / np.outer(std, std)
+  correlation = np.nan_to_num(correlation, nan=0.0)
+  np.fill_diagonal(correlation, 1.0)
+  return (1 - shrinkage) * correlation + shrinkage * np.eye(len(histories))
+
+def reconcile(S, base, sigma, correlation, method = 'bottom_up'):
+  """
+  Reconciles the base forecasts of a hierarchy, step by step.
+
+  :param S: np.ndarray (n_nodes, n_bottom), summing matrix, the bottom series are the last n_bottom nodes
+  :param base: np.ndarray (n_nodes, horizon), base forecasts. Bottom-up only uses the bottom rows.
+  :param sigma: np.ndarray (n_nodes, horizon), standard deviations of the base forecast errors
+  :param correlation: np.ndarray (n_nodes, n_nodes), correlations of the base forecast errors
+  :param method: 'bottom_up' or 'mint'
+  :return: reconciled forecasts and their standard deviations, both np.ndarray (n_nodes, horizon)
+  """
+  n_nodes, n_bottom = S.shape
+  bottom = slice(n_nodes - n_bottom, n_nodes)
+  mean = np.empty((n_nodes, base.shape[1]))
+  std = np.empty((n_nodes, base.shape[1]))
+  for h in range(base.shape[1]):
+    if method == 'bottom_up':
+      W = correlation[bottom, bottom] * np.outer(sigma[bottom, h], sigma[bottom, h])
+      mean[:, h] = S @ base[bottom, h]
+      variance = np.einsum('ij,jk,ik->i', S, W, S)
+    elif method == 'mint':
+      # a zero width would make the weights singular, it is floored to a tiny fraction of the largest
+      step_sigma = np.maximum(sigma[:, h], 1e-6 * max(sigma[:, h].max(), 1e-12))
+      W = correlation * np.outer(step_sigma, step_sigma)
+      W_inv = np.linalg.pinv(W)
+      G = np.linalg.pinv(S.T @ W_inv @ S) @ S.T @ W_inv
+      SG = S @ G
+      mean[:, h] = SG @ base[:, h]
+      variance = np.einsum('ij,jk,ik->i', SG, W, SG)
+    else:
+      raise ValueError(f"Unknown reconciliation method {method}")
+    std[:, h] = np.sqrt(np.clip(variance, 0.0, None))
+  return mean, std
+
+def node_histories(kpi, machines, S, last_observed):
+  """
+  Aligned histories of all the nodes and the correlations of their errors, cached until the stored
+  forecasts are refreshed or for HIERARCHY_TTL seconds.
+
+  :param machines: list of the machines, in the order of the columns of S
+  :param last_observed: key of the stored forecasts, the cache entry is dropped when it changes
+  :return: np.ndarray (n_nodes, T) of the histories and np.ndarray (n_nodes, n_nodes) of the correlations
+  """
+  key = (kpi, tuple(machines), S.tobytes())
+  with _cache_lock:
+    entry = _history_cache.get(key)
+    if entry is not None and entry[0] > time.monotonic() and entry[1] == last_observed:
+      return entry[2], entry[3]
+
+  loaded = f_dataprocessing.data_load_bulk([(machine, kpi) for machine in machines])
+  columns = {}
+  for machine in machines:
+    times, values = loaded[(machine, kpi)]
+    columns[machine] = pd.Series(values, index=pd.to_datetime(times)).groupby(level=0).last()
+  frame = pd.DataFrame(columns).sort_index().tail(HIERARCHY_WINDOW)
+  # the gaps of a machine are interpolated as by data_clean_missing_values, the dates no machine has are dropped
+  frame = frame.interpolate(method='linear', limit_direction='both').dropna()
+  histories = S @ frame[machines].to_numpy(dtype=float).T
+  correlation = shrunk_correlation(histories)
+  with _cache_lock:
+    _history_cache[key] = (time.monotonic() + HIERARCHY_TTL, last_observed, histories, correlation)
+  return histories, correlation
+
+def aggregate_forecast(kpi, horizon, group = PLANT, method = 'bottom_up', aggregation = 'sum', api_key = None):
+  """
+  Forecasts a KPI for a machine type, or for the whole plant and every machine type, from the stored
+  per-machine forecasts.
+
+  :param kpi: str, KPI name.
+  :param horizon: int, number of steps, at most FORECAST_TABLE_HORIZON.
+  :param group: str, PLANT or a machine type of the KB.
+  :param method: str, 'bottom_up' or 'mint'.
+  :param aggregation: str, 'sum' or 'mean' of the machines.
+  :param api_key: the authentication key for the KB, the my_key environment variable if None.
+  :return: list of dictionaries, one per aggregate of the group (the group itself and, for PLANT, every
+    machine type), with 'Group', 'Machines', 'Missing_machines' and the forecast keys of make_prediction
+  :raise ValueError: if the request is invalid or no machine of the group has a stored forecast.
+  """
+  if method not in RECONCILIATION_METHODS:
+    raise ValueError(f"unknown reconciliation method {method}, use one of {', '.join(RECONCILIATION_METHODS)}")
+  if aggregation not in AGGREGATIONS:
+    raise ValueError(f"unknown aggregation {aggregation}, use one of {', '.join(AGGREGATIONS)}")
+  if horizon <= 0 or horizon > f_dataprocessing.FORECAST_TABLE_HORIZON:
+    raise ValueError(f"the horizon must be between 1 and {f_dataprocessing.FORECAST_TABLE_HORIZON} days")
+  groups = machine_groups(api_key if api_key is not None else os.getenv('my_key'))
+  if group != PLANT:
+    if group not in groups:
+      raise ValueError(f"unknown machine type {group}")
+    groups = {group: groups[group]}
+
+  requested = sorted({machine for members in groups.values() for machine in members})
+  stored = get_stored_forecasts(kpi, requested, horizon)
+  # the machines forecast from another day than most of them are left out, their steps would not line up
+  start = Counter(f['Date_prediction'][0] for f in stored.values()).most_common(1)
+  stored = {m: f for m, f in stored.items() if start and f['Date_prediction'][0] == start[0][0]}
+  if len(stored) == 0:
+    raise ValueError(f"no stored forecast of {kpi} for the machines of {group}")
+  requested_groups = groups
+  groups = {name: [m for m in members if m in stored] for name, members in groups.items()}
+  groups = {name: members for name, members in groups.items() if members}
+
+  nodes, S = summing_matrix(groups, aggregation, root=group == PLANT)
+  machines = nodes[len(nodes) - S.shape[1]:]
+  n_aggregates = len(nodes) - len(machines)
+  z = NormalDist().inv_cdf(0.5 + HIERARCHY_CONFIDENCE / 2)
+  last_observed = max(stored[m]['LastObserved'] for m in machines)
+  histories, correlation = node_histories(kpi, machines, S, last_observed)
+
+  base = np.zeros((len(nodes), horizon))
+  sigma = np.zeros((len(nodes), horizon))
+  # error growth of a random walk, for the steps with no interval stored
+  fallback = np.diff(histories, axis=1).std(axis=1)[:, None] * np.sqrt(np.arange(1, horizon + 1)) \
+      if histories.shape[1] > 2 else np.zeros((len(nodes), horizon))
+  for i, machine in enumerate(machines, start=n_aggregates):
+    f = stored[machine]
+    base[i] = f['Predicted_value']
+    confidence = np.array(f['Confidence_score'], dtype=float)
+    half = (np.array(f['Upper_bound'], dtype=float) - np.array(f['Lower_bound'], dtype=float)) / 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+      step_sigma = half / np.array([NormalDist().inv_cdf(0.5 + c / 2) if 0 < c < 1 else np.nan for c in confidence])
+    sigma[i] = np.where(np.isfinite(step_sigma) & (step_sigma > 0), step_sigma, fallback[i])
+  if method == 'mint':
+    if histories.shape[1] < 2:
+      raise ValueError(f"not enough common history of the machines of {group} for MinT, use bottom_up")
+    # base forecasts of the aggregates, by the statistical model with the best backtest on their history
+    aggregate_histories = list(histories[:n_aggregates])
+    selected = statistical_forecasters.select(aggregate_histories)
+    infos = [dict(s['params'][s['name']], name=s['name']) for s in selected]
+    for i, (mean, half) in enumerate(statistical_forecasters.predict_many(infos, aggregate_histories, horizon, HIERARCHY_CONFIDENCE)):
+      base[i] = mean
+      sigma[i] = half / z
+
+  mean, std = reconcile(S, base, sigma, correlation, method)
+  dates = stored[machines[0]]['Date_prediction']
+  out = []
+  for i, name in enumerate(nodes[:n_aggregates]):
+    members = machines if name == PLANT else groups[name]
+    out.append({
+        'Group': name,
+        'Machines': members,
+        'Missing_machines': sorted(set(requested if name == PLANT else requested_groups[name]) - set(members)),
+        'Predicted_value': mean[i].tolist(),
+        'Lower_bound': (mean[i] - z * std[i]).tolist(),
+        'Upper_bound': (mean[i] + z * std[i]).tolist(),
+        'Confidence_score': [HIERARCHY_CONFIDENCE] * horizon,
+        'Date_prediction': dates
+    })
+  return out
@@ -1,16 +1,28 @@
 import f_dataprocessing
+import monitoring
 import uvicorn
 
-from storage.storage_operations import retrieve_all_models_from_storage
+from storage.storage_operations import list_models_from_storage, fetch_models_from_storage, list_model_versions, activate_model_version
+from storage.postgres_client import check_postgres, close_postgres_pool
+from storage.minio_client import check_minio
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI, Depends, BackgroundTasks, HTTPException
 import os
 import datetime
 import asyncio
 
 from api_auth.api_auth import get_verify_api_key
 
-from model import Json_out, Json_in, Json_out_el, LimeExplainationItem, Severity
+from model import Json_out, Json_in, Json_out_el, LimeExplainationItem, Severity, ExplanationMode, ModelType, Json_explanation, Json_aggregate, Json_aggregate_el
+from explanation_store import explanation_store
+from forecast_cache import forecast_cache
+from retraining import retrain_queue
+from forecast_pool import forecast_pool, forecast_job, explanation_job, PoolFull, NO_MODEL
+from forecast_table import materialize_forecasts
+import hierarchy
+from backends import preload, backend_stats
+from alert_outbox import alert_outbox
+from functools import partial
 from dotenv import load_dotenv
 from pathlib import Path
 from typing import List
@@ -52,23 +64,39 @@ async def task_scheduler():
         'recipients': alertList["Recipients"][i],
         'severity': alertList["severity"][i]
         }
-        send_dummy_alert(alert_data)
+        send_dummy_alert(alert_data) # only queued, the outbox sends it
         i+=1
             
-        # new_data_polling()
-        # await asyncio.sleep(86400)
-        
         # await asyncio.sleep(10)
-            
+
+async def monitoring_scheduler():
+    """Runs the daily fleet monitoring in a worker thread, so the event loop keeps serving requests,
+    then refreshes the materialized forecasts with the new data points"""
+    interval = int(os.getenv('MONITORING_INTERVAL', 86400))
+    while True:
+        await asyncio.sleep(interval)
+        await asyncio.to_thread(new_data_polling)
+        await asyncio.to_thread(refresh_forecast_table)
 
 async def lifespan(app: FastAPI):
     """Lifespan context manager to start and stop the scheduler"""
     scheduler_task = asyncio.create_task(task_scheduler())
+    monitoring_task = asyncio.create_task(monitoring_scheduler())
+    preload() # the frameworks listed in BACKENDS_PRELOAD, in background
+    await alert_outbox.start()
     try:
         yield
     finally:
-        scheduler_task.cancel()
-        await scheduler_task
+        for task in (scheduler_task, monitoring_task):
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        retrain_queue.shutdown()
+        forecast_pool.shutdown()
+        await alert_outbox.shutdown() # after the tasks that queue alerts
+        close_postgres_pool()
 
 app = FastAPI(lifespan = lifespan)
 
@@ -92,17 +120,61 @@ def hello_world():
 def hello_world(api_key: str = Depends(get_verify_api_key(["ai-agent","api-layer"]))):
     return 'Hello private World :)'
 
+@app.get("/data-processing/health")
+def health():
+    """
+    return the status and the pool settings of the storage connections
+    """
+    storage = {'postgres': check_postgres(), 'minio': check_minio()}
+    return {'status': 'ok' if all(s['status'] == 'ok' for s in storage.values()) else 'degraded', **storage}
+
+@app.get("/data-processing/backends")
+def backends(api_key: str = Depends(get_verify_api_key(["ai-agent","api-layer"]))):
+    """
+    return which forecasting frameworks have been loaded, and how long their import took
+    """
+    return backend_stats()
+
 @app.get("/data-processing/retrieve_models")
 def retrieve_models(api_key: str = Depends(get_verify_api_key(["ai-agent","api-layer"]))):
     """
-    print and return the list of the existing forecast models
+    print and return the list of the existing forecast models, with their training date,
+    version and size. Only the model registry is read, use fetch_models for the model data.
     """
-    availableModels = retrieve_all_models_from_storage()
+    availableModels = list_models_from_storage()
     print("The following models have already been created:")
     for m in availableModels:
         print(f"model for {m['MachineName']}, {m['KPI']}")
     return availableModels
 
+@app.post("/data-processing/fetch_models")
+def fetch_models(JSONS: Json_in, api_key: str = Depends(get_verify_api_key(["ai-agent","api-layer"]))):
+    """
+    return the stored data of the requested models, downloaded concurrently
+
+    args:
+    JSONS: the list of machine/kpi whose model is requested
+    """
+    requested = {(json_in.Machine_Name, json_in.KPI_Name) for json_in in JSONS.value}
+    models = [m for m in list_models_from_storage() if (m['MachineName'], m['KPI']) in requested]
+    return fetch_models_from_storage(models)
+
+@app.get("/data-processing/model_versions")
+def model_versions(machine: str, kpi: str, api_key: str = Depends(get_verify_api_key(["ai-agent","api-layer"]))):
+    """
+    return the stored versions of the model of a machine/KPI, the newest first
+    """
+    return list_model_versions(kpi, machine)
+
+@app.post("/data-processing/model_versions/activate")
+def activate_version(machine: str, kpi: str, version: str, api_key: str = Depends(get_verify_api_key(["ai-agent","api-layer"]))):
+    """
+    make a stored version the one used for the predictions of a machine/KPI, e.g. to roll back a retraining
+    """
+    # the cached forecasts are keyed by model version, the ones of the other versions are never served
+    activated = activate_model_version(kpi, machine, version)
+    return {'Machine_name': machine, 'KPI_name': kpi, 'Version': version, 'Status': 'active' if activated else 'unknown'}
+
 @app.post("/data-processing/train_models")
 def train_selected_models(JSONS: Json_in,api_key: str = Depends(get_verify_api_key(["ai-agent","api-layer"]))):
     """
@@ -111,28 +183,35 @@ def train_selected_models(JSONS: Json_in,api_key: str = Depends(get_verify_api_k
     args:
     JSONS: the list of machine/kpi the user wishes to use
     """
-    n_models = len(JSONS.value)
-
-    print(f"Starting training for the {n_models} requested models. this may take a while...")
-    curr_model = 1
-    for json_in in JSONS.value:
-        f_dataprocessing.characterize_KPI(json_in.Machine_Name,json_in.KPI_Name )
-        print(f"{curr_model} model created of {n_models}")
-        curr_model+=1
-    print("all models created succesfully")
+    # the data of all the series is loaded with a few bulk queries, then the models are trained
+    # by a small pool of workers. The elements asking for a global model are trained together, one model per KPI
+    requests = [(json_in.Machine_Name, json_in.KPI_Name, json_in.Model_type.value) for json_in in JSONS.value]
+    print(f"Starting training for the {len(requests)} requested models. this may take a while...")
+    statuses = f_dataprocessing.characterize_many(requests)
+    failed = [key for key, status in statuses.items() if status != 0]
+    for machine, kpi in failed:
+        print(f"model for {machine}, {kpi} could not be created")
+    print(f"{len(statuses) - len(failed)} models created of {len(statuses)}")
 
 # ACTUAL PREDICTIONS
 @app.post("/data-processing/predict", response_model = Json_out)
-def predict(JSONS: Json_in, api_key: str = Depends(get_verify_api_key(["ai-agent","api-layer"]))): # to add or modify the services allowed to access the API, add or remove them from the list in the get_verify_api_key function e.g. get_verify_api_key(["gui", "service1", "service2"])
+async def predict(JSONS: Json_in, background_tasks: BackgroundTasks, api_key: str = Depends(get_verify_api_key(["ai-agent","api-layer"]))): # to add or modify the services allowed to access the API, add or remove them from the list in the get_verify_api_key function e.g. get_verify_api_key(["gui", "service1", "service2"])
     """
         given a series of couple MACHINE-KPI and an integer value N, this function predicts
         the next N data points given a certain trained model. If the model does not exist yet
-        it is created, trained, and stored in json format for future use.
+        its training (with the requested Model_type) is queued in background and the element
+        returns an Error_message asking to retry once the model is stored: the first request of a
+        series without a model, and the ones made while it trains, get no forecast. When the training
+        cannot succeed (constant series or no data, too little data to fit a model) the following
+        requests get that error instead, and the series is not queued again for RETRAIN_FAILED_TTL seconds.
         This function also returns explainability results to help the user understand how certain
         we are about the given prediction.
+        The forecasts run in the bounded process pool of forecast_pool: when it is full the request
+        is refused with 429 and a Retry-After header, when it takes longer than PREDICT_TIMEOUT with 504.
 
         Args:
-        JSONS: the list of tuples to be used for prediction
+        JSONS: the list of tuples to be used for prediction, each one can set its Explanation_mode
+        background_tasks: used to compute the deferred explanations after the response is sent
         api_key: authentication to allow only selected container to access this function
 
         Returns:
@@ -147,10 +226,12 @@ def predict(JSONS: Json_in, api_key: str = Depends(get_verify_api_key(["ai-agent
         Measure_unit: str -> unit of the KPI
         Date_prediction: List[str] -> list of dates regarding the predicted values
         Forecast: bool
+        Prediction_id: str -> only for deferred explanations, the id to fetch them with
     """
     out_dicts = []
     if len(JSONS.value) != 0:
         print(f"received a list of {len(JSONS.value)} KPIs to predict")
+        forecasts = [] # elements to forecast, with their KPI information
         for json_in in JSONS.value:
             
             machine = json_in.Machine_Name#['Machine_Name'] #direttamente valore DB
@@ -171,7 +252,7 @@ def predict(JSONS: Json_in, api_key: str = Depends(get_verify_api_key(["ai-agent
             if json_in.Date_prediction is not None:
 
                 API_key = os.getenv('my_key')
-                KPI_data = f_dataprocessing.kpi_exists(machine,KPI_Name, API_key)
+                KPI_data = await asyncio.to_thread(f_dataprocessing.kpi_exists, machine, KPI_Name, API_key)
                 if KPI_data['Status'] == 0:
                     print('the KPI exists')
                     if KPI_data['forecastable'] == True:
@@ -181,32 +262,7 @@ def predict(JSONS: Json_in, api_key: str = Depends(get_verify_api_key(["ai-agent
                         # delta = req_date - today
                         # horizon = delta.days() 
                         if horizon > 0:
-                            
-                            status = 0
-                            if not f_dataprocessing.check_model_exists(machine,KPI_Name):
-                                print(f"Creating model for {machine},{KPI_Name}")
-                                status = f_dataprocessing.characterize_KPI(machine,KPI_Name)
-                            if status == 0:
-                                result = f_dataprocessing.make_prediction(machine, KPI_Name, horizon)
-                                print(f"the output data is: {result['Predicted_value']}")
-
-                                json_out_el.Predicted_value = result['Predicted_value']
-                                json_out_el.Lower_bound = result['Lower_bound']
-                                json_out_el.Upper_bound = result['Upper_bound']
-                                json_out_el.Measure_unit = KPI_data["unit_measure"]
-                                json_out_el.Confidence_score = result['Confidence_score']
-
-                                Lime_exp = []
-                                for exp in result['Lime_explaination']:
-                                    Lime_exp.append([LimeExplainationItem(date_info=item[0], value=item[1]) for item in exp])
-                                json_out_el.Lime_explaination = Lime_exp
-                                json_out_el.Date_prediction = result['Date_prediction']  
-                            else:
-                                if status == -1:
-                                    json_out_el.Error_message = 'Error: the time-series is constant, forecast is meaningless'
-                                else:
-                                    json_out_el.Error_message = 'Error: could not preprocess the data'
-
+                            forecasts.append((json_out_el, json_in, KPI_data))
                         else:
                             json_out_el.Error_message = 'Error: invalid selected date for forecast'
                     else:
@@ -216,6 +272,58 @@ def predict(JSONS: Json_in, api_key: str = Depends(get_verify_api_key(["ai-agent
                 out_dicts.append(json_out_el)
             else:
                 json_out_el.Error_message = f'Error:, no date received for the prediction'
+        if len(forecasts) != 0:
+            jobs = [(forecast_job, (json_in.Machine_Name, json_in.KPI_Name, json_in.Date_prediction, json_in.Explanation_mode))
+                    for _, json_in, _ in forecasts]
+            try:
+                outcomes = await forecast_pool.run_all(jobs)
+            except PoolFull as e:
+                raise HTTPException(status_code=429, detail="Too many forecasts in progress, retry later",
+                                    headers={"Retry-After": str(e.retry_after)})
+            except asyncio.TimeoutError:
+                raise HTTPException(status_code=504, detail="The forecast took too long")
+            for (json_out_el, json_in, KPI_data), (status, result, cache_stats) in zip(forecasts, outcomes):
+                forecast_pool.record_cache_stats(cache_stats)
+                if status == 0:
+                    print(f"the output data is: {result['Predicted_value']}")
+
+                    json_out_el.Predicted_value = result['Predicted_value']
+                    json_out_el.Lower_bound = result['Lower_bound']
+                    json_out_el.Upper_bound = result['Upper_bound']
+                    json_out_el.Measure_unit = KPI_data["unit_measure"]
+                    json_out_el.Confidence_score = result['Confidence_score']
+
+                    Lime_exp = []
+                    for exp in result['Lime_explaination']:
+                        Lime_exp.append([LimeExplainationItem(date_info=item[0], value=item[1]) for item in exp])
+                    json_out_el.Lime_explaination = Lime_exp
+                    if json_in.Explanation_mode == ExplanationMode.DEFERRED:
+                        prediction_id = explanation_store.reserve()
+                        background_tasks.add_task(explanation_store.compute, prediction_id,
+                                                  partial(forecast_pool.run_sync, explanation_job, json_in.Machine_Name,
+                                                          json_in.KPI_Name, json_in.Date_prediction))
+                        json_out_el.Prediction_id = prediction_id
+                    json_out_el.Date_prediction = result['Date_prediction']  
+                else:
+                    if status == NO_MODEL:
+                        # trained in background, once, however many requests ask for it meanwhile.
+                        # A global model is only trained through train_models, here the series gets its own
+                        model_type = 'xgboost' if json_in.Model_type == ModelType.XGBOOST_GLOBAL else json_in.Model_type.value
+                        training_status = retrain_queue.training_status(json_in.Machine_Name, json_in.KPI_Name)
+                        if training_status == -1:
+                            json_out_el.Error_message = 'Error: the time-series is constant or empty, forecast is meaningless'
+                        elif training_status == -2:
+                            json_out_el.Error_message = 'Error: the time-series has too little data to train a model'
+                        elif training_status == -3:
+                            json_out_el.Error_message = 'Error: the model of the series has an unknown type'
+                        elif retrain_queue.submit(json_in.Machine_Name, json_in.KPI_Name, float('inf'), model_type=model_type):
+                            json_out_el.Error_message = 'Error: the model of the series is being trained, retry later'
+                        else:
+                            json_out_el.Error_message = 'Error: the series has no model and the training queue is full, retry later'
+                    elif status == -3:
+                        json_out_el.Error_message = 'Error: the model of the series has an unknown type'
+                    else:
+                        json_out_el.Error_message = 'Error: could not preprocess the data'
         json_out = Json_out(
         value=out_dicts
         )
@@ -241,28 +349,193 @@ def predict(JSONS: Json_in, api_key: str = Depends(get_verify_api_key(["ai-agent
         )
         return json_out.dict()
         
+@app.post("/data-processing/predict_fleet", response_model = Json_out)
+def predict_fleet(JSONS: Json_in, api_key: str = Depends(get_verify_api_key(["ai-agent","api-layer"]))):
+    """
+        forecasts many machines at once with the global models of their KPIs: the elements are
+        grouped by KPI and horizon and each group is predicted with one batched model call per step.
+        No LIME explanation is returned, elements not covered by a global model get an error message.
+
+        Args:
+        JSONS: the list of tuples to be used for prediction
+        api_key: authentication to allow only selected container to access this function
+
+        Returns:
+        the same list of dictionaries returned by /data-processing/predict
+    """
+    API_key = os.getenv('my_key')
+    groups = {}
+    out_dicts = []
+    for json_in in JSONS.value:
+        json_out_el = Json_out_el(
+            Machine_Name=json_in.Machine_Name,
+            KPI_Name=json_in.KPI_Name,
+            Predicted_value=[],
+            Lower_bound=[],
+            Upper_bound=[],
+            Confidence_score=[],
+            Lime_explaination=[],
+            Measure_unit="",
+            Date_prediction=[],
+            Error_message="",
+            Forecast=True
+        )
+        out_dicts.append(json_out_el)
+        if json_in.Date_prediction is None or json_in.Date_prediction <= 0:
+            json_out_el.Error_message = 'Error: invalid selected date for forecast'
+            continue
+        KPI_data = f_dataprocessing.kpi_exists(json_in.Machine_Name, json_in.KPI_Name, API_key)
+        if KPI_data['Status'] != 0:
+            json_out_el.Error_message = f'Error:, the KPI {json_in.KPI_Name} does not exist for {json_in.Machine_Name}'
+            continue
+        json_out_el.Measure_unit = KPI_data["unit_measure"]
+        groups.setdefault((json_in.KPI_Name, json_in.Date_prediction), []).append(json_out_el)
+
+    for (kpi, horizon), elements in groups.items():
+        results = f_dataprocessing.make_fleet_prediction(kpi, [el.Machine_Name for el in elements], horizon)
+        for json_out_el in elements:
+            result = results.get(json_out_el.Machine_Name)
+            if result is None:
+                json_out_el.Error_message = f'Error: no global model of {kpi} covers {json_out_el.Machine_Name}'
+                continue
+            json_out_el.Predicted_value = result['Predicted_value']
+            json_out_el.Lower_bound = result['Lower_bound']
+            json_out_el.Upper_bound = result['Upper_bound']
+            json_out_el.Confidence_score = result['Confidence_score']
+            json_out_el.Date_prediction = result['Date_prediction']
+
+    return Json_out(value=out_dicts).dict()
+
+@app.get("/data-processing/predict_aggregate", response_model = Json_aggregate)
+def predict_aggregate(kpi: str, horizon: int, group: str = hierarchy.PLANT, method: str = 'bottom_up', aggregation: str = 'sum',
+                      api_key: str = Depends(get_verify_api_key(["ai-agent","api-layer"]))):
+    """
+        forecasts a KPI for a machine type of the KB, or for the whole plant ('all') and every machine type,
+        by reconciling the per-machine forecasts stored in the Forecasts table: no model is run.
+
+        Args:
+        kpi: the KPI to be predicted
+        horizon: number of days to forecast, at most FORECAST_TABLE_HORIZON
+        group: 'all' or a machine type
+        method: 'bottom_up' (sums of the machine forecasts) or 'mint' (minimum trace reconciliation)
+        aggregation: 'sum' or 'mean' of the machines
+        api_key: authentication to allow only selected container to access this function
+
+        Returns:
+        one element per aggregate, with its forecast, the machines it covers and those without a stored forecast
+    """
+    try:
+        results = hierarchy.aggregate_forecast(kpi, horizon, group, method, aggregation)
+        out = [Json_aggregate_el(KPI_Name=kpi, Method=method, **result) for result in results]
+    except Exception as e:
+        print(f"Aggregate forecast of {kpi} for {group} failed: {e}")
+        out = [Json_aggregate_el(Group=group, KPI_Name=kpi, Method=method, Machines=[], Missing_machines=[],
+                                 Predicted_value=[], Lower_bound=[], Upper_bound=[], Confidence_score=[],
+                                 Date_prediction=[], Error_message=f'Error: {e}')]
+    return Json_aggregate(value=out).dict()
+
+@app.get("/data-processing/explanations/{prediction_id}", response_model = Json_explanation)
+def get_explanations(prediction_id: str, api_key: str = Depends(get_verify_api_key(["ai-agent","api-layer"]))):
+    """
+        returns the LIME explanations of a forecast requested with Explanation_mode 'deferred'
+
+        Args:
+        prediction_id: the Prediction_id returned by /data-processing/predict
+        api_key: authentication to allow only selected container to access this function
+
+        Returns:
+        a dictionary containing the status of the computation ('pending', 'done', 'failed' or 'unknown')
+        and, once done, the list of explanations
+    """
+    entry = explanation_store.get(prediction_id)
+    if entry is None:
+        json_exp = Json_explanation(
+            Prediction_id=prediction_id,
+            Status='unknown',
+            Lime_explaination=[],
+            Error_message=f'Error: no explanation found for prediction {prediction_id}'
+        )
+    else:
+        json_exp = Json_explanation(
+            Prediction_id=prediction_id,
+            Status=entry['status'],
+            Lime_explaination=[[LimeExplainationItem(date_info=item[0], value=item[1]) for item in exp]
+                               for exp in entry['explanation']],
+            Error_message=entry['error']
+        )
+    return json_exp.dict()
+
+@app.get("/data-processing/forecast_cache")
+def forecast_cache_stats(api_key: str = Depends(get_verify_api_key(["ai-agent","api-layer"]))):
+    """
+    return the size and hit-rate counters of the forecast caches: 'workers' sums the caches of the
+    forecast pool processes serving /predict (as last reported by each of them), 'service' is the
+    cache of this process, used by the forecast table refresh and the monitoring
+    """
+    return {'workers': forecast_pool.cache_stats(), 'service': forecast_cache.stats()}
+
+@app.get("/data-processing/forecast_pool")
+def forecast_pool_stats(api_key: str = Depends(get_verify_api_key(["ai-agent","api-layer"]))):
+    """
+    return the load and the admission counters of the forecast process pool
+    """
+    return forecast_pool.stats()
+
+@app.post("/data-processing/materialize_forecasts")
+def materialize(background_tasks: BackgroundTasks, api_key: str = Depends(get_verify_api_key(["ai-agent","api-layer"]))):
+    """
+    refresh the Forecasts table of every series with a model in background, as done after the daily monitoring
+    """
+    background_tasks.add_task(refresh_forecast_table)
+    return {'Status': 'started', 'Horizon': f_dataprocessing.FORECAST_TABLE_HORIZON}
+
+@app.get("/data-processing/alert_outbox")
+def alert_outbox_stats(api_key: str = Depends(get_verify_api_key(["ai-agent","api-layer"]))):
+    """
+    return the queued alerts and the delivery counters of the alert outbox
+    """
+    return alert_outbox.stats()
+
+@app.get("/data-processing/retrain_queue")
+def retrain_queue_stats(api_key: str = Depends(get_verify_api_key(["ai-agent","api-layer"]))):
+    """
+    return the pending and running jobs of the background retraining queue
+    """
+    return retrain_queue.stats()
+
 def new_data_polling():
     """
         daily check of new data point to update the models. new data points are extracted 24 hours
         if an error occurs it is reported to the user and if drift is detected the re-training of
-        the code is performed
+        the code is performed. The whole fleet is checked by the batched monitoring pipeline,
+        this function blocks and must be run off the event loop.
 
         Args:
 
         Returns:
     """
-    availableModels = retrieve_all_models_from_storage()
-    for m in availableModels:
-        f_dataprocessing.elaborate_new_datapoint(m['Machine_Name'], m['KPI_Name'])
+    try:
+        monitoring.run_monitoring_pass()
+    except Exception as e:
+        print(f"Monitoring pass failed: {e}")
+
+def refresh_forecast_table():
+    """
+        forecasts the next FORECAST_TABLE_HORIZON days of every series with a model and stores them
+        in the Forecasts table, served by /data-processing/predict and read by the monitoring.
+        Blocking, it must be run off the event loop.
+    """
+    try:
+        materialize_forecasts()
+    except Exception as e:
+        print(f"Forecast table refresh failed: {e}")
 
 
 def send_dummy_alert(alert_data):
     """
         send the specified alert for test purpose
     """
-    url_alert = f"http://api:8000/smartfactory/postAlert"
-    API_key = os.getenv('my_key')
-    f_dataprocessing.send_Alert(url_alert,alert_data,API_key)
+    f_dataprocessing.send_Alert(alert_data)
 
 
 if __name__ == "__main__":
@@ -3,16 +3,56 @@ from typing import List
 from typing import Optional
 from enum import Enum
 
+class ExplanationMode(Enum):
+    """
+    How much of the LIME explanation a forecast request pays for
+
+    FULL: one explanation per forecast step (default)
+    FIRST_STEP: only the first forecast step is explained
+    NONE: no explanation is computed
+    DEFERRED: the forecast is returned right away together with a Prediction_id,
+      the explanations are computed in background and fetched from /data-processing/explanations
+    """
+    FULL = "full"
+    FIRST_STEP = "first_step"
+    NONE = "none"
+    DEFERRED = "deferred"
+
+class ModelType(Enum):
+    """
+    Model trained for a series that has none yet
+
+    XGBOOST: recursive one-step booster (default)
+    XGBOOST_DIRECT: direct multi-horizon booster
+    XGBOOST_GLOBAL: one booster per KPI shared by all the machines of the request, only for
+      /data-processing/train_models
+    ARIMA: ARIMA model with a stepwise order search
+    SEASONAL_NAIVE, SES, THETA: numpy statistical models
+    AUTO: the cheapest model with a good backtest accuracy
+    """
+    XGBOOST = "xgboost"
+    XGBOOST_DIRECT = "xgboost_direct"
+    XGBOOST_GLOBAL = "xgboost_global"
+    ARIMA = "ARIMA"
+    SEASONAL_NAIVE = "seasonal_naive"
+    SES = "ses"
+    THETA = "theta"
+    AUTO = "auto"
+
 class Json_in_el(BaseModel):
     """
     Prediction input
 
     Machine_Name and KPI_Name (str): identifiers of the KPI to be predicted
     Date_prediction: number of days to forecast
+    Explanation_mode (ExplanationMode): which LIME explanations to compute for the forecast
+    Model_type (ModelType): model to train when the series has none yet, 'xgboost' by default
     """
     Machine_Name: str
     KPI_Name: str
     Date_prediction: Optional[int] = None
+    Explanation_mode: ExplanationMode = ExplanationMode.FULL
+    Model_type: ModelType = ModelType.XGBOOST
 
 class Json_in(BaseModel):
     value: List[Json_in_el]
@@ -35,6 +75,7 @@ class Json_out_el(BaseModel):
     Date_prediction (list[str]) date of the corresponding prediction
     Error_message (str): in case of error its description will be here
     Forecast (bool): forecast identifier
+    Prediction_id (str): set when the explanations are deferred, use it to fetch them later
     """
     Machine_Name: str
     KPI_Name: str
@@ -47,10 +88,53 @@ class Json_out_el(BaseModel):
     Date_prediction: List[str]
     Error_message: str
     Forecast: bool
+    Prediction_id: Optional[str] = None
 
 class Json_out(BaseModel):
     value: List[Json_out_el]
 
+class Json_aggregate_el(BaseModel):
+    """
+    An aggregate forecast, reconciled from the stored forecasts of the machines
+
+    Group (str): 'all' for the whole plant, otherwise a machine type of the KB
+    KPI_Name (str): the predicted KPI
+    Method (str): 'bottom_up' or 'mint' reconciliation
+    Machines (List[str]): the machines whose forecasts are aggregated
+    Missing_machines (List[str]): the machines of the group without an up to date stored forecast
+    Predicted_value, Lower_bound, Upper_bound, Confidence_score and Date_prediction: as in Json_out_el
+    Error_message (str): in case of error its description will be here
+    """
+    Group: str
+    KPI_Name: str
+    Method: str
+    Machines: List[str]
+    Missing_machines: List[str]
+    Predicted_value: List[float]
+    Lower_bound: List[float]
+    Upper_bound: List[float]
+    Confidence_score: List[float]
+    Date_prediction: List[str]
+    Error_message: str = ""
+
+class Json_aggregate(BaseModel):
+    value: List[Json_aggregate_el]
+
+class Json_explanation(BaseModel):
+    """
+    The deferred explanations of a prediction
+
+    Prediction_id (str): the id returned by /data-processing/predict
+    Status (str): one of 'pending', 'done', 'failed' or 'unknown'
+    Lime_explaination (List[List[LimeExplainationItem]]): one explanation per forecast step,
+      empty until Status is 'done'
+    Error_message (str): in case of error its description will be here
+    """
+    Prediction_id: str
+    Status: str
+    Lime_explaination: List[List[LimeExplainationItem]]
+    Error_message: str = ""
+
 class Severity(Enum):
     LOW = "Low"
     MEDIUM = "Medium"
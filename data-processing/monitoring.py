@@ -0,0 +1,262 @@
+import os
+import threading
+import warnings
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+import f_dataprocessing
+from f_dataprocessing import execute_druid_query, split_kpi_name, sql_list, outlier_window, GLOBAL_MACHINE
+from model import Severity
+from storage.storage_operations import list_models_from_storage, get_monitoring_state, save_monitoring_state
+
+# Fleet monitoring pipeline, run daily by the scheduler of main.py:
+#   1. one bulk Druid query loads the recent window of every monitored series
+#      into a (series x days) matrix
+#   2. missing and zero streaks and robust z-scores are computed for all the series
+#      at once, the alerts are raised and the streaks written back with one statement
+#   3. only the series with a new data point go through drift detection and
+#      forecast update, in a bounded pool of workers
+
+MONITORING_WORKERS = int(os.getenv('MONITORING_WORKERS', 4))
+# robust z-score (distance from the window median in scaled MADs) above which a value is an outlier
+OUTLIER_ZSCORE = float(os.getenv('OUTLIER_ZSCORE', 3.5))
+ZERO_STREAK_ALERT = 2 # zeros in a row after which an alert is sent
+STREAK_HIGH = 5 # missing or zero values in a row after which the alert is of high severity, and sent only once
+
+# time of the last data point processed for every series, so that a series without
+# new data is skipped by the next pass
+_last_processed = {}
+_last_processed_lock = threading.Lock()
+
+def fetch_recent_windows(series, window = outlier_window):
+  """
+  Stage 1: loads the last window + 1 days of every series with one bulk query.
+
+  :param series: list of (machine, kpi) tuples
+  :param window: int, number of past values the latest one is compared with
+  :return: the list of dates (columns) and a np.ndarray of shape (len(series), window + 1),
+    nan where a series has no value for a date. (None, None) if nothing could be loaded.
+  """
+  machines = sorted({machine for machine, _ in series})
+  kpi_names = sorted({split_kpi_name(kpi)[0] for _, kpi in series})
+
+  response = execute_druid_query({
+      "query": f"SELECT MAX(__time) AS last_time FROM \"timeseries\" WHERE name IN ({sql_list(machines)})"
+  })
+  if not response or response[0]['last_time'] is None:
+    return None, None
+  last_time = pd.to_datetime(response[0]['last_time'])
+  first_time = last_time - timedelta(days=window)
+
+  response = execute_druid_query({
+      "query": f"SELECT __time, name, kpi, \"sum\", \"min\", \"max\", \"avg\" FROM \"timeseries\" "
+               f"WHERE name IN ({sql_list(machines)}) AND kpi IN ({sql_list(kpi_names)}) "
+               f"AND __time >= TIMESTAMP '{first_time.strftime('%Y-%m-%d %H:%M:%S')}'"
+  })
+  if not response:
+    return None, None
+  frame = pd.DataFrame(response)
+  frame['__time'] = pd.to_datetime(frame['__time'])
+  dates = pd.date_range(first_time, last_time, periods=window + 1)
+
+  matrix = np.full((len(series), window + 1), np.nan)
+  grouped = {key: rows for key, rows in frame.groupby(['name', 'kpi'])}
+  for i, (machine, kpi) in enumerate(series):
+    kpi_name, data_type = split_kpi_name(kpi)
+    rows = grouped.get((machine, kpi_name))
+    if rows is None:
+      continue
+    values = pd.to_numeric(rows.set_index('__time')[data_type], errors='coerce')
+    matrix[i] = values.groupby(level=0).last().reindex(dates).values
+  return dates, matrix
+
+def trailing_runs(mask):
+  """
+  :param mask: boolean np.ndarray (n_series, n_days)
+  :return: np.ndarray (n_series,), number of True values at the end of every row
+  """
+  return np.cumprod(mask[:, ::-1], axis=1).sum(axis=1)
+
+def robust_zscores(matrix):
+  """
+  Robust z-scores of the last column of every series: distance from the median of the
+  window in units of the scaled median absolute deviation, so the outliers of the window
+  do not hide the new one. Windows with a zero MAD fall back to the standard deviation.
+
+  :param matrix: np.ndarray of shape (n_series, window + 1) as returned by fetch_recent_windows
+  :return: np.ndarray (n_series,), nan for the series without a latest value or a history
+  """
+  latest = matrix[:, -1]
+  history = matrix[:, :-1]
+  with warnings.catch_warnings():
+    # series without any past value give nan statistics, hence no z-score
+    warnings.simplefilter('ignore', category=RuntimeWarning)
+    median = np.nanmedian(history, axis=1)
+    scale = 1.4826 * np.nanmedian(np.abs(history - median[:, None]), axis=1)
+    scale = np.where(scale > 0, scale, np.nanstd(history, axis=1))
+  deviation = latest - median
+  with np.errstate(invalid='ignore', divide='ignore'):
+    # a constant window flags any different value
+    return np.where(scale > 0, deviation / scale, np.where(deviation == 0, 0.0, np.inf * np.sign(deviation)))
+
+def check_latest_points(matrix, threshold = OUTLIER_ZSCORE):
+  """
+  Stage 2: vectorized missing, zero and outlier checks of the last column of every series.
+
+  :param matrix: np.ndarray of shape (n_series, window + 1) as returned by fetch_recent_windows
+  :param threshold: float, robust z-score above which the latest value is an outlier
+  :return: dictionary of arrays, one element per series: 'missing', 'zero' and 'outlier' (bool),
+    'zscore', 'missing_run' and 'zero_run' (missing and zero values at the end of the window)
+  """
+  latest = matrix[:, -1]
+  missing = np.isnan(matrix)
+  zscore = robust_zscores(matrix)
+  with np.errstate(invalid='ignore'):
+    outlier = ~missing[:, -1] & (np.abs(zscore) > threshold)
+  return {
+      'missing': missing[:, -1],
+      'zero': latest == 0,
+      'outlier': outlier,
+      'zscore': zscore,
+      'missing_run': trailing_runs(missing),
+      'zero_run': trailing_runs(matrix == 0)
+  }
+
+def update_streaks(checks, state, new, width):
+  """
+  Updates the missing and zero streaks of all the series and decides their alerts. A streak
+  covering the whole window continues the stored one, an alert of high severity is only sent
+  once per streak.
+
+  :param checks: dictionary returned by check_latest_points
+  :param state: dictionary of arrays 'missing_streak', 'zero_streak' (int), 'missing_alert_sent' and
+    'zero_alert_sent' (bool), the stored state of every series
+  :param new: boolean np.ndarray, the series with a data point not yet counted, the others keep their state
+  :param width: int, number of days of the window
+  :return: the new state (same keys) and a dictionary of boolean arrays 'missing_alert', 'zero_alert'
+    and 'high' (the alert is of high severity)
+  """
+  streaks = {}
+  for kind in ('missing', 'zero'):
+    run = checks[f'{kind}_run']
+    streak = np.where(run >= width, np.maximum(state[f'{kind}_streak'] + 1, run), run)
+    streaks[kind] = np.where(new, streak, state[f'{kind}_streak'])
+  valid = ~checks['missing'] & ~checks['zero']
+  missing_alert = new & checks['missing'] & ~state['missing_alert_sent']
+  zero_alert = new & (streaks['zero'] > ZERO_STREAK_ALERT) & ~state['zero_alert_sent']
+  high_missing = missing_alert & (streaks['missing'] > STREAK_HIGH)
+  high_zero = zero_alert & (streaks['zero'] > STREAK_HIGH)
+  new_state = {
+      'missing_streak': streaks['missing'],
+      'zero_streak': streaks['zero'],
+      # a valid value ends both streaks, the next streak is alerted again
+      'missing_alert_sent': np.where(new & valid, False, state['missing_alert_sent'] | high_missing),
+      'zero_alert_sent': np.where(new & valid, False, state['zero_alert_sent'] | high_zero)
+  }
+  return new_state, {'missing_alert': missing_alert, 'zero_alert': zero_alert, 'high': high_missing | high_zero}
+
+def load_streaks(series):
+  """
+  :return: the stored state of the series as arrays (see update_streaks), and the time of the last
+    data point counted for every series
+  """
+  stored = get_monitoring_state()
+  rows = [stored.get(key, {}) for key in series]
+  return {
+      'missing_streak': np.array([r.get('MissingStreak', 0) for r in rows], dtype=int),
+      'zero_streak': np.array([r.get('ZeroStreak', 0) for r in rows], dtype=int),
+      'missing_alert_sent': np.array([r.get('MissingAlertSent', False) for r in rows], dtype=bool),
+      'zero_alert_sent': np.array([r.get('ZeroAlertSent', False) for r in rows], dtype=bool)
+  }, [r.get('LastObserved') for r in rows]
+
+def streak_alerts(series, checks, streaks, alerts):
+  """
+  :return: the list of the alerts to send, as the alert dictionaries of elaborate_new_datapoint
+  """
+  out = []
+  now = str(datetime.now())
+  for i in np.flatnonzero(alerts['missing_alert'] | alerts['zero_alert'] | checks['new_outlier']):
+    machine, kpi = series[i]
+    base = {'machine': machine, 'isPush': True, 'isEmail': True, 'alert_date': now,
+            'severity': Severity.HIGH if alerts['high'][i] else Severity.MEDIUM}
+    if alerts['missing_alert'][i]:
+      days = f" for {streaks['missing_streak'][i]} days in a row" if streaks['missing_streak'][i] > 1 else ""
+      out.append(dict(base, title='missing value', type='machine_unreachable', recipients=["FactoryFloorManager"],
+                      description=f'{machine} did not yield a new value for: {kpi}{days}'))
+    if alerts['zero_alert'][i]:
+      out.append(dict(base, title='Zero streak', type='machine_unreachable', recipients=["FactoryFloorManager"],
+                      description=f"{kpi} for {machine} returned zeros for {streaks['zero_streak'][i]} days in a row"))
+    if checks['new_outlier'][i]:
+      out.append(dict(base, title='Outlier detected', type='unexpected output', severity=Severity.MEDIUM,
+                      recipients=["FactoryFloorManager", "SpecialityManufacturingOwner"],
+                      description=f'{kpi} for {machine} returned a value {"higher" if checks["zscore"][i] > 0 else "lower"} than expected'))
+  return out
+
+def monitored_series():
+  """
+  :return: the list of (machine, kpi) tuples with a model of their own
+  """
+  models = list_models_from_storage()
+  return sorted({(m['MachineName'], m['KPI']) for m in models if m['MachineName'] != GLOBAL_MACHINE})
+
+def run_monitoring_pass(series = None, max_workers = MONITORING_WORKERS):
+  """
+  Runs the three monitoring stages over the fleet. Blocking, meant to run off the event loop.
+
+  :param series: list of (machine, kpi) tuples, all the series with a model by default
+  :param max_workers: int, number of series processed concurrently in stage 3
+  :return: number of series processed in stage 3
+  """
+  series = series if series is not None else monitored_series()
+  if len(series) == 0:
+    return 0
+  dates, matrix = fetch_recent_windows(series)
+  if matrix is None:
+    print("Monitoring: no data could be loaded")
+    return 0
+  checks = check_latest_points(matrix)
+  latest_time = dates[-1].strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+  # the streaks of all the series are updated at once, a data point already counted is not counted again
+  state, counted = load_streaks(series)
+  with _last_processed_lock:
+    new = np.array([last != latest_time and _last_processed.get(key) != latest_time
+                    for key, last in zip(series, counted)], dtype=bool)
+  streaks, alerts = update_streaks(checks, state, new, matrix.shape[1])
+  checks['new_outlier'] = new & checks['outlier']
+  for alert_data in streak_alerts(series, checks, streaks, alerts):
+    f_dataprocessing.send_Alert(alert_data)
+  save_monitoring_state([{
+      'MachineName': machine, 'KPI': kpi,
+      'MissingStreak': int(streaks['missing_streak'][i]), 'ZeroStreak': int(streaks['zero_streak'][i]),
+      'MissingAlertSent': bool(streaks['missing_alert_sent'][i]), 'ZeroAlertSent': bool(streaks['zero_alert_sent'][i]),
+      'LastObserved': latest_time
+  } for i, (machine, kpi) in enumerate(series) if new[i]])
+
+  with _last_processed_lock:
+    to_process = [i for i, key in enumerate(series) if _last_processed.get(key) != latest_time]
+
+  processed = 0
+  with ThreadPoolExecutor(max_workers=max_workers) as pool:
+    futures = {}
+    for i in to_process:
+      machine, kpi = series[i]
+      latest = (latest_time, float(matrix[i, -1]))
+      # the checks and their alerts are done, stage 3 only updates the statistics, the drift and the forecast
+      futures[pool.submit(f_dataprocessing.elaborate_new_datapoint, machine, kpi, latest, bool(checks['outlier'][i]),
+                          alerted=True)] = series[i]
+    for future in as_completed(futures):
+      key = futures[future]
+      try:
+        future.result()
+        processed += 1
+        with _last_processed_lock:
+          _last_processed[key] = latest_time
+      except Exception as e:
+        print(f"Monitoring of {key[0]}, {key[1]} failed: {e}")
+  print(f"Monitoring: {processed} of {len(series)} series updated, "
+        f"{int(checks['missing'].sum())} missing, {int(checks['zero'].sum())} zero, {int(checks['outlier'].sum())} outliers, "
+        f"{int((streaks['zero_streak'] > ZERO_STREAK_ALERT).sum())} zero streaks")
+  return processed
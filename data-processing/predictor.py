@@ -0,0 +1,134 @@
+import base64
+import hashlib
+import os
+import tempfile
+import threading
+import numpy as np
+from collections import OrderedDict
+from backends import get_backend
+
+xgb = get_backend('xgboost')
+
+# Low-overhead inference of the stored XGBoost models.
+# Forecast rollouts, bootstrap intervals and LIME all call the model with small float
+# matrices, many times per request: building a DMatrix (or going through the sklearn
+# wrapper) for each call costs more than walking the trees. The predictors below call
+# Booster.inplace_predict on float32 buffers reused across calls, and are cached per
+# model so a model is decoded and loaded once.
+
+# 'xgboost' (inplace_predict) or 'treelite' (compiled native library, needs the optional
+# treelite and tl2cgen packages and a C compiler, falls back to 'xgboost' otherwise)
+PREDICTOR_BACKEND = os.getenv('PREDICTOR_BACKEND', 'xgboost')
+PREDICTOR_CACHE_SIZE = int(os.getenv('PREDICTOR_CACHE_SIZE', 128))
+TREELITE_DIR = os.getenv('TREELITE_DIR', os.path.join(tempfile.gettempdir(), 'treelite'))
+
+class BoosterPredictor:
+  """
+  Predictor of an xgb.Booster through inplace_predict, with the predict method of the
+  sklearn models so it can be used wherever ForecastExplainer expects a model.
+
+  Inputs that are not contiguous float32 matrices are copied into a per-thread buffer that
+  is reused by the following calls, instead of allocating a new matrix every time.
+  """
+
+  def __init__(self, booster):
+    """
+    :param booster: xgb.Booster, the trained model.
+    """
+    self.booster = booster
+    self.n_features = booster.num_features()
+    self._local = threading.local()
+
+  def _buffer(self, n_rows):
+    buffer = getattr(self._local, 'buffer', None)
+    if buffer is None or buffer.shape[0] < n_rows:
+      buffer = np.empty((max(n_rows, 1), self.n_features), dtype=np.float32)
+      self._local.buffer = buffer
+    return buffer[:n_rows]
+
+  def as_float32(self, X):
+    """
+    :param X: array-like of shape (n_features,) or (n_rows, n_features).
+    :return: a C-contiguous float32 matrix with the values of X, X itself when it already is one.
+    """
+    X = np.asarray(X)
+    if X.ndim != 2:
+      X = X.reshape(-1, self.n_features)
+    if X.dtype == np.float32 and X.flags.c_contiguous:
+      return X
+    buffer = self._buffer(X.shape[0])
+    np.copyto(buffer, X, casting='unsafe')
+    return buffer
+
+  def _predict(self, X):
+    return self.booster.inplace_predict(X)
+
+  def predict(self, X):
+    """
+    :param X: array-like of shape (n_features,) or (n_rows, n_features).
+    :return: np.ndarray of shape (n_rows,), or (n_rows, n_outputs) for multi-output models.
+    """
+    return np.asarray(self._predict(self.as_float32(X)), dtype=float)
+
+class TreelitePredictor(BoosterPredictor):
+  """
+  Predictor running the trees of a booster compiled to a native library with treelite.
+  The libraries are built once per model in TREELITE_DIR and shared by the workers.
+  """
+
+  def __init__(self, booster, model_key):
+    """
+    :param booster: xgb.Booster, the trained model.
+    :param model_key: str, identifier of the model content, names the compiled library.
+    """
+    import treelite
+    import tl2cgen
+    super().__init__(booster)
+    libpath = os.path.join(TREELITE_DIR, f"{model_key}.so")
+    if not os.path.exists(libpath):
+      os.makedirs(TREELITE_DIR, exist_ok=True)
+      model = treelite.frontend.from_xgboost(booster)
+      # built aside and renamed, another worker may be compiling the same model
+      tmp_path = f"{libpath}.{os.getpid()}.tmp.so"
+      tl2cgen.export_lib(model, toolchain='gcc', libpath=tmp_path)
+      os.replace(tmp_path, libpath)
+    self._tl2cgen = tl2cgen
+    self.predictor = tl2cgen.Predictor(libpath, nthread=1)
+
+  def _predict(self, X):
+    out = self.predictor.predict(self._tl2cgen.DMatrix(X)).reshape(X.shape[0], -1)
+    return out[:, 0] if out.shape[1] == 1 else out
+
+_predictors = OrderedDict()
+_predictors_lock = threading.Lock()
+
+def get_predictor(encoded_model):
+  """
+  Returns the predictor of a stored model, loading it only the first time it is seen.
+
+  :param encoded_model: str, the base64 encoded booster as stored in the model metadata.
+  :return: BoosterPredictor (or TreelitePredictor when PREDICTOR_BACKEND is 'treelite')
+  """
+  model_key = hashlib.sha1(encoded_model.encode('utf-8')).hexdigest()
+  with _predictors_lock:
+    predictor = _predictors.get(model_key)
+    if predictor is not None:
+      _predictors.move_to_end(model_key)
+      return predictor
+
+  booster = xgb.Booster()
+  booster.load_model(bytearray(base64.b64decode(encoded_model)))
+  predictor = None
+  if PREDICTOR_BACKEND == 'treelite':
+    try:
+      predictor = TreelitePredictor(booster, model_key)
+    except Exception as e:
+      print(f"Treelite predictor not available, using xgboost: {e}")
+  if predictor is None:
+    predictor = BoosterPredictor(booster)
+
+  with _predictors_lock:
+    _predictors[model_key] = predictor
+    while len(_predictors) > PREDICTOR_CACHE_SIZE:
+      _predictors.popitem(last=False)
+  return predictor
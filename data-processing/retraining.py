@@ -0,0 +1,266 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from datetime import date, datetime
+
+import f_dataprocessing
+
+# Retraining of the models flagged by the drift detector, and first training of the
+# series forecast before they have a model.
+# Monitoring and /predict only enqueue a job: training runs in a small pool of background
+# workers, so neither the monitoring pass nor a prediction request waits for a
+# grid search. A (machine, kpi) pair is queued at most once, and the jobs are
+# run by decreasing drift severity, then by decreasing age of the model.
+
+RETRAIN_WORKERS = int(os.getenv('RETRAIN_WORKERS', 2))
+RETRAIN_MAX_PENDING = int(os.getenv('RETRAIN_MAX_PENDING', 1000))
+# jobs taken at once by a worker, their data is loaded with one bulk extraction
+RETRAIN_BATCH = int(os.getenv('RETRAIN_BATCH', 20))
+# seconds a training that cannot succeed (constant series, too little data) is remembered,
+# the series is not queued again meanwhile, then new data may allow the training
+RETRAIN_FAILED_TTL = int(os.getenv('RETRAIN_FAILED_TTL', 86400))
+# statuses of characterize_KPI that training the same data again does not change
+TERMINAL_STATUSES = (-1, -2, -3)
+
+def staleness_days(trained_on):
+  """
+  :param trained_on: str, training date as stored in the model metadata ('YYYY-MM-DD')
+  :return: int, days elapsed since the training date, 0 if unknown
+  """
+  try:
+    return (date.today() - datetime.strptime(trained_on, "%Y-%m-%d").date()).days
+  except (TypeError, ValueError):
+    return 0
+
+def retrain_models(keys, model_types = None):
+  """
+  Retrains the models of a batch of series. The boosters are updated incrementally when possible
+  (see f_dataprocessing.update_KPI), the other series are trained again with the model type they
+  currently use (or with the automatic selection if the model was selected automatically).
+
+  :param keys: list of (machine, kpi) tuples
+  :param model_types: dictionary (machine, kpi) -> model type of the series without a model yet,
+    trained from scratch with it
+  :return: dictionary (machine, kpi) -> status code of the training
+  """
+  model_types = model_types or {}
+  series = f_dataprocessing.data_load_bulk(keys)
+  statuses = {}
+  requests = []
+  for machine, kpi in keys:
+    if (machine, kpi) in model_types:
+      requests.append((machine, kpi, model_types[(machine, kpi)]))
+      continue
+    # the model is fetched once, for the update and for the type of a full training
+    model_info = {}
+    try:
+      model_info = f_dataprocessing.load_model(machine, kpi).get('model', {})
+      status = f_dataprocessing.update_KPI(machine, kpi, series.get((machine, kpi)), model_info)
+    except Exception as e:
+      print(f"Incremental update of {machine}, {kpi} failed: {e}")
+      status = 1
+    if status == 0:
+      statuses[(machine, kpi)] = 0
+      continue
+    # a model chosen automatically is chosen again, the data may now favour another one
+    model_type = model_info.get('metadata', {}).get('selection', {}).get('requested') or model_info.get('name') or 'xgboost'
+    if model_type == 'xgboost_global':
+      # a global model is retrained fleet-wide, the series gets a model of its own
+      model_type = 'xgboost'
+    requests.append((machine, kpi, model_type))
+  if len(requests) == 0:
+    return statuses
+  # the workers of the queue already bound the concurrency, the batch is trained sequentially
+  statuses.update(f_dataprocessing.characterize_many(requests, max_workers=1, series=series))
+  return statuses
+
+class RetrainQueue:
+  """
+  Priority queue of retraining jobs with de-duplication and a bounded pool of workers.
+
+  Attributes:
+  - workers: int, number of background threads running the jobs.
+  - max_pending: int, maximum number of queued jobs, further submissions are rejected.
+  - batch_size: int, maximum number of jobs a worker takes at once, the most urgent ones.
+  - train_fn: callable(list of (machine, kpi), dictionary (machine, kpi) -> model type) running a batch of
+    jobs and returning their status codes.
+  - failed_ttl: int, seconds the terminal status of a failed training is kept (see training_status).
+  """
+
+  def __init__(self, workers=RETRAIN_WORKERS, max_pending=RETRAIN_MAX_PENDING, batch_size=RETRAIN_BATCH,
+               train_fn=retrain_models, failed_ttl=RETRAIN_FAILED_TTL):
+    self.workers = workers
+    self.max_pending = max_pending
+    self.batch_size = batch_size
+    self.train_fn = train_fn
+    self.failed_ttl = failed_ttl
+    self._heap = []
+    self._pending = {}   # (machine, kpi) -> heap entry, the entry is marked removed when re-prioritized
+    self._running = set()
+    self._requeue = set()  # jobs submitted again while running
+    self._model_types = {}  # (machine, kpi) -> model type of the series trained for the first time
+    self._terminal = {}  # (machine, kpi) -> (status, time) of the last training that cannot succeed
+    self._seq = itertools.count()
+    self._cond = threading.Condition()
+    self._threads = []
+    self._stopped = False
+    self.completed = 0
+    self.failed = 0
+    self.rejected = 0
+    self.merged = 0
+
+  def _start_workers(self):
+    # called with the condition held, the threads are only started at the first submission
+    if self._threads:
+      return
+    for i in range(self.workers):
+      t = threading.Thread(target=self._worker, name=f"retrain-{i}", daemon=True)
+      t.start()
+      self._threads.append(t)
+
+  def submit(self, machine, kpi, severity=0.0, trained_on=None, model_type=None):
+    """
+    Queues the retraining of a series. A series already queued keeps a single job,
+    with the highest of the severities submitted.
+
+    :param machine: str, machine identifier.
+    :param kpi: str, KPI name.
+    :param severity: float, drift severity reported by the detector.
+    :param trained_on: str, training date of the current model, older models go first.
+    :param model_type: str, model to train for a series that has none yet (see characterize_KPI).
+    :return: bool, False if the job was rejected because the queue is full or because the last
+      training of the series failed with a terminal status (see training_status).
+    """
+    key = (machine, kpi)
+    with self._cond:
+      if self._stopped:
+        return False
+      if self._terminal_status(key) is not None:
+        return False
+      if key in self._running:
+        if model_type is None:
+          # the running job trains on data that may predate the drift, run it again afterwards
+          self._requeue.add(key)
+        self.merged += 1
+        return True
+      entry = self._pending.get(key)
+      if entry is not None:
+        self.merged += 1
+        if model_type is not None:
+          self._model_types[key] = model_type
+        if severity <= -entry[0]:
+          return True
+        entry[-1] = None  # lazily removed from the heap
+        severity = max(severity, -entry[0])
+      elif len(self._pending) >= self.max_pending:
+        self.rejected += 1
+        print(f"Retraining queue full, {machine}, {kpi} not queued")
+        return False
+      if model_type is not None:
+        self._model_types[key] = model_type
+      new_entry = [-severity, -staleness_days(trained_on), next(self._seq), key]
+      self._pending[key] = new_entry
+      heapq.heappush(self._heap, new_entry)
+      self._start_workers()
+      self._cond.notify()
+    return True
+
+  def _terminal_status(self, key):
+    # called with the condition held, an expired status is dropped
+    outcome = self._terminal.get(key)
+    if outcome is None:
+      return None
+    status, failed_at = outcome
+    if time.monotonic() - failed_at > self.failed_ttl:
+      del self._terminal[key]
+      return None
+    return status
+
+  def training_status(self, machine, kpi):
+    """
+    :param machine: str, machine identifier.
+    :param kpi: str, KPI name.
+    :return: int, status of the last training of the series if it failed with a terminal status
+      (-1 constant series or no data, -2 too little data to fit a model, -3 unknown model type)
+      less than failed_ttl seconds ago, None otherwise.
+    """
+    with self._cond:
+      return self._terminal_status((machine, kpi))
+
+  def _next_jobs(self):
+    with self._cond:
+      while True:
+        if self._stopped:
+          return []
+        keys = []
+        while self._heap and len(keys) < self.batch_size:
+          key = heapq.heappop(self._heap)[-1]
+          if key is None:
+            continue
+          del self._pending[key]
+          self._running.add(key)
+          keys.append(key)
+        if keys:
+          return keys
+        self._cond.wait()
+
+  def _worker(self):
+    while True:
+      keys = self._next_jobs()
+      if not keys:
+        return
+      with self._cond:
+        model_types = {key: self._model_types.pop(key) for key in keys if key in self._model_types}
+      try:
+        statuses = self.train_fn(keys, model_types)
+      except Exception as e:
+        print(f"Retraining of {len(keys)} models failed: {e}")
+        statuses = {}
+      requeue = []
+      with self._cond:
+        for key in keys:
+          # a series without a status failed on an error, it may succeed when submitted again
+          status = statuses.get(key)
+          if status == 0:
+            self.completed += 1
+            self._terminal.pop(key, None)
+          else:
+            self.failed += 1
+            print(f"Retraining of {key[0]}, {key[1]} returned {status}")
+            if status in TERMINAL_STATUSES:
+              self._terminal[key] = (status, time.monotonic())
+          self._running.discard(key)
+          if key in self._requeue:
+            self._requeue.discard(key)
+            requeue.append(key)
+      for machine, kpi in requeue:
+        self.submit(machine, kpi)
+
+  def stats(self):
+    """
+    :return: dictionary with the queue size and its counters.
+    """
+    with self._cond:
+      return {
+          'pending': len(self._pending),
+          'running': len(self._running),
+          'workers': self.workers,
+          'max_pending': self.max_pending,
+          'completed': self.completed,
+          'failed': self.failed,
+          'rejected': self.rejected,
+          'merged': self.merged,
+          'terminal': len(self._terminal)
+      }
+
+  def shutdown(self):
+    """
+    Stops the workers once their current job is done, the queued jobs are dropped.
+    """
+    with self._cond:
+      self._stopped = True
+      self._cond.notify_all()
+
+retrain_queue = RetrainQueue()
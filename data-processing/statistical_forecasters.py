@@ -0,0 +1,246 @@
+import os
+import warnings
+import numpy as np
+from statistics import NormalDist
+
+# Classical forecasters written with numpy only: seasonal naive, simple exponential
+# smoothing (SES) and the Theta method (SES with half the slope of the linear trend).
+# They work on many series at once: the series are right-aligned in a matrix padded
+# with NaN on the left, and every time step is one array operation over all the series
+# and all the smoothing constants tried. Fitting a fleet of series takes milliseconds,
+# so characterize_KPI can afford to backtest them and keep the boosters for the series
+# where they are clearly more accurate.
+
+STATISTICAL_MODELS = ('seasonal_naive', 'ses', 'theta')
+# models sorted by fit and predict cost, among similarly accurate models the cheapest is chosen
+MODEL_COST = {'seasonal_naive': 0, 'ses': 1, 'theta': 2, 'ARIMA': 3, 'xgboost': 4, 'xgboost_direct': 4}
+SEASON_LENGTH = int(os.getenv('SEASON_LENGTH', 7)) # daily KPIs, weekly season
+BACKTEST_HORIZON = int(os.getenv('BACKTEST_HORIZON', 14)) # held-out last points of the backtest
+# a costlier model must have a backtest error lower by more than this fraction to be chosen
+SELECTION_MARGIN = float(os.getenv('SELECTION_MARGIN', 0.1))
+ALPHAS = np.linspace(0.05, 1.0, 20) # smoothing constants tried by the SES fit
+
+def pad_series(series_list):
+  """
+  Stacks series of different lengths in one matrix, right-aligned and padded with NaN.
+
+  :param series_list: list of 1D arrays
+  :return: np.ndarray of shape (n_series, max length)
+  """
+  length = max(len(s) for s in series_list)
+  Y = np.full((len(series_list), length), np.nan)
+  for i, s in enumerate(series_list):
+    if len(s) > 0:
+      Y[i, length - len(s):] = s
+  return Y
+
+def ses_filter(Y, alphas):
+  """
+  Runs simple exponential smoothing on all the series with all the smoothing constants.
+
+  :param Y: np.ndarray (n_series, T), series padded with NaN on the left (see pad_series)
+  :param alphas: np.ndarray (n_series, k) or (k,), smoothing constants
+  :return: final levels (n_series, k) and sums of the squared one-step errors (n_series, k)
+  """
+  alphas = np.broadcast_to(alphas, (Y.shape[0], np.shape(alphas)[-1]))
+  level = np.full(alphas.shape, np.nan)
+  sse = np.zeros(alphas.shape)
+  for t in range(Y.shape[1]):
+    y = Y[:, t:t + 1]
+    valid = ~np.isnan(y)
+    started = ~np.isnan(level)
+    err = np.where(valid & started, y - np.where(started, level, 0.0), 0.0)
+    sse += err ** 2
+    # the level starts at the first value of the series
+    level = np.where(valid & ~started, y, level + alphas * err)
+  return level, sse
+
+def trend_slope(Y):
+  """
+  :param Y: np.ndarray (n_series, T), padded series
+  :return: np.ndarray (n_series,), least squares slope of every series over time
+  """
+  t = np.broadcast_to(np.arange(Y.shape[1], dtype=float), Y.shape)
+  valid = ~np.isnan(Y)
+  n = np.maximum(valid.sum(axis=1), 1)
+  t_mean = np.where(valid, t, 0).sum(axis=1) / n
+  y_mean = np.where(valid, Y, 0).sum(axis=1) / n
+  dt = np.where(valid, t - t_mean[:, None], 0)
+  dy = np.where(valid, Y - y_mean[:, None], 0)
+  var = (dt ** 2).sum(axis=1)
+  return np.where(var > 0, (dt * dy).sum(axis=1) / np.where(var > 0, var, 1), 0.0)
+
+def fit(Y, season_length = SEASON_LENGTH):
+  """
+  Fits the three models on a batch of series.
+
+  :param Y: np.ndarray (n_series, T), padded series
+  :return: dictionary of per-series arrays: 'alpha', 'level', 'sigma' (one-step error of SES),
+    'slope', 'n_obs', 'last_season' (n_series, season_length) and 'season_sigma'
+  """
+  n_obs = (~np.isnan(Y)).sum(axis=1)
+  levels, sse = ses_filter(Y, ALPHAS)
+  best = np.argmin(sse, axis=1)
+  rows = np.arange(Y.shape[0])
+  sigma = np.sqrt(sse[rows, best] / np.maximum(n_obs - 1, 1))
+
+  season_errors = Y[:, season_length:] - Y[:, :-season_length]
+  n_season = (~np.isnan(season_errors)).sum(axis=1)
+  season_sigma = np.sqrt(np.nansum(season_errors ** 2, axis=1) / np.maximum(n_season, 1))
+  return {
+      'alpha': ALPHAS[best],
+      'level': levels[rows, best],
+      'sigma': sigma,
+      'slope': trend_slope(Y),
+      'n_obs': n_obs,
+      'last_season': Y[:, -season_length:],
+      'season_sigma': np.where(n_season > 0, season_sigma, sigma)
+  }
+
+def forecast(name, fitted, horizon, confidence = 0.95):
+  """
+  Forecasts a batch of fitted series with one of the models.
+
+  :param name: str, one of STATISTICAL_MODELS
+  :param fitted: dictionary returned by fit
+  :param horizon: int, number of steps
+  :param confidence: float, coverage of the prediction intervals
+  :return: forecasts and interval half-widths, both np.ndarray (n_series, horizon)
+  """
+  h = np.arange(1, horizon + 1)
+  z = NormalDist().inv_cdf(0.5 + confidence / 2)
+  alpha = fitted['alpha'][:, None]
+  if name == 'seasonal_naive':
+    season_length = fitted['last_season'].shape[1]
+    mean = fitted['last_season'][:, (h - 1) % season_length]
+    half = z * fitted['season_sigma'][:, None] * np.sqrt((h - 1) // season_length + 1)
+    return mean, half
+  mean = np.repeat(fitted['level'][:, None], horizon, axis=1)
+  if name == 'theta':
+    # Hyndman and Billah (2003): SES forecast plus half the drift of the linear trend
+    n = fitted['n_obs'][:, None]
+    mean = mean + fitted['slope'][:, None] / 2 * (h - 1 + 1 / alpha - (1 - alpha) ** n / alpha)
+  elif name != 'ses':
+    raise ValueError(f"Unknown statistical model {name}")
+  half = z * fitted['sigma'][:, None] * np.sqrt(1 + (h - 1) * alpha ** 2)
+  return mean, half
+
+def choose(errors, margin = SELECTION_MARGIN):
+  """
+  Chooses a model from its backtest error and its cost: the cheapest model whose
+  error is within margin of the best one.
+
+  :param errors: dictionary model name -> backtest error (None if it could not be measured)
+  :return: str, the chosen model name, None if no error was measured
+  """
+  measured = {name: err for name, err in errors.items() if err is not None and np.isfinite(err)}
+  if len(measured) == 0:
+    return None
+  best = min(measured.values())
+  for name in sorted(measured, key=lambda name: MODEL_COST.get(name, len(MODEL_COST))):
+    if measured[name] <= best * (1 + margin):
+      return name
+
+def backtest(series_list, models = STATISTICAL_MODELS, horizon = BACKTEST_HORIZON, season_length = SEASON_LENGTH):
+  """
+  Backtests the models on a batch of series: each model is fitted without the last horizon
+  points of every series and scored with the mean absolute error on them.
+
+  :param series_list: list of 1D arrays
+  :return: list with a dictionary model name -> error per series, the errors are None for
+    the series too short to be backtested
+  """
+  min_length = horizon + 2 * season_length
+  Y = pad_series(series_list)
+  if Y.shape[1] < min_length:
+    return [{name: None for name in models} for _ in series_list]
+  fitted = fit(Y[:, :-horizon], season_length)
+  actual = Y[:, -horizon:]
+  with warnings.catch_warnings():
+    # the series too short to be backtested have no error, they are left out below
+    warnings.simplefilter('ignore', category=RuntimeWarning)
+    errors = {name: np.nanmean(np.abs(forecast(name, fitted, horizon)[0] - actual), axis=1) for name in models}
+  return [{name: (float(errors[name][i]) if len(s) >= min_length else None) for name in models}
+          for i, s in enumerate(series_list)]
+
+def select(series_list, models = STATISTICAL_MODELS, season_length = SEASON_LENGTH):
+  """
+  Backtests the models on a batch of series, chooses one per series and fits it on the whole series.
+
+  :param series_list: list of 1D arrays, the cleaned series
+  :param models: names of the candidate models
+  :return: list with one dictionary per series: 'name' (the chosen model, 'ses' when the series
+    is too short to be backtested), 'params' (model name -> parameters to store in the model
+    metadata, for every candidate) and 'backtest' (model name -> error)
+  """
+  errors = backtest(series_list, models, season_length=season_length)
+  fitted = fit(pad_series(series_list), season_length)
+  out = []
+  for i, series_errors in enumerate(errors):
+    name = choose(series_errors) or ('ses' if 'ses' in models else models[0])
+    out.append({'name': name, 'params': {m: model_params(m, fitted, i) for m in models}, 'backtest': series_errors})
+  return out
+
+def model_params(name, fitted, i):
+  """
+  :return: the parameters of series i to store for the model, the state (level, last season) is
+    recomputed from the data at forecast time
+  """
+  if name == 'seasonal_naive':
+    return {'season_length': int(fitted['last_season'].shape[1]), 'sigma': float(fitted['season_sigma'][i])}
+  params = {'alpha': float(fitted['alpha'][i]), 'sigma': float(fitted['sigma'][i])}
+  if name == 'theta':
+    params['slope'] = float(fitted['slope'][i])
+  return params
+
+def predict(model_info, values, horizon, confidence = 0.95):
+  """
+  Forecasts a series with its stored statistical model.
+
+  :param model_info: dictionary stored under 'model' in the model metadata
+  :param values: 1D array, the cleaned series up to the last observed point
+  :param horizon: int, number of steps
+  :return: forecasts and interval half-widths, both 1D np.ndarray
+  """
+  name = model_info['name']
+  Y = np.asarray(values, dtype=float)[None, :]
+  if name == 'seasonal_naive':
+    fitted = {'last_season': Y[:, -model_info['season_length']:], 'season_sigma': np.array([model_info['sigma']]),
+              'alpha': np.ones(1)}
+  else:
+    alpha = np.array([model_info['alpha']])
+    level, _ = ses_filter(Y, alpha[:, None])
+    fitted = {'alpha': alpha, 'level': level[:, 0], 'sigma': np.array([model_info['sigma']]),
+              'slope': np.array([model_info.get('slope', 0.0)]), 'n_obs': np.array([Y.shape[1]])}
+  mean, half = forecast(name, fitted, horizon, confidence)
+  return mean[0], half[0]
+
+def predict_many(model_infos, values_list, horizon, confidence = 0.95):
+  """
+  Forecasts many series with their stored statistical models, the series of the same
+  model (and season length) in one batch.
+
+  :param model_infos: list of dictionaries stored under 'model' in the model metadata
+  :param values_list: list of 1D arrays, the cleaned series, in the same order
+  :param horizon: int, number of steps
+  :return: list of (forecasts, interval half-widths) tuples, in the same order
+  """
+  groups = {}
+  for i, info in enumerate(model_infos):
+    groups.setdefault((info['name'], info.get('season_length')), []).append(i)
+  out = [None] * len(model_infos)
+  for (name, season_length), idx in groups.items():
+    Y = pad_series([np.asarray(values_list[i], dtype=float) for i in idx])
+    sigma = np.array([model_infos[i]['sigma'] for i in idx])
+    if name == 'seasonal_naive':
+      fitted = {'last_season': Y[:, -season_length:], 'season_sigma': sigma, 'alpha': np.ones(len(idx))}
+    else:
+      alpha = np.array([model_infos[i]['alpha'] for i in idx])
+      level, _ = ses_filter(Y, alpha[:, None])
+      fitted = {'alpha': alpha, 'level': level[:, 0], 'sigma': sigma,
+                'slope': np.array([model_infos[i].get('slope', 0.0) for i in idx]),
+                'n_obs': (~np.isnan(Y)).sum(axis=1)}
+    mean, half = forecast(name, fitted, horizon, confidence)
+    for row, i in enumerate(idx):
+      out[i] = (mean[row], half[row])
+  return out
@@ -1,15 +1,45 @@
 from minio import Minio
 import os
+import threading
+import urllib3
 from dotenv import load_dotenv
 from pathlib import Path
 
 env_path = Path(__file__).resolve().parent.parent / ".env"
 load_dotenv(dotenv_path=env_path)
 
+# number of keep-alive connections of the client shared by all the threads of the service
+MINIO_POOL_SIZE = int(os.getenv('MINIO_POOL_SIZE', 10))
+
+_client = None
+_client_lock = threading.Lock()
+
 def get_minio_client():
-    return Minio(
-        os.getenv('MINIO_HOST') + os.getenv('MINIO_ADDRESS'),
-        access_key=os.getenv('MINIO_ROOT_USER'),
-        secret_key=os.getenv('MINIO_ROOT_PASSWORD'),
-        secure=False
-    )
\ No newline at end of file
+    # the Minio client is thread-safe: one client per process reuses its open connections
+    global _client
+    with _client_lock:
+        if _client is None:
+            # same timeout and retries as the default client of Minio
+            http_client = urllib3.PoolManager(
+                timeout=300,
+                maxsize=MINIO_POOL_SIZE,
+                retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504])
+            )
+            _client = Minio(
+                os.getenv('MINIO_HOST') + os.getenv('MINIO_ADDRESS'),
+                access_key=os.getenv('MINIO_ROOT_USER'),
+                secret_key=os.getenv('MINIO_ROOT_PASSWORD'),
+                secure=False,
+                http_client=http_client
+            )
+        return _client
+
+def check_minio(bucket_name="models"):
+    # health check, returns the pool settings and whether the bucket is reachable
+    status = {"pool_size": MINIO_POOL_SIZE}
+    try:
+        status["status"] = "ok" if get_minio_client().bucket_exists(bucket_name) else "bucket not found"
+    except Exception as e:
+        status["status"] = "error"
+        status["error"] = str(e)
+    return status
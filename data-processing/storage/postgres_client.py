@@ -1,16 +1,78 @@
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
 import os
+import threading
+from contextlib import contextmanager
 from dotenv import load_dotenv
 from pathlib import Path
 
 env_path = Path(__file__).resolve().parent.parent / ".env"
 load_dotenv(dotenv_path=env_path)
 
-def get_postgres_connection():
-    return psycopg2.connect(
+# size of the connection pool shared by all the threads of the service
+POSTGRES_POOL_MIN = int(os.getenv('POSTGRES_POOL_MIN', 1))
+POSTGRES_POOL_MAX = int(os.getenv('POSTGRES_POOL_MAX', 10))
+
+_pool = None
+_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises when it is exhausted, callers wait on the semaphore instead
+_pool_slots = threading.BoundedSemaphore(POSTGRES_POOL_MAX)
+
+def _connection_params():
+    return dict(
         dbname=os.getenv('POSTGRES_DB'),
         user=os.getenv('POSTGRES_USER'),
         password=os.getenv('POSTGRES_PASSWORD'),
         host=os.getenv('POSTGRES_HOST'),
         port=os.getenv('POSTGRES_PORT')
-    )
\ No newline at end of file
+    )
+
+def get_postgres_connection():
+    # dedicated connection, to be closed by the caller. Prefer postgres_connection()
+    return psycopg2.connect(**_connection_params())
+
+def get_postgres_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.closed:
+            _pool = ThreadedConnectionPool(POSTGRES_POOL_MIN, POSTGRES_POOL_MAX, **_connection_params())
+        return _pool
+
+@contextmanager
+def postgres_connection():
+    # borrows a connection from the pool: committed by the caller, rolled back on error,
+    # and discarded instead of returned to the pool if the server closed it
+    with _pool_slots:
+        pool = get_postgres_pool()
+        conn = pool.getconn()
+        broken = False
+        try:
+            yield conn
+        except Exception:
+            broken = conn.closed != 0
+            if not broken:
+                conn.rollback()
+            raise
+        finally:
+            pool.putconn(conn, close=broken or conn.closed != 0)
+
+def check_postgres():
+    # health check, returns the pool settings and whether a query succeeds
+    status = {"min_connections": POSTGRES_POOL_MIN, "max_connections": POSTGRES_POOL_MAX}
+    try:
+        with postgres_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+                cursor.fetchone()
+        status["status"] = "ok"
+    except Exception as e:
+        status["status"] = "error"
+        status["error"] = str(e)
+    return status
+
+def close_postgres_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None and not _pool.closed:
+            _pool.closeall()
+        _pool = None
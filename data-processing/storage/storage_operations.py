@@ -1,18 +1,34 @@
-from .minio_client import get_minio_client
-from .postgres_client import get_postgres_connection
+from .minio_client import get_minio_client, MINIO_POOL_SIZE
+from .postgres_client import postgres_connection
+from psycopg2.extras import execute_values
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import copy
 import io
 import json
+import os
+import threading
 
-# Insert a JSON model into the bucket
-def insert_model_to_storage(bucket_name, file_name, json_data, kpi, machine_name):
+# number of models downloaded concurrently by fetch_models_from_storage, within the MinIO pool
+FETCH_WORKERS = min(8, MINIO_POOL_SIZE)
+# number of downloaded models kept in memory by retrieve_model_from_storage
+MODEL_CACHE_SIZE = int(os.getenv('MODEL_CACHE_SIZE', 256))
+# inactive versions kept per model besides the active one, the older ones are deleted at every save
+MODEL_VERSIONS_KEPT = int(os.getenv('MODEL_VERSIONS_KEPT', 3))
+
+# Insert a JSON model into the bucket as a version of the model of (kpi, machine_name) and make it the active one.
+# Saving again the same version overwrites it, trained_on and version are kept in the Models table for the listing.
+# Past the active version and the MODEL_VERSIONS_KEPT newest ones, the versions are deleted with their objects
+def insert_model_to_storage(bucket_name, file_name, json_data, kpi, machine_name, trained_on=None, version=None):
+    version = version or ''
     client = get_minio_client()
     # Ensure the bucket exists
     if client.bucket_exists(bucket_name):
         # Convert JSON data to bytes
         json_bytes = json.dumps(json_data).encode('utf-8')
-        
+
         # Upload JSON data
-        client.put_object(
+        result = client.put_object(
             bucket_name,
             file_name,
             data=io.BytesIO(json_bytes),
@@ -23,104 +39,362 @@ def insert_model_to_storage(bucket_name, file_name, json_data, kpi, machine_name
 
         # Insert record into PostgreSQL
         try:
-            conn = get_postgres_connection()
-            cursor = conn.cursor()
-            model_path = f"{bucket_name}/{file_name}"
-            insert_query = """
-            INSERT INTO Models (KPI, MachineName, ModelPath)
-            VALUES (%s, %s, %s)
-            RETURNING ID;
-            """
-            cursor.execute(insert_query, (kpi, machine_name, model_path))
-            record_id = cursor.fetchone()[0]
-            conn.commit()
-            print(f"Record inserted into PostgreSQL with ID: {record_id}")
+            with postgres_connection() as conn, conn.cursor() as cursor:
+                model_path = f"{bucket_name}/{file_name}"
+                upsert_query = """
+                INSERT INTO Models (KPI, MachineName, ModelPath, TrainedOn, Version, SizeBytes, ETag)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (KPI, MachineName, Version) DO UPDATE
+                SET ModelPath = EXCLUDED.ModelPath, TrainedOn = EXCLUDED.TrainedOn,
+                    SizeBytes = EXCLUDED.SizeBytes, ETag = EXCLUDED.ETag
+                RETURNING ID;
+                """
+                cursor.execute(upsert_query, (kpi, machine_name, model_path, trained_on, version, len(json_bytes), result.etag))
+                record_id = cursor.fetchone()[0]
+                _activate(cursor, kpi, machine_name, version)
+                pruned = _prune_versions(cursor, kpi, machine_name, MODEL_VERSIONS_KEPT)
+                conn.commit()
+            _cache_model(kpi, machine_name, result.etag, json_data)
+            print(f"Record stored into PostgreSQL with ID: {record_id}")
+            # the rows are gone first, the registry never points to a deleted object
+            _remove_objects(client, pruned)
         except Exception as e:
             print("Error inserting into PostgreSQL:", e)
-        finally:
-            if cursor:
-                cursor.close()
-            if conn:
-                conn.close()
     else:
         print(f"Bucket '{bucket_name}' not found.")
     pass
 
-# Retrieve a JSON model from the bucket
-def retrieve_model_from_storage(kpi, machine_name):
+def _activate(cursor, kpi, machine_name, version):
+    # two statements, the unique index on the active version is checked row by row
+    cursor.execute("""
+    UPDATE Models SET IsActive = FALSE
+    WHERE KPI = %s AND MachineName = %s AND IsActive AND Version <> %s;
+    """, (kpi, machine_name, version))
+    cursor.execute("""
+    UPDATE Models SET IsActive = TRUE
+    WHERE KPI = %s AND MachineName = %s AND Version = %s
+    RETURNING ID;
+    """, (kpi, machine_name, version))
+    return cursor.fetchone() is not None
+
+def _prune_versions(cursor, kpi, machine_name, keep):
+    # the active version always stays, even when it is older than the kept ones (after a rollback)
+    cursor.execute("""
+    DELETE FROM Models
+    WHERE KPI = %s AND MachineName = %s AND NOT IsActive
+      AND ID NOT IN (SELECT ID FROM Models WHERE KPI = %s AND MachineName = %s AND NOT IsActive
+                     ORDER BY Version DESC LIMIT %s)
+    RETURNING ModelPath;
+    """, (kpi, machine_name, kpi, machine_name, keep))
+    return [row[0] for row in cursor.fetchall()]
+
+def _remove_objects(client, model_paths):
+    for model_path in model_paths:
+        bucket_name, file_name = model_path.split('/', 1)
+        try:
+            client.remove_object(bucket_name, file_name)
+        except Exception as e:
+            print(f"Error deleting the old model version {model_path}:", e)
+    if model_paths:
+        print(f"{len(model_paths)} old model versions deleted")
+
+# Make a stored version the active model of (kpi, machine_name), e.g. to roll back a retraining
+def activate_model_version(kpi, machine_name, version):
     try:
-        # Query PostgreSQL for the file path
-        conn = get_postgres_connection()
-        cursor = conn.cursor()
+        with postgres_connection() as conn, conn.cursor() as cursor:
+            found = _activate(cursor, kpi, machine_name, version)
+            if found:
+                conn.commit()
+            else:
+                conn.rollback()
+        if not found:
+            print(f"No version {version} found for KPI: {kpi} and MachineName: {machine_name}")
+        return found
+    except Exception as e:
+        print("Error activating the model version:", e)
+        return False
+
+# Path, version and ETag of the active model, an indexed lookup that downloads nothing
+def get_active_model_version(kpi, machine_name):
+    with postgres_connection() as conn, conn.cursor() as cursor:
         select_query = """
-        SELECT ModelPath FROM Models
-        WHERE KPI = %s AND MachineName = %s;
+        SELECT ModelPath, Version, ETag FROM Models
+        WHERE KPI = %s AND MachineName = %s AND IsActive;
         """
         cursor.execute(select_query, (kpi, machine_name))
         result = cursor.fetchone()
+        # read-only transaction, ended before the connection goes back to the pool
+        conn.rollback()
+    return result
+
+# Downloaded models, revalidated against the ETag of the active version instead of downloaded again
+_model_cache = OrderedDict()
+_model_cache_lock = threading.Lock()
+
+def _cache_model(kpi, machine_name, etag, json_data):
+    if etag is None:
+        return
+    with _model_cache_lock:
+        _model_cache[(kpi, machine_name)] = (etag, copy.deepcopy(json_data))
+        _model_cache.move_to_end((kpi, machine_name))
+        while len(_model_cache) > MODEL_CACHE_SIZE:
+            _model_cache.popitem(last=False)
+
+def _cached_model(kpi, machine_name, etag):
+    with _model_cache_lock:
+        entry = _model_cache.get((kpi, machine_name))
+        if entry is None or entry[0] != etag:
+            return None
+        _model_cache.move_to_end((kpi, machine_name))
+    # callers modify the model they get, the cached one must stay untouched
+    return copy.deepcopy(entry[1])
+
+# Retrieve the active JSON model from the bucket
+def retrieve_model_from_storage(kpi, machine_name):
+    try:
+        # Query PostgreSQL for the file path
+        result = get_active_model_version(kpi, machine_name)
         if result is None:
             print(f"No record found for KPI: {kpi} and MachineName: {machine_name}")
             return None
-        model_path = result[0]
-        bucket_name, file_name = model_path.split('/', 1)
+        model_path, version, etag = result
+        json_data = _cached_model(kpi, machine_name, etag)
+        if json_data is not None:
+            return json_data
 
         # Retrieve JSON object from MinIO
-        client = get_minio_client()
-        response = client.get_object(bucket_name, file_name)
-        json_data = json.load(response)
-        response.close()
-        response.release_conn()
+        json_data = _fetch_model(get_minio_client(), model_path)
+        _cache_model(kpi, machine_name, etag, json_data)
         print(f"JSON data retrieved for KPI: {kpi} and MachineName: {machine_name}")
         return json_data
     except Exception as e:
         print("Error occurred:", e)
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
     pass
 
-# Retrieve all JSON models from the storage
-def retrieve_all_models_from_storage():
+# List the stored versions of the model of (kpi, machine_name), the newest first
+def list_model_versions(kpi, machine_name):
     try:
-        # Query PostgreSQL for all file paths
-        conn = get_postgres_connection()
-        cursor = conn.cursor()
-        select_query = """
-        SELECT KPI, MachineName, ModelPath FROM Models;
-        """
-        cursor.execute(select_query)
-        results = cursor.fetchall()
+        with postgres_connection() as conn, conn.cursor() as cursor:
+            select_query = """
+            SELECT Version, TrainedOn, SizeBytes, ETag, IsActive FROM Models
+            WHERE KPI = %s AND MachineName = %s
+            ORDER BY Version DESC;
+            """
+            cursor.execute(select_query, (kpi, machine_name))
+            rows = cursor.fetchall()
+            conn.rollback()
+        return [{
+            "Version": version,
+            "TrainedOn": str(trained_on) if trained_on is not None else None,
+            "SizeBytes": size_bytes,
+            "ETag": etag,
+            "IsActive": is_active
+        } for version, trained_on, size_bytes, etag, is_active in rows]
+    except Exception as e:
+        print("Error occurred while listing the model versions:", e)
+        return []
 
-        all_models = []
-        client = get_minio_client()
+# List the active models reading only the Models table, no model is downloaded
+def list_models_from_storage():
+    try:
+        with postgres_connection() as conn, conn.cursor() as cursor:
+            select_query = """
+            SELECT KPI, MachineName, ModelPath, TrainedOn, Version, SizeBytes FROM Models
+            WHERE IsActive
+            ORDER BY MachineName, KPI;
+            """
+            cursor.execute(select_query)
+            rows = cursor.fetchall()
+            conn.rollback()
+        return [{
+            "KPI": kpi,
+            "MachineName": machine_name,
+            "ModelPath": model_path,
+            "TrainedOn": str(trained_on) if trained_on is not None else None,
+            "Version": version,
+            "SizeBytes": size_bytes
+        } for kpi, machine_name, model_path, trained_on, version, size_bytes in rows]
+    except Exception as e:
+        print("Error occurred while listing the models:", e)
+        return []
 
-        for kpi, machine_name, model_path in results:
-            bucket_name, file_name = model_path.split('/', 1)
+def _fetch_model(client, model_path):
+    bucket_name, file_name = model_path.split('/', 1)
+    response = client.get_object(bucket_name, file_name)
+    try:
+        return json.load(response)
+    finally:
+        response.close()
+        response.release_conn()
 
+# Download the JSON of the given models concurrently, models is a list of entries of list_models_from_storage
+def fetch_models_from_storage(models, max_workers=FETCH_WORKERS):
+    if len(models) == 0:
+        return []
+    client = get_minio_client()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_fetch_model, client, m["ModelPath"]) for m in models]
+        all_models = []
+        for m, future in zip(models, futures):
             try:
-                # Retrieve JSON object from MinIO
-                response = client.get_object(bucket_name, file_name)
-                json_data = json.load(response)
-                response.close()
-                response.release_conn()
-
-                all_models.append({
-                    "KPI": kpi,
-                    "MachineName": machine_name,
-                    "ModelPath": model_path,
-                    "Data": json_data
-                })
+                all_models.append({**m, "Data": future.result()})
             except Exception as e:
-                print(f"Error retrieving file {file_name} from bucket {bucket_name}: {e}")
+                print(f"Error retrieving file {m['ModelPath']}: {e}")
+    return all_models
 
-        print("All models retrieved successfully.")
-        return all_models
+# Retrieve all JSON models from the storage
+def retrieve_all_models_from_storage():
+    all_models = fetch_models_from_storage(list_models_from_storage())
+    print("All models retrieved successfully.")
+    return all_models
+
+# Replace the stored forecasts of some series, forecasts is a list of dictionaries with KPI, MachineName,
+# ModelVersion, LastObserved (time of the last data point) and the step lists returned by make_prediction
+def save_forecasts(forecasts):
+    if len(forecasts) == 0:
+        return 0
+    keys = [(f["KPI"], f["MachineName"]) for f in forecasts]
+    rows = []
+    for f in forecasts:
+        steps = zip(f["Date_prediction"], f["Predicted_value"], f["Lower_bound"], f["Upper_bound"], f["Confidence_score"])
+        for step, (forecast_date, predicted, lower, upper, confidence) in enumerate(steps, start=1):
+            rows.append((f["KPI"], f["MachineName"], step, forecast_date, predicted, lower, upper, confidence,
+                         f["ModelVersion"], f["LastObserved"]))
+    try:
+        with postgres_connection() as conn, conn.cursor() as cursor:
+            # a series is replaced as a whole, a shorter horizon leaves no old steps behind
+            execute_values(cursor, "DELETE FROM Forecasts WHERE (KPI, MachineName) IN (VALUES %s)", keys)
+            execute_values(cursor, """
+            INSERT INTO Forecasts (KPI, MachineName, Step, ForecastDate, Predicted, LowerBound, UpperBound,
+                                   Confidence, ModelVersion, LastObserved)
+            VALUES %s
+            """, rows, page_size=1000)
+            conn.commit()
+        return len(rows)
     except Exception as e:
-        print("Error occurred while retrieving all models:", e)
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
\ No newline at end of file
+        print("Error storing the forecasts:", e)
+        return 0
+
+# First horizon steps of the stored forecast of (kpi, machine_name), None if fewer steps are stored
+def get_stored_forecast(kpi, machine_name, horizon):
+    try:
+        with postgres_connection() as conn, conn.cursor() as cursor:
+            select_query = """
+            SELECT ForecastDate, Predicted, LowerBound, UpperBound, Confidence, ModelVersion, LastObserved
+            FROM Forecasts
+            WHERE KPI = %s AND MachineName = %s AND Step <= %s
+            ORDER BY Step;
+            """
+            cursor.execute(select_query, (kpi, machine_name, horizon))
+            rows = cursor.fetchall()
+            conn.rollback()
+    except Exception as e:
+        print("Error reading the stored forecast:", e)
+        return None
+    if len(rows) < horizon:
+        return None
+    return {
+        "ModelVersion": rows[0][5],
+        "LastObserved": rows[0][6],
+        "Predicted_value": [r[1] for r in rows],
+        "Lower_bound": [r[2] for r in rows],
+        "Upper_bound": [r[3] for r in rows],
+        "Confidence_score": [r[4] for r in rows],
+        "Lime_explaination": [],
+        "Date_prediction": [str(r[0]) for r in rows]
+    }
+
+# Stored forecast values of (kpi, machine_name) for some dates, as a dictionary date -> value
+def get_forecast_values(kpi, machine_name, dates):
+    try:
+        with postgres_connection() as conn, conn.cursor() as cursor:
+            select_query = """
+            SELECT ForecastDate, Predicted FROM Forecasts
+            WHERE KPI = %s AND MachineName = %s AND ForecastDate = ANY(%s);
+            """
+            cursor.execute(select_query, (kpi, machine_name, list(dates)))
+            rows = cursor.fetchall()
+            conn.rollback()
+        return dict(rows)
+    except Exception as e:
+        print("Error reading the stored forecast values:", e)
+        return {}
+
+# First horizon steps of the stored forecasts of a KPI for many machines with one query, as a dictionary
+# machine -> forecast (with LastObserved), the machines with fewer stored steps are left out
+def get_stored_forecasts(kpi, machine_names, horizon):
+    try:
+        with postgres_connection() as conn, conn.cursor() as cursor:
+            select_query = """
+            SELECT MachineName, ForecastDate, Predicted, LowerBound, UpperBound, Confidence, LastObserved
+            FROM Forecasts
+            WHERE KPI = %s AND MachineName = ANY(%s) AND Step <= %s
+            ORDER BY MachineName, Step;
+            """
+            cursor.execute(select_query, (kpi, list(machine_names), horizon))
+            rows = cursor.fetchall()
+            conn.rollback()
+    except Exception as e:
+        print("Error reading the stored forecasts:", e)
+        return {}
+    forecasts = {}
+    for machine_name, forecast_date, predicted, lower, upper, confidence, last_observed in rows:
+        forecast = forecasts.setdefault(machine_name, {
+            "LastObserved": last_observed,
+            "Predicted_value": [],
+            "Lower_bound": [],
+            "Upper_bound": [],
+            "Confidence_score": [],
+            "Date_prediction": []
+        })
+        forecast["Predicted_value"].append(predicted)
+        forecast["Lower_bound"].append(lower)
+        forecast["Upper_bound"].append(upper)
+        forecast["Confidence_score"].append(confidence)
+        forecast["Date_prediction"].append(str(forecast_date))
+    return {m: f for m, f in forecasts.items() if len(f["Predicted_value"]) == horizon}
+
+# Missing and zero streaks of all the monitored series, as a dictionary (machine_name, kpi) -> state
+def get_monitoring_state():
+    try:
+        with postgres_connection() as conn, conn.cursor() as cursor:
+            select_query = """
+            SELECT MachineName, KPI, MissingStreak, ZeroStreak, MissingAlertSent, ZeroAlertSent, LastObserved
+            FROM MonitoringState;
+            """
+            cursor.execute(select_query)
+            rows = cursor.fetchall()
+            conn.rollback()
+    except Exception as e:
+        print("Error reading the monitoring state:", e)
+        return {}
+    return {(machine_name, kpi): {
+        "MissingStreak": missing_streak,
+        "ZeroStreak": zero_streak,
+        "MissingAlertSent": missing_alert_sent,
+        "ZeroAlertSent": zero_alert_sent,
+        "LastObserved": last_observed
+    } for machine_name, kpi, missing_streak, zero_streak, missing_alert_sent, zero_alert_sent, last_observed in rows}
+
+# Write the state of many series with one statement, states is a list of dictionaries with MachineName, KPI
+# and the keys returned by get_monitoring_state
+def save_monitoring_state(states):
+    if len(states) == 0:
+        return 0
+    rows = [(s["KPI"], s["MachineName"], s["MissingStreak"], s["ZeroStreak"], s["MissingAlertSent"], s["ZeroAlertSent"],
+             s["LastObserved"]) for s in states]
+    try:
+        with postgres_connection() as conn, conn.cursor() as cursor:
+            execute_values(cursor, """
+            INSERT INTO MonitoringState (KPI, MachineName, MissingStreak, ZeroStreak, MissingAlertSent, ZeroAlertSent, LastObserved)
+            VALUES %s
+            ON CONFLICT (KPI, MachineName) DO UPDATE SET
+            MissingStreak = EXCLUDED.MissingStreak, ZeroStreak = EXCLUDED.ZeroStreak,
+            MissingAlertSent = EXCLUDED.MissingAlertSent, ZeroAlertSent = EXCLUDED.ZeroAlertSent,
+            LastObserved = EXCLUDED.LastObserved, UpdatedAt = NOW()
+            """, rows, page_size=1000)
+            conn.commit()
+        return len(rows)
+    except Exception as e:
+        print("Error storing the monitoring state:", e)
+        return 0
@@ -0,0 +1,182 @@
+import numpy as np
+from math import isnan, sqrt
+
+# Streaming statistics of a KPI series, updated one data point at a time.
+# Their state is a plain dictionary stored in the model metadata, so the daily
+# monitoring only needs the new value instead of reloading the whole history.
+
+class RunningMoments:
+  """
+  Mean and variance of a stream with Welford's algorithm.
+
+  Attributes:
+  - n: int, number of values seen.
+  - mean: float, running mean.
+  - m2: float, running sum of squared deviations from the mean.
+  """
+
+  def __init__(self, n=0, mean=0.0, m2=0.0):
+    self.n = n
+    self.mean = mean
+    self.m2 = m2
+
+  @classmethod
+  def from_array(cls, values):
+    """Initializes the moments from a whole array at once."""
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+      return cls()
+    mean = float(np.mean(values))
+    return cls(len(values), mean, float(np.sum((values - mean) ** 2)))
+
+  def update(self, x):
+    self.n += 1
+    delta = x - self.mean
+    self.mean += delta / self.n
+    self.m2 += delta * (x - self.mean)
+
+  def variance(self):
+    return self.m2 / self.n if self.n > 0 else 0.0
+
+  def std(self):
+    return sqrt(self.variance())
+
+  def to_dict(self):
+    return {'n': self.n, 'mean': self.mean, 'm2': self.m2}
+
+  @classmethod
+  def from_dict(cls, d):
+    return cls(d['n'], d['mean'], d['m2'])
+
+
+class RollingWindow:
+  """
+  Ring buffer of the last `size` values keeping their sum and sum of squares,
+  so that the window mean and standard deviation cost O(1) per update.
+
+  The sums are recomputed from the buffer every time it wraps around, which bounds the
+  floating point drift of the incremental updates at an amortized O(1) cost.
+  """
+
+  def __init__(self, size=30, values=None, pos=0):
+    self.size = size
+    self.values = list(values) if values is not None else []
+    self.pos = pos
+    self._resync()
+
+  def _resync(self):
+    self.total = float(sum(self.values))
+    self.total_sq = float(sum(v * v for v in self.values))
+
+  @classmethod
+  def from_array(cls, values, size=30):
+    """Initializes the window with the last `size` values of an array."""
+    values = [float(v) for v in np.asarray(values, dtype=float)[-size:]]
+    return cls(size, values, 0)
+
+  def update(self, x):
+    if len(self.values) < self.size:
+      self.values.append(x)
+      self.total += x
+      self.total_sq += x * x
+      return
+    old = self.values[self.pos]
+    self.values[self.pos] = x
+    self.pos = (self.pos + 1) % self.size
+    if self.pos == 0:
+      self._resync()
+    else:
+      self.total += x - old
+      self.total_sq += x * x - old * old
+
+  def count(self):
+    return len(self.values)
+
+  def mean(self):
+    return self.total / len(self.values) if self.values else 0.0
+
+  def std(self):
+    if not self.values:
+      return 0.0
+    mean = self.mean()
+    return sqrt(max(self.total_sq / len(self.values) - mean * mean, 0.0))
+
+  def to_dict(self):
+    return {'size': self.size, 'values': self.values, 'pos': self.pos}
+
+  @classmethod
+  def from_dict(cls, d):
+    return cls(d['size'], d['values'], d['pos'])
+
+
+class StreamingStats:
+  """
+  Streaming statistics of one KPI series: Welford moments and running extrema over
+  the whole history, plus a rolling window of the most recent values used for the
+  outlier check. Missing (nan) values are ignored.
+  """
+
+  def __init__(self, moments=None, window=None, min_value=float('inf'), max_value=float('-inf')):
+    self.moments = moments or RunningMoments()
+    self.window = window or RollingWindow()
+    self.min_value = min_value
+    self.max_value = max_value
+
+  @classmethod
+  def from_series(cls, values, window_size=30):
+    """
+    Seeds the statistics from a whole series, done once when the model is trained.
+
+    :param values: array-like, the series values.
+    :param window_size: int, number of recent values kept for the outlier check.
+    """
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+      return cls(window=RollingWindow(window_size))
+    return cls(RunningMoments.from_array(values), RollingWindow.from_array(values, window_size),
+               float(np.min(values)), float(np.max(values)))
+
+  def update(self, x):
+    """Adds a new value in O(1)."""
+    if x is None or isnan(x):
+      return
+    self.moments.update(x)
+    self.window.update(x)
+    self.min_value = min(self.min_value, x)
+    self.max_value = max(self.max_value, x)
+
+  def is_outlier(self, x, multiplier=3):
+    """
+    Checks a value against the rolling window, before adding it.
+
+    :param x: float, value to check.
+    :param multiplier: float, number of standard deviations from the window mean tolerated.
+    :return: bool, True if outlier, False otherwise (or when the window is empty).
+    """
+    if self.window.count() == 0:
+      return False
+    return abs(x - self.window.mean()) > self.window.std() * multiplier
+
+  def trends(self):
+    """
+    :return: dictionary with the max, min, mean and std of the whole history (as data_extract_trends)
+    """
+    return {
+        'max': self.max_value if self.moments.n > 0 else 0,
+        'min': self.min_value if self.moments.n > 0 else 0,
+        'mean': self.moments.mean,
+        'std': self.moments.std()
+    }
+
+  def to_dict(self):
+    return {
+        'moments': self.moments.to_dict(),
+        'window': self.window.to_dict(),
+        'min': self.min_value,
+        'max': self.max_value
+    }
+
+  @classmethod
+  def from_dict(cls, d):
+    return cls(RunningMoments.from_dict(d['moments']), RollingWindow.from_dict(d['window']), d['min'], d['max'])
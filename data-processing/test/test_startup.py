@@ -0,0 +1,31 @@
+import sys
+import os
+import json
+import subprocess
+import unittest
+
+SERVICE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, SERVICE_DIR)
+
+from benchmark.startup import lazy_packages
+
+# modules loaded by 'import main' in a fresh interpreter, without the background preload of BACKENDS_PRELOAD
+_PROBE = "import json, sys; import main; print(json.dumps(sorted(sys.modules)))"
+
+class TestStartup(unittest.TestCase):
+
+    def test_no_lazy_backend_imported_at_startup(self):
+        proc = subprocess.run([sys.executable, '-c', _PROBE], cwd=SERVICE_DIR, capture_output=True, text=True,
+                              env=dict(os.environ, BACKENDS_PRELOAD=''))
+        self.assertEqual(proc.returncode, 0, proc.stderr[-2000:])
+        modules = json.loads(proc.stdout.strip().splitlines()[-1])
+
+        # lime is the package under aix360.algorithms.lime, the registry must still cover the frameworks
+        lazy = lazy_packages() | {'lime'}
+        self.assertEqual(lazy & {'xgboost', 'statsmodels', 'sklearn', 'torch', 'aix360'},
+                         {'xgboost', 'statsmodels', 'sklearn', 'torch', 'aix360'})
+        loaded = sorted({module.split('.')[0] for module in modules} & lazy)
+        self.assertEqual(loaded, [], f"backends imported by 'import main': {', '.join(loaded)}")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -117,7 +117,81 @@ if __name__ == "__main__":
             ID SERIAL PRIMARY KEY,
             KPI VARCHAR(50) NOT NULL,
             MachineName VARCHAR(50) NOT NULL,
-            ModelPath TEXT NOT NULL
+            ModelPath TEXT NOT NULL,
+            TrainedOn DATE,
+            Version VARCHAR(50) NOT NULL DEFAULT '',
+            SizeBytes INT,
+            ETag VARCHAR(100),
+            IsActive BOOLEAN NOT NULL DEFAULT FALSE
+            )
+            """,
+            # registry columns of the Models table for databases created before they existed
+            """
+            ALTER TABLE Models
+            ADD COLUMN IF NOT EXISTS TrainedOn DATE,
+            ADD COLUMN IF NOT EXISTS Version VARCHAR(50),
+            ADD COLUMN IF NOT EXISTS SizeBytes INT,
+            ADD COLUMN IF NOT EXISTS ETag VARCHAR(100),
+            ADD COLUMN IF NOT EXISTS IsActive BOOLEAN NOT NULL DEFAULT FALSE
+            """,
+            """
+            UPDATE Models SET Version = '' WHERE Version IS NULL
+            """,
+            """
+            ALTER TABLE Models
+            ALTER COLUMN Version SET DEFAULT '',
+            ALTER COLUMN Version SET NOT NULL
+            """,
+            # older databases have one row per save, only the latest one is kept
+            """
+            DELETE FROM Models a USING Models b
+            WHERE a.KPI = b.KPI AND a.MachineName = b.MachineName AND a.Version = b.Version AND a.ID < b.ID
+            """,
+            """
+            UPDATE Models SET IsActive = TRUE
+            WHERE ID IN (SELECT MAX(ID) FROM Models GROUP BY KPI, MachineName)
+            AND NOT EXISTS (SELECT 1 FROM Models m WHERE m.IsActive)
+            """,
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS models_version_idx ON Models (KPI, MachineName, Version)
+            """,
+            # at most one active version per model, also the index of the serving lookups
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS models_active_idx ON Models (KPI, MachineName) WHERE IsActive
+            """,
+            # latest forecasts of every series, written by the nightly batch of data-processing
+            """
+            CREATE TABLE IF NOT EXISTS Forecasts (
+            KPI VARCHAR(50) NOT NULL,
+            MachineName VARCHAR(50) NOT NULL,
+            Step INT NOT NULL,
+            ForecastDate DATE NOT NULL,
+            Predicted DOUBLE PRECISION NOT NULL,
+            LowerBound DOUBLE PRECISION,
+            UpperBound DOUBLE PRECISION,
+            Confidence DOUBLE PRECISION,
+            ModelVersion VARCHAR(50) NOT NULL,
+            LastObserved VARCHAR(30) NOT NULL,
+            CreatedAt TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (KPI, MachineName, Step)
+            )
+            """,
+            # lookup of the expected value of a date by the monitoring
+            """
+            CREATE INDEX IF NOT EXISTS forecasts_date_idx ON Forecasts (KPI, MachineName, ForecastDate)
+            """,
+            # missing and zero streaks of every monitored series, written in bulk by the monitoring pass
+            """
+            CREATE TABLE IF NOT EXISTS MonitoringState (
+            KPI VARCHAR(50) NOT NULL,
+            MachineName VARCHAR(50) NOT NULL,
+            MissingStreak INT NOT NULL DEFAULT 0,
+            ZeroStreak INT NOT NULL DEFAULT 0,
+            MissingAlertSent BOOLEAN NOT NULL DEFAULT FALSE,
+            ZeroAlertSent BOOLEAN NOT NULL DEFAULT FALSE,
+            LastObserved VARCHAR(30),
+            UpdatedAt TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (KPI, MachineName)
             )
             """,
             """
@@ -311,6 +311,20 @@ async def ask_predictor_engine(json_body):
                     }
                 }
 
+def without_explanations(json_body):
+    """
+    Asks the predictor engine not to compute the LIME explanations, which are discarded by the agent anyway.
+
+    Args:
+        json_body (dict): the json used to communicate the request to the predictor engine API.
+
+    Returns:
+        dict: the same request with Explanation_mode set to 'none' for every element.
+    """
+    for item in json_body.get('value', []):
+        item['Explanation_mode'] = 'none'
+    return json_body
+
 async def handle_predictions(json_body):
     """
     Handles the response from the predictor engine.
@@ -324,7 +338,7 @@ async def handle_predictions(json_body):
     Returns:
         str: A string representing the prediction data formatted for the response.
     """
-    response = await ask_predictor_engine(json_body)
+    response = await ask_predictor_engine(without_explanations(json_body))
 
     if response['success'] == True:
         for item in response['data']['value']:
@@ -369,7 +383,7 @@ async def handle_report(json_objs):
     Returns:
         str: A formatted report string containing both KPI and prediction data.
     """
-    predictor_response = await ask_predictor_engine(json_objs[1])
+    predictor_response = await ask_predictor_engine(without_explanations(json_objs[1]))
 
     if predictor_response['success'] == True:
         for item in predictor_response['data']['value']: